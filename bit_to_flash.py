@@ -1,44 +1,63 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import sys
+import time
+import random
+import tempfile
 import textwrap
+import argparse
+import subprocess
 
 # Very basic bitstream to SVF converter, tested with the ULX3S WiFi interface
 
 flash_page_size = 256
 erase_block_size = 64*1024
 
+# Bits are shifted out LSB first, so every byte sent to the flash is bit-reversed.
+BITREVERSE = bytes(int("{:08b}".format(x)[::-1], 2) for x in range(256))
 
-def bitreverse(x):
-    y = 0
-    for i in range(8):
-        if (x >> (7 - i)) & 1 == 1:
-            y |= (1 << i)
-    return y
-
-with open(sys.argv[1], 'rb') as bitf:
-    bs = bitf.read()
+def find_idcode(bs):
     # Autodetect IDCODE from bitstream
-    idcode_cmd = bytes([0xE2, 0x00, 0x00, 0x00])
-    idcode = None
-    for i in range(len(bs) - 4):
-        if bs[i:i+4] == idcode_cmd:
-            idcode = bs[i+4] << 24
-            idcode |= bs[i+5] << 16
-            idcode |= bs[i+6] << 8
-            idcode |= bs[i+7]
-            break
-    if idcode is None:
-        print("Failed to find IDCODE in bitstream, check bitstream is valid")
-        sys.exit(1)
-    print("IDCODE in bitstream is 0x%08x" % idcode)
-    bitf.seek(0)
+    i = bs.find(bytes([0xE2, 0x00, 0x00, 0x00]), 0, len(bs) - 1)
+    if i < 0:
+        return None
+    return int.from_bytes(bs[i+4:i+8], "big")
+
+def sdr_hex(data):
+    # Bit-reversed bytes as hex, last byte first.
+    return data.translate(BITREVERSE)[::-1].hex().upper()
 
-    address = 0
-    last_page = -1
+def sdr_wrap(data, width=100):
+    # Same lines as textwrap.wrap() on "SDR <n> TDI (<hex>);", slicing directly when the hex is split.
+    line = "SDR {} TDI ({});".format(8*len(data), sdr_hex(data))
+    if len(line) <= width or 2*len(data) + 3 <= width:
+        return "\n".join(textwrap.wrap(line, width))
+    return "\n".join(line[i:i+width] for i in range(0, len(line), width))
 
-    with open(sys.argv[2], 'w') as svf:
-        print("""
+def changed_blocks(bs, previous):
+    """Erase blocks of bs whose content differs from the previously flashed image (or readback)."""
+    blocks = []
+    for start in range(0, len(bs), erase_block_size):
+        new = bs[start:start + erase_block_size]
+        if start >= len(previous):
+            # Never written by the previous image: content unknown.
+            blocks.append(start // erase_block_size)
+            continue
+        # The tail of the previous image's last block was left erased.
+        old = previous[start:start + len(new)]
+        old += b"\xff"*(len(new) - len(old))
+        if old != new:
+            blocks.append(start // erase_block_size)
+    return blocks
+
+def bitstream_to_svf(bs, idcode, previous=None):
+    svf = []
+    def emit(s):
+        svf.append(s + "\n")
+
+    emit("""
 STATE RESET;
 HDR	0;
 HIR	0;
@@ -47,14 +66,14 @@ TIR	0;
 ENDDR	DRPAUSE;
 ENDIR	IRPAUSE;
 STATE	IDLE;
-        """, file=svf)
-        print("""
+        """)
+    emit("""
 SIR	8	TDI  (E0);
 SDR	32	TDI  (00000000)
         TDO  ({:08X})
         MASK (FFFFFFFF);
-        """.format(idcode), file=svf)
-        print("""
+        """.format(idcode))
+    emit("""
 SIR	8	TDI  (1C);
 SDR	510	TDI  (3FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
              FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF);
@@ -108,34 +127,49 @@ SDR 16   TDI(0080);
 RUNTEST 1.00E-0 SEC;
 
 
-        """, file=svf)
+        """)
+
+    def erase(block):
+        emit("""SDR	8	TDI  (60);
+                """)
+        emit(sdr_wrap(bytes([0xd8, block & 0xff, 0x00, 0x00])))
+        emit("""RUNTEST	3.00 SEC;
+                """)
+
+    def program(address, chunk):
+        header = bytes([0x02, (address >> 16) & 0xff, (address >> 8) & 0xff, address & 0xff])
+        emit("""
+SDR	8	TDI  (60);
+                """)
+        emit(sdr_wrap(header + chunk))
+        emit("""
+RUNTEST	2.50E-2 SEC;
+                """)
+
+    if previous is None:
+        address = 0
+        last_page = -1
         while True:
             if((address // 0x10000) != last_page):
                 last_page = (address // 0x10000)
-                print("""SDR	8	TDI  (60);
-                """, file=svf)
-                address_flipped = [bitreverse(x) for x in [0xd8,int(address // 0x10000),0x00,0x00]]
-                hex_address= ["{:02X}".format(x) for x in reversed(address_flipped)]
-                print("\n".join(textwrap.wrap("SDR {} TDI ({});".format(8*len(hex_address), "".join(hex_address)), 100)), file=svf)
-                print("""RUNTEST	3.00 SEC;
-                """, file=svf)
-
-            chunk = bitf.read(flash_page_size)
+                erase(last_page)
+
+            chunk = bs[address:address + flash_page_size]
             if not chunk:
                 break
-            # Convert chunk to bit-reversed hex
-            br_chunk = [bitreverse(x) for x in bytes([0x02, int(address / 0x10000 % 0x100),int(address / 0x100 % 0x100),int(address % 0x100)]) + chunk]
+            program(address, chunk)
             address += len(chunk)
-            hex_chunk = ["{:02X}".format(x) for x in reversed(br_chunk)]
-            print("""
-SDR	8	TDI  (60);
-                """, file=svf)
-            print("\n".join(textwrap.wrap("SDR {} TDI ({});".format(8*len(br_chunk), "".join(hex_chunk)), 100)), file=svf)
-            print("""
-RUNTEST	2.50E-2 SEC;
-                """, file=svf)
+    else:
+        # Only rewrite changed blocks; pages left blank (0xFF) by the erase are not programmed.
+        for block in changed_blocks(bs, previous):
+            erase(block)
+            start = block*erase_block_size
+            for address in range(start, min(start + erase_block_size, len(bs)), flash_page_size):
+                chunk = bs[address:address + flash_page_size]
+                if chunk.count(0xff) != len(chunk):
+                    program(address, chunk)
 
-        print("""
+    emit("""
 // BYPASS
 SIR 8 TDI (FF);
 
@@ -147,4 +181,216 @@ STATE IDLE;
 RUNTEST 32 TCK;
 RUNTEST 2.00E-2 SEC;
 STATE RESET;
-        """, file=svf)
+        """)
+    return "".join(svf)
+
+def svf_runtime(svf):
+    """Programming time spent in RUNTEST waits of an SVF, in seconds."""
+    return sum(float(t) for t in re.findall(r"RUNTEST[^;]*?([0-9.]+E?[-+]?[0-9]*)\s+SEC", svf))
+
+# W25Q32JV Model -----------------------------------------------------------------------------------
+
+class W25Q32JV:
+    """Software model of the SPI flash, driven by the SPI transactions of an SVF file."""
+    size = 4*1024*1024
+
+    def __init__(self, content=b""):
+        self.mem = bytearray(b"\xff"*self.size)
+        self.mem[:len(content)] = content
+        self.wel = False
+        self.erased     = [] # Addresses of the executed block erases.
+        self.programmed = [] # and page programs.
+
+    def miso(self, data):
+        """Bytes shifted out by the flash while data is shifted in."""
+        cmd, addr = data[0], int.from_bytes(data[1:4], "big")
+        out = bytearray(b"\xff"*len(data))
+        if cmd == 0x9f:
+            out[1:4] = bytes([0xef, 0x40, 0x16])
+        elif cmd == 0x05:
+            out[1:] = bytes([0x02 if self.wel else 0x00])*(len(data) - 1)
+        elif cmd in [0x03, 0x0b]:
+            start = 4 if cmd == 0x03 else 5 # Fast read has one dummy byte.
+            for i in range(start, len(data)):
+                out[i] = self.mem[(addr + i - start) % self.size]
+        return bytes(out[:len(data)])
+
+    def spi(self, data):
+        """Execute a complete (chip select framed) SPI transaction, returns the MISO bytes."""
+        miso = self.miso(data)
+        cmd, addr = data[0], int.from_bytes(data[1:4], "big")
+        if cmd == 0x06:
+            self.wel = True
+        if cmd == 0xd8 and self.wel:
+            start = addr & ~(erase_block_size - 1)
+            self.erased.append(start)
+            self.mem[start:start + erase_block_size] = b"\xff"*erase_block_size
+        if cmd == 0x02 and self.wel:
+            page = addr & ~(flash_page_size - 1)
+            self.programmed.append(page)
+            for i, b in enumerate(data[4:4 + flash_page_size]):
+                a = page + ((addr + i) % flash_page_size)
+                self.mem[a] &= b
+        if cmd in [0x01, 0x02, 0xd8]:
+            self.wel = False
+        return miso
+
+    def run_svf(self, svf):
+        spi_mode = False
+        spi_key  = False
+        for stmt in re.sub(r"//[^\n]*", "", svf).split(";"):
+            words = stmt.split()
+            if not words:
+                continue
+            if words[0] == "SIR":
+                spi_key  = "(3A)" in stmt.replace(" ", "")
+                spi_mode = False
+            elif words[0] == "SDR":
+                if spi_key:
+                    spi_key, spi_mode = False, True
+                elif spi_mode:
+                    tdi = re.search(r"TDI\s*\(([0-9A-Fa-f\s]+)\)", stmt).group(1)
+                    self.spi(bytes.fromhex("".join(tdi.split()))[::-1].translate(BITREVERSE))
+
+# Self-test ----------------------------------------------------------------------------------------
+
+# The original per-byte converter, kept with the build outputs it produced.
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "build", "gateware", "bit_to_flash.py")
+
+def test_bitstreams(count=6, seed=0):
+    """(name, data) test inputs: sizes around page/block boundaries and random ones, with some blank pages."""
+    rng   = random.Random(seed)
+    sizes = [8, flash_page_size, erase_block_size - 1, erase_block_size, 2*erase_block_size + 3]
+    sizes += [rng.randrange(8, 3*erase_block_size) for _ in range(count)]
+    for size in sizes:
+        bs = bytearray(rng.randbytes(size))
+        for page in range(0, size, flash_page_size):
+            if rng.random() < 0.2:
+                bs[page:page + flash_page_size] = b"\xff"*len(bs[page:page + flash_page_size])
+        bs[:8] = bytes([0xe2, 0x00, 0x00, 0x00, 0x41, 0x11, 0x10, 0x43]) # IDCODE command (LFE5U-25F).
+        yield f"random {size} bytes", bytes(bs)
+
+def check_reference(bitstreams, reference=REFERENCE):
+    """Names of the bitstreams whose SVF differs (byte for byte) from the original converter's."""
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        bit, svf = os.path.join(tmp, "in.bit"), os.path.join(tmp, "out.svf")
+        for name, bs in bitstreams:
+            with open(bit, "wb") as f:
+                f.write(bs)
+            subprocess.run([sys.executable, reference, bit, svf], check=True, capture_output=True)
+            with open(svf, "rb") as f:
+                expected = f.read()
+            if bitstream_to_svf(bs, find_idcode(bs)).encode() != expected:
+                failures.append(name)
+    return failures
+
+def check_incremental(old, blocks, grow=0, seed=0):
+    """Problems flashing an image differing from old in `blocks` (and grown by `grow` bytes) with --previous.
+
+    In each changed block a few bytes change and one page becomes blank: only those blocks may be
+    erased, only their non-blank pages programmed, and the flash must end up holding the new image.
+    """
+    rng = random.Random(seed)
+    new = bytearray(old) + bytearray(rng.randbytes(grow))
+    for block in blocks:
+        start = block*erase_block_size
+        for addr in rng.sample(range(start, min(start + erase_block_size, len(old))), 4):
+            new[addr] ^= 0x5a
+        page = start + flash_page_size*rng.randrange(min(erase_block_size, len(old) - start)//flash_page_size)
+        new[page:page + flash_page_size] = b"\xff"*flash_page_size
+    new      = bytes(new)
+    expected = set(blocks) | set(range(len(old)//erase_block_size, (len(new) - 1)//erase_block_size + 1) if grow else ())
+    pages    = [a for b in sorted(expected)
+        for a in range(b*erase_block_size, min((b + 1)*erase_block_size, len(new)), flash_page_size)
+        if new[a:a + flash_page_size].count(0xff) != len(new[a:a + flash_page_size])]
+
+    flash = W25Q32JV(old)
+    flash.run_svf(bitstream_to_svf(new, find_idcode(new), old))
+    problems = []
+    if sorted(flash.erased) != [b*erase_block_size for b in sorted(expected)]:
+        problems.append(f"erased blocks {[a//erase_block_size for a in flash.erased]}, expected {sorted(expected)}")
+    if flash.programmed != pages:
+        problems.append(f"programmed {len(flash.programmed)} pages, expected the {len(pages)} non-blank pages of the changed blocks")
+    if flash.mem[:len(new)] != new or flash.mem[len(new):].count(0xff) != flash.size - len(new):
+        problems.append("flash model content differs from the new image")
+    return problems
+
+def selftest(bitstream=None):
+    bitstreams = list(test_bitstreams())
+    if bitstream is not None:
+        with open(bitstream, "rb") as f:
+            bitstreams.insert(0, (bitstream, f.read()))
+    failures = check_reference(bitstreams)
+    print(f"SVF identical to the original converter: {len(bitstreams) - len(failures)}/{len(bitstreams)}")
+    for name in failures:
+        print(f"  differs: {name}")
+
+    # Incremental (--previous) flashing of an image (at least 3 blocks) changed in a few blocks.
+    old = bitstreams[0][1] if bitstream is not None else next(test_bitstreams())[1]
+    old = old + bytes(random.Random(1).randbytes(max(0, 3*erase_block_size - len(old))))
+    cases = [((0, 2), 0), ((1,), 0), ((0,), erase_block_size + 100)]
+    for blocks, grow in cases:
+        problems = check_incremental(old, blocks, grow)
+        print(f"Incremental SVF, blocks {blocks} changed{f', grown by {grow} bytes' if grow else ''}: "
+              f"{'ok' if not problems else '; '.join(problems)}")
+        failures += problems
+    return not failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Bitstream to SPI flash programming SVF")
+    parser.add_argument("bitstream", nargs="?", help="Input bitstream (.bit)")
+    parser.add_argument("svf",       nargs="?", help="Output SVF file")
+    parser.add_argument("--previous",  default=None,      help="Previously flashed image or flash readback: only rewrite changed blocks")
+    parser.add_argument("--verify",    action="store_true", help="Check the SVF against a W25Q32JV flash model")
+    parser.add_argument("--benchmark", default=0, type=int, help="Time N conversions and report throughput")
+    parser.add_argument("--selftest",  action="store_true", help="Check the SVF output against the original converter and incremental flashing on the W25Q32JV model (on bitstream if given)")
+    args = parser.parse_args()
+
+    if args.selftest:
+        sys.exit(0 if selftest(args.bitstream) else 1)
+    if args.bitstream is None or args.svf is None:
+        parser.error("bitstream and svf are required")
+
+    with open(args.bitstream, 'rb') as bitf:
+        bs = bitf.read()
+    idcode = find_idcode(bs)
+    if idcode is None:
+        print("Failed to find IDCODE in bitstream, check bitstream is valid")
+        sys.exit(1)
+    print("IDCODE in bitstream is 0x%08x" % idcode)
+
+    previous = None
+    if args.previous is not None:
+        with open(args.previous, 'rb') as f:
+            previous = f.read()
+
+    svf = bitstream_to_svf(bs, idcode, previous)
+    if previous is not None:
+        blocks = changed_blocks(bs, previous)
+        full   = svf_runtime(bitstream_to_svf(bs, idcode))
+        diff   = svf_runtime(svf)
+        print("Rewriting {}/{} blocks, estimated programming time {:.1f} s instead of {:.1f} s (saves {:.1f} s)".format(
+            len(blocks), (len(bs) + erase_block_size - 1)//erase_block_size, diff, full, full - diff))
+
+    if args.verify:
+        # Start from the previous content, or from garbage to make sure everything gets erased.
+        flash = W25Q32JV(previous if previous is not None else bytes(W25Q32JV.size))
+        flash.run_svf(svf)
+        if flash.mem[:len(bs)] != bs:
+            print("Verification failed: flash model content differs from bitstream")
+            sys.exit(1)
+        print("Verified SVF against W25Q32JV model")
+
+    with open(args.svf, 'w') as f:
+        f.write(svf)
+
+    if args.benchmark:
+        start = time.perf_counter()
+        for _ in range(args.benchmark):
+            bitstream_to_svf(bs, find_idcode(bs))
+        elapsed = (time.perf_counter() - start)/args.benchmark
+        print("Converted {} bytes in {:.2f} ms ({:.1f} MB/s)".format(len(bs), 1e3*elapsed, len(bs)/elapsed/1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# Resource and timing tracker for gateware builds.
+#
+# Parses the yosys report (<build_name>.rpt) and nextpnr log (<build_name>_nextpnr.log) of a build
+# into a JSON record, appends it to a history file and compares it against the previous record of
+# the same build to flag utilization and timing regressions.
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+from toolchain import BUILD_HISTORY, parse_fmax
+
+# Thresholds ---------------------------------------------------------------------------------------
+
+# Relative increase allowed before a cell count, wall time or memory peak is flagged.
+CELL_THRESHOLD = 0.05
+TIME_THRESHOLD = 0.50
+MEM_THRESHOLD  = 0.25
+# Relative Fmax decrease allowed per clock domain.
+FMAX_THRESHOLD = 0.05
+# Absolute device utilization (per BEL type) above which a build is flagged.
+UTIL_THRESHOLD = 0.90
+
+# Parsers ------------------------------------------------------------------------------------------
+
+_YOSYS_END  = re.compile(r"CPU: user ([\d.]+)s system ([\d.]+)s, MEM: ([\d.]+) MB peak")
+_YOSYS_CELL = re.compile(r"^\s+(\S+)\s+(\d+)\s*$")
+_NEXTPNR_UTIL = re.compile(r"Info:\s+(\w+):\s+(\d+)/\s*(\d+)\s+\d+%")
+
+def parse_yosys_report(filename):
+    with open(filename, "r", errors="replace") as f:
+        lines = f.read().splitlines()
+
+    # Cell counts of the last statistics block (the final, mapped netlist).
+    cells = {}
+    start = max((i for i, l in enumerate(lines) if "Number of cells:" in l), default=None)
+    if start is not None:
+        for line in lines[start + 1:]:
+            m = _YOSYS_CELL.match(line)
+            if m is None:
+                break
+            cells[m.group(1)] = int(m.group(2))
+
+    r = {"cells": cells, "cells_total": sum(cells.values()), "bram": cells.get("DP16KD", 0)}
+    for line in reversed(lines):
+        m = _YOSYS_END.search(line)
+        if m is not None:
+            r["yosys_cpu_s"]       = float(m.group(1)) + float(m.group(2))
+            r["yosys_peak_mem_mb"] = float(m.group(3))
+            break
+    return r
+
+def parse_nextpnr_log(filename):
+    with open(filename, "r", errors="replace") as f:
+        log = f.read()
+
+    # Last "Device utilisation" block (post-placement).
+    utilization = {}
+    for bel, used, total in _NEXTPNR_UTIL.findall(log.split("Device utilisation:")[-1]):
+        utilization[bel] = [int(used), int(total)]
+
+    fmax = {d: {"achieved": a, "constraint": c} for d, (a, c) in parse_fmax(log).items()}
+    return {"utilization": utilization, "fmax": fmax}
+
+def git_commit():
+    try:
+        p = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+        if p.returncode != 0:
+            return None
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], capture_output=True).returncode != 0
+    except OSError:
+        return None
+    return p.stdout.strip() + ("-dirty" if dirty else "")
+
+def collect(gateware_dir, build_name, wall_time=None, peak_mem_mb=None):
+    r = {
+        "build_name"  : build_name,
+        "commit"      : git_commit(),
+        "timestamp"   : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "wall_time_s" : None if wall_time   is None else round(wall_time, 1),
+        "peak_mem_mb" : None if peak_mem_mb is None else round(peak_mem_mb, 1),
+    }
+    rpt = os.path.join(gateware_dir, build_name + ".rpt")
+    if os.path.exists(rpt):
+        r.update(parse_yosys_report(rpt))
+    log = os.path.join(gateware_dir, build_name + "_nextpnr.log")
+    if os.path.exists(log):
+        r.update(parse_nextpnr_log(log))
+    return r
+
+# History ------------------------------------------------------------------------------------------
+
+def load_history(filename, build_name=None):
+    if not os.path.exists(filename):
+        return []
+    with open(filename, "r") as f:
+        history = [json.loads(l) for l in f if l.strip()]
+    return [r for r in history if build_name is None or r["build_name"] == build_name]
+
+def append_history(filename, report):
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, "a") as f:
+        f.write(json.dumps(report, sort_keys=True) + "\n")
+
+def regressions(prev, cur):
+    """Human readable list of regressions of cur against prev (prev may be None)."""
+    issues = []
+
+    for bel, (used, total) in cur.get("utilization", {}).items():
+        if total and used/total > UTIL_THRESHOLD:
+            issues.append(f"{bel} utilization {used}/{total} ({100*used/total:.0f}%) above {100*UTIL_THRESHOLD:.0f}%")
+    for domain, f in cur.get("fmax", {}).items():
+        if f["achieved"] < f["constraint"]:
+            issues.append(f"{domain} Fmax {f['achieved']:.2f} MHz misses {f['constraint']:.2f} MHz constraint")
+
+    if prev is None:
+        return issues
+
+    def increase(key, a, b, threshold, unit=""):
+        if a and b is not None and (b - a)/a > threshold:
+            issues.append(f"{key} {a:g}{unit} -> {b:g}{unit} (+{100*(b - a)/a:.1f}%)")
+
+    for cell, n in cur.get("cells", {}).items():
+        if cell not in prev.get("cells", {}):
+            issues.append(f"{cell} new cell type ({n})")
+        increase(cell, prev.get("cells", {}).get(cell), n, CELL_THRESHOLD)
+    if cur.get("bram", 0) > prev.get("bram", 0):
+        issues.append(f"BRAM {prev.get('bram', 0)} -> {cur['bram']}")
+    increase("wall time",   prev.get("wall_time_s"), cur.get("wall_time_s"), TIME_THRESHOLD, "s")
+    increase("peak memory", prev.get("peak_mem_mb"), cur.get("peak_mem_mb"), MEM_THRESHOLD,  "MB")
+    for domain, f in cur.get("fmax", {}).items():
+        p = prev.get("fmax", {}).get(domain)
+        if p and (p["achieved"] - f["achieved"])/p["achieved"] > FMAX_THRESHOLD:
+            issues.append(f"{domain} Fmax {p['achieved']:.2f} -> {f['achieved']:.2f} MHz")
+    return issues
+
+def record(gateware_dir, build_name, history=BUILD_HISTORY, wall_time=None, peak_mem_mb=None):
+    """Collect the report of a finished build, print regressions and append it to history."""
+    report  = collect(gateware_dir, build_name, wall_time, peak_mem_mb)
+    past    = load_history(history, build_name)
+    prev    = past[-1] if past else None
+    issues  = regressions(prev, report)
+    against = f" against {prev['commit'] or 'previous build'}" if prev else ""
+    for issue in issues:
+        print(f"Build regression{against}: {issue}")
+    append_history(history, report)
+    return report, issues
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Kandinsky gateware build report")
+    parser.add_argument("--gateware-dir", default=os.path.join("build", "gateware"), help="Build output directory")
+    parser.add_argument("--build-name",   default="kandinsky",   help="Build name")
+    parser.add_argument("--history",      default=BUILD_HISTORY, help="History file")
+    parser.add_argument("--no-record",    action="store_true",   help="Only print, do not append to history")
+    parser.add_argument("--strict",       action="store_true",   help="Exit with an error on regressions")
+    args = parser.parse_args()
+
+    if args.no_record:
+        report = collect(args.gateware_dir, args.build_name)
+        past   = load_history(args.history, args.build_name)
+        issues = regressions(past[-1] if past else None, report)
+        for issue in issues:
+            print(f"Build regression: {issue}")
+    else:
+        report, issues = record(args.gateware_dir, args.build_name, args.history)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.strict and issues:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+# Minimal Etherbone client/server talking to the LiteEth Etherbone core directly over UDP.
+#
+# litex_server/RemoteClient wait for the reply of every access, so each CSR access costs a network
+# round trip. The LiteEth core only handles one record per frame (a run of writes at incrementing
+# addresses followed by up to 255 reads at any addresses), so here scattered reads share one record,
+# several frames are kept in flight and the replies are matched back through their return address.
+
+import csv
+import time
+import socket
+import select
+import struct
+import argparse
+import threading
+import collections
+
+# Protocol -----------------------------------------------------------------------------------------
+
+ETHERBONE_PORT = 1234
+ETHERBONE_MAGIC = 0x4e6f
+ETHERBONE_HEADER = struct.pack(">HBB4x", ETHERBONE_MAGIC, 0x10, 0x44) # Version 1, 32-bit addr/data.
+
+MAX_COUNT   = 255  # Writes/reads per record (8-bit counts).
+MAX_PAYLOAD = 1472 # UDP payload of a 1500 bytes MTU.
+MAX_RECORD  = MAX_PAYLOAD - len(ETHERBONE_HEADER)
+
+def encode_record(writes_base=0, writes=(), reads_base=0, reads=()):
+    record = struct.pack(">BBBB", 0, 0x0f, len(writes), len(reads))
+    if writes:
+        record += struct.pack(f">I{len(writes)}I", writes_base, *writes)
+    if reads:
+        record += struct.pack(f">I{len(reads)}I", reads_base, *reads)
+    return record
+
+def record_size(nwrites, nreads):
+    return 4 + (4 + 4*nwrites if nwrites else 0) + (4 + 4*nreads if nreads else 0)
+
+def decode_packet(data):
+    """List of (writes_base, writes, reads_base, reads) records of an Etherbone packet."""
+    magic, = struct.unpack_from(">H", data, 0)
+    if magic != ETHERBONE_MAGIC:
+        raise ValueError("Not an Etherbone packet")
+    records = []
+    offset  = len(ETHERBONE_HEADER)
+    while offset + 4 <= len(data):
+        _, _, wcount, rcount = struct.unpack_from(">BBBB", data, offset)
+        offset += 4
+        writes_base, writes, reads_base, reads = 0, [], 0, []
+        if wcount:
+            writes_base, *writes = struct.unpack_from(f">I{wcount}I", data, offset)
+            offset += 4 + 4*wcount
+        if rcount:
+            reads_base, *reads = struct.unpack_from(f">I{rcount}I", data, offset)
+            offset += 4 + 4*rcount
+        records.append((writes_base, writes, reads_base, reads))
+    return records
+
+# CSR Map ------------------------------------------------------------------------------------------
+
+class CSRMap:
+    """Register/memory addresses and constants from a LiteX csr.csv."""
+    def __init__(self, csr_csv=None):
+        self.regs      = {}
+        self.sizes     = {}
+        self.mems      = {}
+        self.constants = {}
+        if csr_csv is not None:
+            with open(csr_csv, "r") as f:
+                for row in csv.reader(l for l in f if not l.startswith("#")):
+                    if not row:
+                        continue
+                    if row[0] == "csr_register":
+                        self.regs[row[1]]  = int(row[2], 0)
+                        self.sizes[row[1]] = int(row[3])
+                    elif row[0] == "memory_region":
+                        self.mems[row[1]] = (int(row[2], 0), int(row[3], 0))
+                    elif row[0] == "constant":
+                        self.constants[row[1]] = row[2]
+
+# Batch --------------------------------------------------------------------------------------------
+
+class Batch:
+    """Ordered list of single-word bus accesses executed with as few records (frames) as possible.
+
+    A record holds one run of writes at incrementing addresses followed by reads, so scattered writes
+    each take a frame while reads of any addresses are grouped.
+    """
+    def __init__(self, bus):
+        self.bus     = bus
+        self.records = [] # [writes_base, writes, reads]
+        self.nreads  = 0
+
+    def write(self, addr, value):
+        r = self.records[-1] if self.records else None
+        # Extend the last record if the write continues its incrementing write run.
+        if (r is None or r[2] or addr != r[0] + 4*len(r[1]) or len(r[1]) == MAX_COUNT or
+            record_size(len(r[1]) + 1, 0) > MAX_RECORD):
+            r = [addr, [], []]
+            self.records.append(r)
+        r[1].append(value & 0xffffffff)
+
+    def read(self, addr):
+        """Queue a read, returns the index of its value in the execute() result."""
+        r = self.records[-1] if self.records else None
+        if r is None or len(r[2]) == MAX_COUNT or record_size(len(r[1]), len(r[2]) + 1) > MAX_RECORD:
+            r = [0, [], []]
+            self.records.append(r)
+        r[2].append(addr)
+        self.nreads += 1
+        return self.nreads - 1
+
+    def submit(self):
+        records, self.records, self.nreads = self.records, [], 0
+        return self.bus.submit(records)
+
+    def execute(self):
+        return self.bus.wait(self.submit())
+
+# Etherbone ----------------------------------------------------------------------------------------
+
+class Request:
+    def __init__(self, tags):
+        self.tags = tags
+
+class Register:
+    """RemoteClient-like CSR access (multi-word CSRs are most significant word first)."""
+    def __init__(self, bus, addr, length=1):
+        self.bus    = bus
+        self.addr   = addr
+        self.length = length
+
+    def read(self):
+        value = 0
+        for word in self.bus.read(self.addr, self.length):
+            value = (value << 32) | word
+        return value
+
+    def write(self, value):
+        self.bus.write(self.addr, [(value >> 32*(self.length - 1 - i)) & 0xffffffff for i in range(self.length)])
+
+class Registers:
+    def __init__(self, bus):
+        self._bus = bus
+
+    def __getattr__(self, name):
+        csrs = self._bus.csrs
+        if name not in csrs.regs:
+            raise AttributeError(name)
+        return Register(self._bus, csrs.regs[name], csrs.sizes.get(name, 1))
+
+class Etherbone:
+    """Etherbone client sending one record per frame with up to window replies outstanding."""
+    def __init__(self, host="192.168.1.20", port=ETHERBONE_PORT, csr_csv="csr.csv", timeout=1.0, window=8):
+        self.addr    = (host, port)
+        self.csrs    = CSRMap(csr_csv)
+        self.regs    = Registers(self)
+        self.window  = window
+        self.sock    = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(timeout)
+        self._tag      = 0
+        self._expected = set()
+        self._replies  = {}
+
+    def close(self):
+        self.sock.close()
+
+    def batch(self):
+        return Batch(self)
+
+    def _receive(self, block=True):
+        if not block and not select.select([self.sock], [], [], 0)[0]:
+            return False
+        data, _ = self.sock.recvfrom(65536)
+        for writes_base, writes, _, _ in decode_packet(data):
+            if writes_base in self._expected:
+                self._expected.discard(writes_base)
+                self._replies[writes_base] = writes
+        return True
+
+    def submit(self, records):
+        """Send [writes_base, writes, reads] records without waiting for their replies."""
+        # One record per frame (the core ignores the others), every read record gets a unique tag as
+        # return address and is answered by its own frame.
+        tags = []
+        for writes_base, writes, reads in records:
+            tag = 0
+            if reads:
+                tag, self._tag = self._tag, (self._tag + 1) & 0xffffffff
+                while len(self._expected) >= self.window:
+                    self._receive()
+                self._expected.add(tag)
+                tags.append(tag)
+            self.sock.sendto(ETHERBONE_HEADER + encode_record(writes_base, writes, tag, reads), self.addr)
+        return Request(tags)
+
+    def ready(self, request):
+        while self._receive(block=False):
+            pass
+        return all(tag in self._replies for tag in request.tags)
+
+    def wait(self, request):
+        """Read values of a submitted request, in order."""
+        while not all(tag in self._replies for tag in request.tags):
+            self._receive()
+        return [v for tag in request.tags for v in self._replies.pop(tag)]
+
+    def transact(self, records):
+        return self.wait(self.submit(records))
+
+    def read(self, addr, length=1):
+        """Burst read of length words at incrementing addresses."""
+        b = self.batch()
+        for i in range(length):
+            b.read(addr + 4*i)
+        return b.execute()
+
+    def write(self, addr, datas):
+        """Burst write at incrementing addresses."""
+        b = self.batch()
+        for i, data in enumerate(datas if isinstance(datas, list) else [datas]):
+            b.write(addr + 4*i, data)
+        b.execute()
+
+# CSR Poller ---------------------------------------------------------------------------------------
+
+class CSRPoller:
+    """Sample a set of registers at a fixed rate into a NumPy time series.
+
+    Samples are requested on schedule with up to depth requests in flight, so the sampling rate is
+    not bounded by the round trip time. Timestamps are the request times relative to the start.
+    """
+    def __init__(self, bus, names, rate, depth=8):
+        self.bus   = bus
+        self.names = names
+        self.addrs = [bus.csrs.regs[name] for name in names]
+        self.rate  = rate
+        self.depth = depth
+
+    def run(self, samples):
+        import numpy as np
+        t = np.zeros(samples)
+        v = np.zeros((samples, len(self.addrs)), dtype=np.uint32)
+
+        period   = 1/self.rate
+        inflight = collections.deque()
+        start    = time.perf_counter()
+        k = done = 0
+        while done < samples:
+            now = time.perf_counter()
+            if k < samples and len(inflight) < self.depth and now >= start + k*period:
+                b = self.bus.batch()
+                for addr in self.addrs:
+                    b.read(addr)
+                inflight.append((k, now, b.submit()))
+                k += 1
+            elif inflight and (k == samples or len(inflight) == self.depth or self.bus.ready(inflight[0][2])):
+                n, t_sent, request = inflight.popleft()
+                t[n] = t_sent - start
+                v[n] = self.bus.wait(request)
+                done += 1
+            else:
+                time.sleep(max(0, min(start + k*period - now, period)))
+        return t, v
+
+# Etherbone Server ---------------------------------------------------------------------------------
+
+class EtherboneServer:
+    """Local Etherbone endpoint standing in for the board, bus accesses go to read/write callbacks.
+
+    With latency, replies are delayed by that many seconds (without stalling the requests that follow)
+    to model the network and board turnaround.
+    """
+    def __init__(self, bus_read, bus_write, host="127.0.0.1", port=ETHERBONE_PORT, latency=0):
+        self.bus_read  = bus_read
+        self.bus_write = bus_write
+        self.latency   = latency
+        self.ignored   = 0 # Records after the first one of a frame.
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.addr = self.sock.getsockname()
+        self.replies = collections.deque()
+        self.pending = threading.Condition()
+        self.threads = [threading.Thread(target=self.serve, daemon=True)]
+        if latency:
+            self.threads.append(threading.Thread(target=self.send_delayed, daemon=True))
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, data, client):
+        if not self.latency:
+            self.sock.sendto(data, client)
+            return
+        with self.pending:
+            self.replies.append((time.perf_counter() + self.latency, data, client))
+            self.pending.notify()
+
+    def send_delayed(self):
+        while True:
+            with self.pending:
+                while not self.replies:
+                    self.pending.wait()
+                due, data, client = self.replies.popleft()
+            time.sleep(max(0, due - time.perf_counter()))
+            try:
+                self.sock.sendto(data, client)
+            except OSError:
+                return
+
+    def serve(self):
+        while True:
+            try:
+                data, client = self.sock.recvfrom(65536)
+            except OSError:
+                return
+            # Like the LiteEth core: only the first record of a frame is executed, its writes before
+            # its reads, which are answered with one frame.
+            records = decode_packet(data)
+            if not records:
+                continue
+            self.ignored += len(records) - 1
+            writes_base, writes, reads_base, reads = records[0]
+            for i, value in enumerate(writes):
+                self.bus_write(writes_base + 4*i, value)
+            if reads:
+                self.send(ETHERBONE_HEADER + encode_record(reads_base, [self.bus_read(a) for a in reads]), client)
+
+# Benchmark ----------------------------------------------------------------------------------------
+
+def benchmark(nregs=16, accesses=2048, latency=200e-6, rate=2000, samples=2000):
+    mem    = {}
+    server = EtherboneServer(lambda a: mem.get(a, a), mem.__setitem__, port=0, latency=latency).start()
+    bus    = Etherbone(*server.addr, csr_csv=None)
+    bus.csrs.regs = {f"reg{i}": 4*i for i in range(nregs)}
+    addrs  = list(bus.csrs.regs.values())
+
+    def run(name, f):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        print(f"{name:>32s}: {accesses/elapsed:10.0f} accesses/s")
+
+    def single():
+        for i in range(accesses):
+            bus.read(addrs[i % nregs])
+    def batched():
+        for i in range(0, accesses, nregs):
+            b = bus.batch()
+            for addr in addrs:
+                b.read(addr)
+            b.execute()
+    def pipelined():
+        requests = []
+        for i in range(0, accesses, nregs):
+            b = bus.batch()
+            for addr in addrs:
+                b.read(addr)
+            requests.append(b.submit())
+        for request in requests:
+            bus.wait(request)
+
+    def scattered():
+        for i in range(0, accesses, nregs):
+            b = bus.batch()
+            for j, addr in enumerate(addrs[::-1]): # Decreasing addresses: one record each.
+                b.write(addr, i + j)
+            b.execute()
+        assert bus.read(addrs[0], nregs) == [accesses - nregs + j for j in range(nregs)][::-1]
+        mem.clear()
+
+    print(f"{nregs} registers, {1e6*latency:.0f} us reply latency")
+    run("one access per round trip",  single)
+    run(f"batches of {nregs} reads",  batched)
+    run(f"pipelined batches ({bus.window})", pipelined)
+    run("scattered writes", scattered)
+
+    t, v = CSRPoller(bus, list(bus.csrs.regs), rate).run(samples)
+    jitter = (t[1:] - t[:-1]).std()
+    print(f"Poller: {samples} samples of {nregs} registers at {samples/t[-1]:.0f}/{rate} Hz, "
+          f"period jitter {1e6*jitter:.0f} us, values ok: {bool((v == addrs).all())}")
+    print(f"Records ignored by the stand-in (more than one per frame): {server.ignored}")
+
+    bus.close()
+    server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Etherbone access benchmark against a local stand-in")
+    parser.add_argument("--regs",     default=16,    type=int,   help="Registers per batch/sample")
+    parser.add_argument("--accesses", default=2048,  type=int,   help="Register reads per test")
+    parser.add_argument("--latency",  default=200e-6, type=float, help="Stand-in reply latency (s)")
+    parser.add_argument("--rate",     default=2000,  type=float, help="Poller rate (Hz)")
+    parser.add_argument("--samples",  default=2000,  type=int,   help="Poller samples")
+    args = parser.parse_args()
+    benchmark(args.regs, args.accesses, args.latency, args.rate, args.samples)
+
+if __name__ == "__main__":
+    main()
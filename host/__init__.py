@@ -0,0 +1,21 @@
+# Host side tools for the Kandinsky microphone stream (no migen/LiteX dependency).
+#
+# Tools start without importing numpy: modules bind it with np = lazy_import("numpy") and the import
+# runs on first use (after argument parsing for the command line tools). Keep module level code free
+# of numpy calls; `python -m host --startup --strict` checks it.
+
+import sys
+import importlib.util
+
+def lazy_import(name):
+    """Module name, executed on first attribute access."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module      = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,84 @@
+# Host tool launcher and startup check.
+#
+# `python -m host <tool> [args]` runs a tool like `python -m host.<tool> [args]`, importing only that
+# tool. `python -m host --startup` starts every tool in fresh interpreters (`import host.<tool>` and
+# `<tool> --help`) and reports the best wall time of a few runs next to a bare interpreter, and which
+# heavy modules got executed on import. `--strict` fails on any of them or past `--budget` ms.
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import subprocess
+
+TOOLS   = ("monitor", "stream", "export", "mvdr", "calibrate", "recorder", "container", "multiboard", "hub",
+           "pinmap", "linktest", "stft", "metrics")
+HEAVY   = ("numpy", "asyncio", "concurrent.futures", "migen", "litex", "liteeth")
+ROOT    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded modules still waiting behind importlib.util.LazyLoader are not counted.
+PROBE = """
+import sys, json, importlib
+importlib.import_module(sys.argv[1])
+print(json.dumps([name for name in {heavy!r} if name in sys.modules and
+    type(sys.modules[name]).__name__ != "_LazyModule"]))
+"""
+
+# Startup ------------------------------------------------------------------------------------------
+
+def run(args):
+    """Wall time (s) and stdout of a fresh interpreter running `args`."""
+    start  = time.perf_counter()
+    result = subprocess.run([sys.executable, *args], cwd=ROOT, capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, result.stdout
+
+def best(args, repeat):
+    return min(run(args)[0] for _ in range(repeat))
+
+def startup(tools=TOOLS, repeat=5, budget=100.0):
+    """Print startup times per tool, returns the list of problems found."""
+    bare     = best(["-c", "pass"], repeat)
+    problems = []
+    print(f"bare interpreter {bare*1e3:6.1f} ms (budget {budget:.0f} ms per tool)")
+    print(f"{'tool':<12}{'import':>9}{'--help':>9}  heavy modules executed")
+    for tool in tools:
+        module  = f"host.{tool}"
+        heavy   = json.loads(run(["-c", PROBE.format(heavy=HEAVY), module])[1])
+        imports = best(["-c", f"import {module}"], repeat)
+        usage   = best(["-m", module, "--help"], repeat)
+        print(f"{tool:<12}{imports*1e3:6.1f} ms{usage*1e3:6.1f} ms  {', '.join(heavy) or '-'}")
+        if heavy:
+            problems.append(f"{tool}: {', '.join(heavy)} executed on import")
+        if max(imports, usage)*1e3 > budget:
+            problems.append(f"{tool}: {max(imports, usage)*1e3:.1f} ms over the {budget:.0f} ms budget")
+    return problems
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in TOOLS:
+        tool = sys.argv.pop(1)
+        sys.argv[0] = f"python -m host {tool}"
+        importlib.import_module(f"host.{tool}").main()
+        return
+    parser = argparse.ArgumentParser(description="Kandinsky host tools",
+        usage="python -m host {tool} [args] | --startup [--strict]", epilog=f"tools: {', '.join(TOOLS)}")
+    parser.add_argument("--startup", action="store_true",  help="Time the startup of every tool in fresh interpreters")
+    parser.add_argument("--tools",   default=",".join(TOOLS), help="Comma separated tools to check")
+    parser.add_argument("--repeat",  default=5, type=int,     help="Runs per measurement, the best is kept")
+    parser.add_argument("--budget",  default=100.0, type=float, help="Startup budget per tool (ms)")
+    parser.add_argument("--strict",  action="store_true",     help="Exit with an error on heavy imports or over budget")
+    args = parser.parse_args()
+    if not args.startup:
+        parser.print_help()
+        return
+    problems = startup(args.tools.split(","), args.repeat, args.budget)
+    for problem in problems:
+        print(problem)
+    if args.strict and problems:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# Microphone array geometry and steered response power maps.
+#
+# The board has 8 arms (hw.py: pdm_data pins a/b/c of arm j1..j8) with 3 data pins per arm and two
+# microphones per pin, i.e. 6 microphones per arm. Default positions assume equally spaced arms in
+# the XY plane with microphones evenly spaced along each arm; measured positions can be loaded from a
+# JSON file ([[x, y, z], ...] in meters, one entry per channel).
+
+import json
+
+from host import lazy_import
+from host.stream import CHANNELS, SLOTS
+
+np = lazy_import("numpy")
+
+SPEED_OF_SOUND = 343.0
+
+ARMS          = 8
+PINS_PER_ARM  = 3
+MICS_PER_ARM  = PINS_PER_ARM*SLOTS
+ARM_START     = 0.03   # Radius of the innermost microphone (m).
+ARM_PITCH     = 0.02   # Distance between microphones along an arm (m).
+
+# Geometry -----------------------------------------------------------------------------------------
+
+def default_positions():
+    """(CHANNELS, 3) microphone positions, channel = SLOTS*pin + slot, pin = PINS_PER_ARM*arm + k."""
+    ch    = np.arange(CHANNELS)
+    arm   = ch//MICS_PER_ARM
+    r     = ARM_START + ARM_PITCH*(ch % MICS_PER_ARM)
+    theta = 2*np.pi*arm/ARMS
+    return np.stack([r*np.cos(theta), r*np.sin(theta), np.zeros(CHANNELS)], axis=1)
+
+def load_positions(filename=None):
+    if filename is None:
+        return default_positions()
+    with open(filename) as f:
+        positions = np.array(json.load(f), dtype=np.float64)
+    assert positions.shape == (CHANNELS, 3), f"{filename}: expected {CHANNELS} [x, y, z] positions"
+    return positions
+
+def directions(azimuths, elevations):
+    """(len(elevations), len(azimuths), 3) unit vectors towards the sources (degrees in)."""
+    az, el = np.meshgrid(np.radians(azimuths), np.radians(elevations))
+    return np.stack([np.cos(el)*np.cos(az), np.cos(el)*np.sin(az), np.sin(el)], axis=-1)
+
+def delays(positions, direction):
+    """Arrival delays (s) of a plane wave from direction(s) at each microphone, relative to origin."""
+    return -(np.asarray(direction) @ positions.T)/SPEED_OF_SOUND
+
+# Direction map ------------------------------------------------------------------------------------
+
+class SRPMap:
+    """Steered response power (PHAT weighted) over an azimuth/elevation grid.
+
+    Frames are (channels, nfft) PCM blocks; the map is computed from the FFT bins within `band` only,
+    with the steering vectors precomputed for the whole grid. `calibration` is an optional (delays,
+    gains) pair from host.calibrate; gains do not matter with PHAT weighting.
+    """
+    def __init__(self, positions, rate, nfft=512, band=(300, 6000),
+                 azimuths=range(0, 360, 4), elevations=range(0, 91, 10), calibration=None):
+        self.nfft  = nfft
+        self.shape = (len(elevations), len(azimuths))
+        freqs      = np.fft.rfftfreq(nfft, 1/rate)
+        self.bins  = np.flatnonzero((freqs >= band[0]) & (freqs <= band[1]))
+        tau        = delays(positions, directions(azimuths, elevations).reshape(-1, 3))
+        if calibration is not None:
+            tau = tau + calibration[0]
+        # Compensating the arrival delays aligns the channels for each direction: (bins, dirs, chans).
+        self.steer  = np.exp(2j*np.pi*freqs[self.bins, None, None]*tau[None]).astype(np.complex64)
+        self.window = np.hanning(nfft).astype(np.float32)
+
+    def __call__(self, frame):
+        return self.from_spectrum(np.fft.rfft(frame*self.window, axis=1))
+
+    def from_spectrum(self, spectrum):
+        """Map from a (channels, nfft//2 + 1) windowed spectrum, e.g. a host.stft.STFT frame."""
+        spectrum = spectrum[:, self.bins].T                                     # (bins, chans).
+        spectrum = spectrum/np.maximum(np.abs(spectrum), 1e-12)                 # PHAT.
+        beams    = self.steer @ spectrum[:, :, None].astype(np.complex64)       # (bins, dirs, 1).
+        return (np.abs(beams[:, :, 0])**2).sum(axis=0).reshape(self.shape)
+
+# Beamformer ---------------------------------------------------------------------------------------
+
+def fractional_delay(delay, taps, half=16):
+    """Windowed-sinc FIR delaying by taps//2 + `delay` samples, |delay| <= taps//2 - half."""
+    n = np.arange(taps) - taps//2 - delay
+    w = np.where(np.abs(n) <= half, 0.42 + 0.5*np.cos(np.pi*n/half) + 0.08*np.cos(2*np.pi*n/half), 0)
+    return np.sinc(n)*w
+
+class DelayAndSum:
+    """Streaming time domain delay-and-sum beams over (channels, samples) PCM blocks.
+
+    Each channel is delayed by a fractional delay FIR so that a plane wave from each beam direction
+    adds up in phase; the output is (beams, samples). `calibration` is an optional (delays, gains)
+    pair from host.calibrate.
+    """
+    def __init__(self, positions, rate, beams, half=16, calibration=None):
+        tau    = delays(positions, directions_list(beams))                  # (beams, chans).
+        if calibration is not None:
+            tau = tau + calibration[0]
+        shift  = -tau*rate                                                  # Delay later arrivals less.
+        taps   = 2*(half + int(np.ceil(np.abs(shift).max()))) + 1
+        self.h = np.stack([[fractional_delay(d, taps, half) for d in row] for row in shift]).astype(np.float32)
+        self.h /= len(positions)
+        if calibration is not None:
+            self.h *= np.asarray(calibration[1], dtype=np.float32)[None, :, None]
+        self.history = np.zeros((len(positions), taps - 1), dtype=np.float32)
+
+    def process(self, x):
+        x = np.concatenate([self.history, x], axis=1)
+        windows = np.lib.stride_tricks.sliding_window_view(x, self.h.shape[2], axis=1)  # (chans, n, taps).
+        self.history = x[:, x.shape[1] - self.history.shape[1]:]
+        return np.einsum("cnt,bct->bn", windows, self.h[:, :, ::-1], optimize=True)
+
+def directions_list(beams):
+    """(len(beams), 3) unit vectors of [(azimuth, elevation), ...] (degrees)."""
+    return np.stack([directions([az], [el])[0, 0] for az, el in beams])
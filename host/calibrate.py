@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+# Array calibration from all-pairs GCC-PHAT time differences of arrival.
+#
+# Each batch of frames goes through one rFFT of all channels. The cross-power spectra of the 1128
+# microphone pairs are PHAT weighted and go through one batched inverse rFFT; the interpolated peak
+# of each generalized cross-correlation is the pair TDOA. Per-pair estimates are reduced over frames
+# with a confidence-weighted median and per-channel delays are solved by iteratively reweighted
+# (Huber) least squares over the pair graph. Gains come from the median in-band level per channel.
+#
+# The recording must contain a broadband far-field source from a known direction (default: overhead,
+# where the planar array has no geometric delays). Results are cached in build/calibration, keyed to
+# the board MAC address and the gateware build.
+
+import os
+import json
+import time
+import hashlib
+import argparse
+
+from host import lazy_import
+from host.array import load_positions, delays, directions_list
+from host.dsp import PDMDecimator, PCM_RATE
+from host.stream import CHANNELS, GROUPS_PER_PACKET, PDM_CLK_FREQ, decode_packed, read_capture
+
+np = lazy_import("numpy")
+
+CALIBRATION_DIR = os.path.join("build", "calibration")
+BITSTREAM       = os.path.join("build", "gateware", "kandinsky.bit")
+DEFAULT_MAC     = "0x726b895bc2e2" # main.py default.
+
+NFFT     = 1024
+HOP      = 512
+BAND     = (200, 6000)  # Hz.
+MAX_LAG  = 32           # Samples searched around zero lag.
+MIN_PEAK = 0.2          # Normalized GCC-PHAT peak below which a pair estimate is discarded.
+BATCH    = 8            # Frames per batched FFT.
+
+# GCC-PHAT -----------------------------------------------------------------------------------------
+
+class GCCPHAT:
+    """Batched GCC-PHAT over all channel pairs: (batch, channels, nfft) frames in, per pair lags out."""
+    def __init__(self, rate, channels=CHANNELS, nfft=NFFT, band=BAND, max_lag=MAX_LAG):
+        self.i, self.j = np.triu_indices(channels, 1)
+        self.nfft   = nfft
+        freqs       = np.fft.rfftfreq(nfft, 1/rate)
+        self.band   = ((freqs >= band[0]) & (freqs <= band[1])).astype(np.float32)
+        self.window = np.hanning(nfft).astype(np.float32)
+        self.lags   = np.arange(-max_lag - 1, max_lag + 2) % nfft # One extra lag each side to interpolate.
+        self.scale  = nfft/(2*self.band.sum())                     # Peak of a perfectly coherent pair = 1.
+
+    def __call__(self, frames):
+        """Returns (lags, peaks, levels): (batch, pairs) lags of channel i relative to j in samples,
+        normalized peak heights, and (batch, channels) in-band log power."""
+        X      = np.fft.rfft(frames*self.window, axis=-1)
+        power  = np.abs(X)**2
+        levels = np.log(np.maximum((power*self.band).sum(axis=-1), 1e-30))
+        G      = X[:, self.i]*np.conj(X[:, self.j])
+        G     *= self.band/np.maximum(np.abs(G), 1e-30)
+        r      = np.fft.irfft(G, self.nfft, axis=-1)[..., self.lags]
+        k      = np.clip(r[..., 1:-1].argmax(axis=-1) + 1, 1, r.shape[-1] - 2)
+        y0, y1, y2 = (np.take_along_axis(r, (k + d)[..., None], axis=-1)[..., 0] for d in (-1, 0, 1))
+        denom  = y0 - 2*y1 + y2
+        delta  = np.where(denom < 0, 0.5*(y0 - y2)/np.where(denom < 0, denom, -1), 0)
+        return k - (len(self.lags)//2) + delta, y1*self.scale, levels
+
+def weighted_median(values, weights):
+    """Weighted median along the last axis (weights 0 excluded); NaN where all weights are 0."""
+    order   = np.argsort(values, axis=-1)
+    values  = np.take_along_axis(values, order, axis=-1)
+    cumw    = np.cumsum(np.take_along_axis(weights, order, axis=-1), axis=-1)
+    total   = cumw[..., -1:]
+    idx     = np.minimum((cumw < total/2).sum(axis=-1, keepdims=True), values.shape[-1] - 1)
+    median  = np.take_along_axis(values, idx, axis=-1)[..., 0]
+    return np.where(total[..., 0] > 0, median, np.nan)
+
+def solve_delays(i, j, tdoa, weights, iterations=5, huber=1.5):
+    """Per-channel delays d (mean 0) with d[i] - d[j] ~ tdoa, robust to outlier pairs."""
+    channels = max(i.max(), j.max()) + 1
+    valid    = np.isfinite(tdoa) & (weights > 0)
+    A        = np.zeros((valid.sum() + 1, channels))
+    rows     = np.arange(valid.sum())
+    A[rows, i[valid]] =  1
+    A[rows, j[valid]] = -1
+    A[-1]    = 1 # Zero mean constraint.
+    b        = np.append(tdoa[valid], 0)
+    w        = np.append(weights[valid], weights[valid].sum())
+    robust   = np.ones(len(b))
+    for _ in range(iterations):
+        sw = np.sqrt(w*robust)
+        d  = np.linalg.lstsq(A*sw[:, None], b*sw, rcond=None)[0]
+        residual = (A @ d - b)[:-1]
+        scale    = max(1.4826*np.median(np.abs(residual)), 1e-3)
+        robust[:-1] = np.minimum(1, huber*scale/np.maximum(np.abs(residual), 1e-12))
+    return d, residual
+
+# Calibration --------------------------------------------------------------------------------------
+
+class Calibrator:
+    """Accumulates GCC-PHAT estimates over PCM blocks and solves per-channel corrections."""
+    def __init__(self, positions, rate=PCM_RATE, source=(0, 90)):
+        self.gcc    = GCCPHAT(rate)
+        self.rate   = rate
+        self.source = source
+        tau         = delays(positions, directions_list([source]))[0]
+        self.geometric = (tau[self.gcc.i] - tau[self.gcc.j])*rate
+        self.pending = np.zeros((CHANNELS, 0), dtype=np.float32)
+        self.lags, self.peaks, self.levels = [], [], []
+
+    def process(self, pcm, final=False):
+        self.pending = np.concatenate([self.pending, pcm], axis=1)
+        frames = (self.pending.shape[1] - NFFT)//HOP + 1
+        if not final:
+            frames -= frames % BATCH
+        if frames <= 0:
+            return
+        idx = np.arange(frames)[:, None]*HOP + np.arange(NFFT)
+        batch = self.pending[:, idx].transpose(1, 0, 2)        # (frames, channels, nfft).
+        for start in range(0, frames, BATCH):
+            lags, peaks, levels = self.gcc(batch[start:start + BATCH])
+            self.lags.append(lags.astype(np.float32))
+            self.peaks.append(peaks.astype(np.float32))
+            self.levels.append(levels.astype(np.float32))
+        self.pending = self.pending[:, frames*HOP:]
+
+    @property
+    def frames(self):
+        return sum(len(l) for l in self.lags)
+
+    def solve(self):
+        self.process(np.zeros((CHANNELS, 0), dtype=np.float32), final=True)
+        if not self.frames:
+            raise ValueError(f"Calibration needs at least {NFFT/self.rate:.3f} s of recording")
+        lags    = np.concatenate(self.lags).T                  # (pairs, frames).
+        peaks   = np.concatenate(self.peaks).T
+        weights = np.where(peaks >= MIN_PEAK, peaks, 0)
+        tdoa    = weighted_median(lags, weights) - self.geometric
+        d, residual = solve_delays(self.gcc.i, self.gcc.j, tdoa, weights.sum(axis=1))
+        level   = np.median(np.concatenate(self.levels), axis=0)/2 # Log amplitude.
+        return {
+            "source"        : list(self.source),
+            "rate"          : self.rate,
+            "frames"        : self.frames,
+            "pairs_used"    : int(np.isfinite(tdoa).sum()),
+            "residual_rms"  : float(np.sqrt(np.mean(residual**2))),  # Samples.
+            "delays"        : (d/self.rate).tolist(),                # Extra arrival delay per channel (s).
+            "gains"         : np.exp(-(level - level.mean())).tolist(), # Correction per channel.
+        }
+
+def calibrate(chunks, positions, source=(0, 90), seconds=None):
+    decimator  = PDMDecimator()
+    calibrator = Calibrator(positions, source=source)
+    groups     = 0
+    for chunk in chunks:
+        ids, packed = decode_packed(chunk)
+        calibrator.process(decimator.process_packed(packed))
+        groups += len(ids)
+        if seconds is not None and groups >= seconds*PDM_CLK_FREQ:
+            break
+    return calibrator.solve()
+
+# Cache --------------------------------------------------------------------------------------------
+
+def build_id(bitstream=BITSTREAM):
+    """Short hash of the gateware bitstream, None if it was not built here."""
+    if not os.path.exists(bitstream):
+        return None
+    with open(bitstream, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+def calibration_path(mac, build, directory=CALIBRATION_DIR):
+    mac = f"{int(str(mac), 0):012x}"
+    return os.path.join(directory, f"{mac}-{build or 'unknown'}.json")
+
+def load_calibration(filename):
+    """(delays, gains) arrays of a calibration file."""
+    with open(filename) as f:
+        c = json.load(f)
+    return np.array(c["delays"]), np.array(c["gains"])
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Kandinsky array calibration (all-pairs GCC-PHAT)")
+    parser.add_argument("capture",     nargs="?",                  help="Raw or compressed (.kpdm) capture file")
+    parser.add_argument("--source",    default="0,90",             help="Calibration source AZ,EL in degrees")
+    parser.add_argument("--positions", default=None,               help="Microphone positions JSON file")
+    parser.add_argument("--seconds",   default=None, type=float,   help="Only use the first SECONDS of the capture")
+    parser.add_argument("--mac",       default=DEFAULT_MAC,        help="Board MAC address (cache key)")
+    parser.add_argument("--bitstream", default=BITSTREAM,          help="Gateware bitstream (cache key)")
+    parser.add_argument("--build-id",  default=None,               help="Build identifier (default: bitstream hash)")
+    parser.add_argument("--force",     action="store_true",        help="Recalibrate even if cached")
+    parser.add_argument("--synthetic", action="store_true",        help="Calibrate a synthetic array with known mismatches and report the errors")
+    args = parser.parse_args()
+
+    source    = tuple(float(v) for v in args.source.split(","))
+    positions = load_positions(args.positions)
+
+    if args.synthetic:
+        from host.synth import SyntheticStream
+        rng  = np.random.default_rng(1)
+        true_delays = rng.uniform(-50e-6, 50e-6, CHANNELS)
+        true_delays -= true_delays.mean()
+        true_gains  = 10**(rng.uniform(-1, 1, CHANNELS)/20)
+        stream = SyntheticStream(sources=(source + (None, 0.5),), seconds=0.25, positions=positions,
+            mismatch=(true_delays, true_gains))
+        packets = int(10*PDM_CLK_FREQ/GROUPS_PER_PACKET)
+        start  = time.time()
+        result = calibrate((stream.read(1024) for i in range(0, packets, 1024)), positions, source)
+        gains  = np.array(result["gains"])
+        gains *= np.exp(np.mean(np.log(true_gains))) # Gains are relative to the array mean.
+        print(f"Calibrated 10 s in {time.time() - start:.1f} s ({result['frames']} frames, {result['pairs_used']} pairs)")
+        print(f"Delay error: {1e6*np.abs(np.array(result['delays']) - true_delays).max():.2f} us max "
+              f"(1 sample = {1e6/PCM_RATE:.1f} us)")
+        print(f"Gain error:  {np.abs(20*np.log10(gains*true_gains)).max():.3f} dB max")
+        return
+
+    if args.capture is None:
+        parser.error("A capture file or --synthetic is required")
+    build = args.build_id or build_id(args.bitstream)
+    path  = calibration_path(args.mac, build)
+    if os.path.exists(path) and not args.force:
+        print(f"Using cached calibration {path} (--force to recalibrate)")
+        return
+
+    start  = time.time()
+    result = calibrate(read_capture(args.capture), positions, source, args.seconds)
+    result.update(mac=args.mac, build=build, capture=os.path.abspath(args.capture),
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(result, f, indent=1)
+    print(f"Calibrated {result['frames']} frames in {time.time() - start:.1f} s, {result['pairs_used']} pairs, "
+          f"residual {result['residual_rms']:.3f} samples: {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+# Compressed capture container (.kpdm) with random access.
+#
+# The stream is split in chunks of whole packets compressed independently (zlib, bz2 or lzma from the
+# standard library) on a process pool. Before compression each chunk is rearranged losslessly:
+# packet_ids become deltas (almost all 1) and the 32 pin bits of both slot words are transposed into
+# one bit stream per pin and slot (8 consecutive PDM bits per byte, as host.stream.decode_packed
+# does for the 24 used pins). PDM bit streams compress far better on their own than interleaved, and
+# the 8 unused pins are zero runs.
+#
+# File: header, chunks, chunk index (file offset, size, packets, first packet), footer locating the
+# index. Any packet range is read by decompressing only the chunks that overlap it.
+
+import os
+import bz2
+import lzma
+import zlib
+import time
+import struct
+import argparse
+
+from host import lazy_import
+from host.stream import GROUP_WORDS, GROUPS_PER_PACKET, PACKET_BYTES, PDM_CLK_FREQ, WORD, _transpose8, is_container, \
+    read_capture
+
+np      = lazy_import("numpy")
+futures = lazy_import("concurrent.futures")
+
+MAGIC         = b"KPDM"  # Also checked by host.stream.is_container.
+INDEX_MAGIC   = b"KIDX"
+VERSION       = 1
+CHUNK_PACKETS = 4096  # ~4.7 MB, ~126 ms of stream.
+
+HEADER = struct.Struct("<4sHHII")   # magic, version, codec, level, chunk packets.
+ENTRY  = struct.Struct("<QIIQ")     # file offset, compressed size, packets, first packet.
+FOOTER = struct.Struct("<QI4s")     # index offset, chunks, magic.
+
+CODECS = {
+    # name: (id, compress(data, level), decompress(data), default level)
+    "zlib" : (0, lambda d, l: zlib.compress(d, l), zlib.decompress, 1),
+    "bz2"  : (1, lambda d, l: bz2.compress(d, l),  bz2.decompress,  9),
+    "lzma" : (2, lambda d, l: lzma.compress(d, preset=l), lzma.decompress, 0),
+}
+CODEC_NAMES = {v[0]: k for k, v in CODECS.items()}
+
+# Transform ----------------------------------------------------------------------------------------
+
+def pack_chunk(payload):
+    """Packet payloads -> id deltas followed by per pin/slot bit streams (32 pins x 2 slots)."""
+    words  = np.frombuffer(payload, dtype=WORD).reshape(-1, GROUP_WORDS)
+    n      = len(words)
+    deltas = np.diff(words[:, 0], prepend=np.uint32(0))
+    planes = np.ascontiguousarray(words.view(np.uint8).reshape(n, GROUP_WORDS, 4)[:, 1:].transpose(2, 1, 0))
+    bits   = _transpose8(planes.view(np.uint64)).view(np.uint8).reshape(4, 2, n//8, 8)
+    return deltas.tobytes() + np.ascontiguousarray(bits.transpose(0, 3, 1, 2)).tobytes()
+
+def unpack_chunk(data):
+    """Inverse of pack_chunk."""
+    n      = len(data)//(4 + 8)
+    words  = np.empty((n, GROUP_WORDS), dtype=WORD)
+    words[:, 0] = np.cumsum(np.frombuffer(data, dtype=WORD, count=n), dtype=WORD)
+    bits   = np.frombuffer(data, dtype=np.uint8, offset=4*n).reshape(4, 8, 2, n//8)
+    planes = _transpose8(np.ascontiguousarray(bits.transpose(0, 2, 3, 1)).view(np.uint64))
+    words.view(np.uint8).reshape(n, GROUP_WORDS, 4)[:, 1:] = planes.view(np.uint8).reshape(4, 2, n).transpose(2, 1, 0)
+    return words.tobytes()
+
+def compress_chunk(payload, codec="zlib", level=None):
+    _, compress, _, default = CODECS[codec]
+    return compress(pack_chunk(payload), default if level is None else level)
+
+def decompress_chunk(data, codec="zlib"):
+    return unpack_chunk(CODECS[codec][2](data))
+
+# Writer -------------------------------------------------------------------------------------------
+
+class ContainerWriter:
+    """Streaming writer: write() any amount of packet payloads, chunks are compressed in parallel."""
+    def __init__(self, filename, codec="zlib", level=None, chunk_packets=CHUNK_PACKETS, jobs=None):
+        self.codec   = codec
+        self.level   = CODECS[codec][3] if level is None else level
+        self.chunk   = chunk_packets*PACKET_BYTES
+        self.f       = open(filename, "wb")
+        self.f.write(HEADER.pack(MAGIC, VERSION, CODECS[codec][0], self.level, chunk_packets))
+        self.jobs    = jobs or os.cpu_count() or 1
+        self.pool    = futures.ProcessPoolExecutor(self.jobs) if self.jobs > 1 else None
+        self.pending = bytearray()
+        self.queue   = []  # (packets, future or compressed bytes) in stream order.
+        self.index   = []
+        self.packets = 0
+        self.raw     = 0
+
+    def write(self, payload):
+        self.pending += payload
+        while len(self.pending) >= self.chunk:
+            self._submit(bytes(self.pending[:self.chunk]))
+            del self.pending[:self.chunk]
+
+    def _submit(self, payload):
+        packets = len(payload)//PACKET_BYTES
+        if self.pool is None:
+            self.queue.append((packets, compress_chunk(payload, self.codec, self.level)))
+        else:
+            self.queue.append((packets, self.pool.submit(compress_chunk, payload, self.codec, self.level)))
+        self.raw += len(payload)
+        while len(self.queue) > 2*self.jobs: # Bounded memory: write out the oldest chunks.
+            self._write_next()
+
+    def _write_next(self):
+        packets, data = self.queue.pop(0)
+        data = data if isinstance(data, bytes) else data.result()
+        self.index.append((self.f.tell(), len(data), packets, self.packets))
+        self.f.write(data)
+        self.packets += packets
+
+    def close(self):
+        tail = len(self.pending) - len(self.pending) % PACKET_BYTES
+        if tail:
+            self._submit(bytes(self.pending[:tail]))
+        while self.queue:
+            self._write_next()
+        offset = self.f.tell()
+        for entry in self.index:
+            self.f.write(ENTRY.pack(*entry))
+        self.f.write(FOOTER.pack(offset, len(self.index), INDEX_MAGIC))
+        self.size = self.f.tell()
+        self.f.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+# Reader -------------------------------------------------------------------------------------------
+
+class ContainerReader:
+    def __init__(self, filename, jobs=1):
+        self.f = open(filename, "rb")
+        magic, version, codec, self.level, self.chunk_packets = HEADER.unpack(self.f.read(HEADER.size))
+        assert magic == MAGIC and version == VERSION, f"{filename}: not a version {VERSION} capture container"
+        self.codec = CODEC_NAMES[codec]
+        self.f.seek(-FOOTER.size, os.SEEK_END)
+        offset, chunks, magic = FOOTER.unpack(self.f.read(FOOTER.size))
+        assert magic == INDEX_MAGIC, f"{filename}: missing chunk index (incomplete file?)"
+        self.f.seek(offset)
+        self.index   = [ENTRY.unpack(self.f.read(ENTRY.size)) for i in range(chunks)]
+        self.starts  = np.cumsum([0] + [e[2] for e in self.index], dtype=np.int64) # Chunk first packets.
+        self.packets = int(self.starts[-1])
+        self.jobs    = jobs
+
+    def close(self):
+        self.f.close()
+
+    def _read(self, entry):
+        self.f.seek(entry[0])
+        return self.f.read(entry[1])
+
+    def chunks(self, start=0, stop=None):
+        """Yield the payloads of packets [start, stop), one (trimmed) chunk at a time."""
+        stop   = self.packets if stop is None else min(stop, self.packets)
+        if start >= stop:
+            return
+        first  = int(np.searchsorted(self.starts, start, side="right")) - 1
+        last   = int(np.searchsorted(self.starts, stop, side="left"))
+        chosen = self.index[first:last]
+        if self.jobs > 1:
+            with futures.ProcessPoolExecutor(self.jobs) as pool:
+                # Keep at most 2*jobs chunks in flight.
+                pending = [pool.submit(decompress_chunk, self._read(e), self.codec) for e in chosen[:2*self.jobs]]
+                for i, entry in enumerate(chosen):
+                    payload = pending[i].result()
+                    pending[i] = None
+                    if i + 2*self.jobs < len(chosen):
+                        pending.append(pool.submit(decompress_chunk, self._read(chosen[i + 2*self.jobs]), self.codec))
+                    yield self._trim(payload, entry, start, stop)
+        else:
+            for entry in chosen:
+                yield self._trim(decompress_chunk(self._read(entry), self.codec), entry, start, stop)
+
+    @staticmethod
+    def _trim(payload, entry, start, stop):
+        lo = max(start - entry[3], 0)
+        hi = min(stop - entry[3], entry[2])
+        return memoryview(payload)[lo*PACKET_BYTES:hi*PACKET_BYTES]
+
+def read_container(filename, start=0, stop=None, jobs=1):
+    reader = ContainerReader(filename, jobs)
+    try:
+        yield from reader.chunks(start, stop)
+    finally:
+        reader.close()
+
+# Benchmark ----------------------------------------------------------------------------------------
+
+def benchmark(payload, label, codecs=("zlib", "bz2", "lzma")):
+    """Compression ratio and single-process compress/decompress speed of each codec on payload."""
+    chunks  = [payload[i:i + CHUNK_PACKETS*PACKET_BYTES] for i in range(0, len(payload), CHUNK_PACKETS*PACKET_BYTES)]
+    print(f"{label}: {len(payload)/1e6:.1f} MB ({len(payload)/PACKET_BYTES*GROUPS_PER_PACKET/PDM_CLK_FREQ:.2f} s), "
+          f"line rate {PDM_CLK_FREQ*GROUP_WORDS*4/1e6:.1f} MB/s")
+    for codec in codecs:
+        start      = time.perf_counter()
+        compressed = [compress_chunk(c, codec) for c in chunks]
+        mid        = time.perf_counter()
+        restored   = [decompress_chunk(c, codec) for c in compressed]
+        end        = time.perf_counter()
+        assert b"".join(restored) == bytes(payload), f"{codec}: round trip mismatch"
+        size = sum(len(c) for c in compressed)
+        print(f"  {codec:5s} level {CODECS[codec][3]}: ratio {len(payload)/size:5.2f}, "
+              f"compress {len(payload)/(mid - start)/1e6:6.1f} MB/s, decompress {len(payload)/(end - mid)/1e6:6.1f} MB/s")
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Compress raw captures into .kpdm containers and back")
+    parser.add_argument("input",           nargs="?",                     help="Raw capture (compress) or .kpdm container (decompress)")
+    parser.add_argument("-o", "--output",  default=None,                  help="Output file")
+    parser.add_argument("--codec",         default="zlib", choices=CODECS, help="Compression codec")
+    parser.add_argument("--level",         default=None, type=int,        help="Codec level (default: per codec)")
+    parser.add_argument("--chunk-packets", default=CHUNK_PACKETS, type=int, help="Packets per chunk")
+    parser.add_argument("--jobs",          default=None, type=int,        help="Worker processes (default: all cores)")
+    parser.add_argument("--start",         default=0.0, type=float,       help="Decompress from this time (s)")
+    parser.add_argument("--duration",      default=None, type=float,      help="Decompress this many seconds")
+    parser.add_argument("--info",          action="store_true",           help="Print the container layout")
+    parser.add_argument("--benchmark",     action="store_true",           help="Report ratio and MB/s of each codec on the input (or synthetic data)")
+    parser.add_argument("--seconds",       default=1.0, type=float,       help="Benchmark: seconds of stream to use")
+    args = parser.parse_args()
+
+    packets = int(args.seconds*PDM_CLK_FREQ/GROUPS_PER_PACKET)
+    if args.benchmark:
+        from host.synth import SyntheticStream
+        if args.input is not None:
+            with open(args.input, "rb") as f:
+                benchmark(f.read(packets*PACKET_BYTES), args.input)
+        benchmark(SyntheticStream(sources=((45, 30, 1000, 0.5), (200, 10, None, 0.3))).read(packets), "synthetic")
+        return
+    if args.input is None:
+        parser.error("An input file is required")
+
+    if is_container(args.input):
+        reader = ContainerReader(args.input, args.jobs or os.cpu_count() or 1)
+        if args.info or args.output is None:
+            size = os.path.getsize(args.input)
+            print(f"{args.input}: {reader.codec} level {reader.level}, {len(reader.index)} chunks of "
+                  f"{reader.chunk_packets} packets, {reader.packets*GROUPS_PER_PACKET/PDM_CLK_FREQ:.1f} s, "
+                  f"ratio {reader.packets*PACKET_BYTES/max(size, 1):.2f}")
+            return
+        start = int(args.start*PDM_CLK_FREQ/GROUPS_PER_PACKET)
+        stop  = None if args.duration is None else start + int(args.duration*PDM_CLK_FREQ/GROUPS_PER_PACKET)
+        begin = time.perf_counter()
+        size  = 0
+        with open(args.output, "wb") as f:
+            for payload in reader.chunks(start, stop):
+                f.write(payload)
+                size += len(payload)
+        elapsed = time.perf_counter() - begin
+        print(f"Decompressed {size/1e6:.1f} MB in {elapsed:.1f} s ({size/elapsed/1e6:.1f} MB/s)")
+        return
+
+    if args.output is None:
+        parser.error("-o is required to compress")
+    writer = ContainerWriter(args.output, args.codec, args.level, args.chunk_packets, args.jobs)
+    begin  = time.perf_counter()
+    for payload in read_capture(args.input, args.chunk_packets):
+        writer.write(payload)
+    writer.close()
+    elapsed = time.perf_counter() - begin
+    print(f"Compressed {writer.raw/1e6:.1f} MB to {writer.size/1e6:.1f} MB (ratio {writer.raw/max(writer.size, 1):.2f}) "
+          f"in {elapsed:.1f} s ({writer.raw/elapsed/1e6:.1f} MB/s, {writer.jobs} processes)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# PDM to PCM decimation.
+#
+# 3.125 MHz PDM --/8 (byte lookup tables on packed bits)--> 390.625 kHz --/8 (polyphase FIR)-->
+# 48.828 kHz --/3 (polyphase FIR)--> 16.276 kHz PCM, all channels processed as (channels, samples)
+# blocks with the filter state carried between blocks.
+
+from host import lazy_import
+from host.stream import CHANNELS, PDM_CLK_FREQ
+
+np = lazy_import("numpy")
+
+PCM_DECIMATION = 192
+PCM_RATE       = PDM_CLK_FREQ/PCM_DECIMATION
+
+# Filters ------------------------------------------------------------------------------------------
+
+def lowpass(taps, cutoff, rate):
+    """Blackman windowed-sinc lowpass with unity DC gain."""
+    n = np.arange(taps) - (taps - 1)/2
+    h = np.sinc(2*cutoff/rate*n)*np.blackman(taps)
+    return (h/h.sum()).astype(np.float32)
+
+def cic(order, factor):
+    """Impulse response of a CIC filter (cascaded boxcars) with unity DC gain."""
+    h = np.ones(1)
+    for i in range(order):
+        h = np.convolve(h, np.ones(factor))
+    return (h/h.sum()).astype(np.float32)
+
+class FIRDecimator:
+    """Streaming polyphase FIR decimator over (channels, samples) blocks."""
+    def __init__(self, taps, factor, channels=CHANNELS):
+        taps = np.concatenate([taps, np.zeros(-len(taps) % factor, dtype=np.float32)])
+        self.factor = factor
+        self.blocks = len(taps)//factor
+        # y[m] = sum_j g_j . block[m - j] with g_j[i] = taps[factor*j + factor - 1 - i].
+        self.g = np.ascontiguousarray(taps.reshape(self.blocks, factor)[:, ::-1])
+        self.history = np.zeros((channels, (self.blocks - 1)*factor), dtype=np.float32)
+
+    def process(self, x):
+        x = np.concatenate([self.history, x], axis=1)
+        n = x.shape[1]//self.factor - (self.blocks - 1)
+        if n <= 0:
+            self.history = x
+            return np.zeros((x.shape[0], 0), dtype=np.float32)
+        blocks = x[:, :(n + self.blocks - 1)*self.factor].reshape(x.shape[0], -1, self.factor)
+        p = self.g @ blocks.transpose(0, 2, 1) # (channels, taps blocks, input blocks).
+        y = p[:, 0, self.blocks - 1:].copy()
+        for j in range(1, self.blocks):
+            y += p[:, j, self.blocks - 1 - j:self.blocks - 1 - j + n]
+        self.history = x[:, n*self.factor:]
+        return y
+
+class PackedFIRDecimator:
+    """First /8 stage of up to 16 taps on packed PDM bytes (first bit in the LSB, 0/1 as -1/+1).
+
+    Two consecutive bytes cover the 16 taps, so each output is a single lookup in a 64K entries table
+    of precomputed partial sums.
+    """
+    def __init__(self, taps, channels=CHANNELS):
+        assert len(taps) <= 16
+        taps = np.concatenate([taps, np.zeros(16 - len(taps), dtype=np.float32)])
+        # Table index: previous byte << 8 | current byte; bit i of the current byte is x[8m + i] and
+        # y[m] = sum_t taps[t] x[8m + 7 - t].
+        bits = 2.0*((np.arange(65536)[:, None] >> np.arange(16)) & 1) - 1
+        order = np.concatenate([np.arange(8, 16), np.arange(8)]) # Index bit position of each sample.
+        self.lut = (bits[:, order] @ taps[::-1].astype(np.float64)).astype(np.float32)
+        self.history = np.full((channels, 1), 0x55, dtype=np.uint8) # Zero mean.
+
+    def process(self, packed):
+        x = np.concatenate([self.history, packed], axis=1)
+        i = x[:, :-1]*np.intp(256)
+        i += x[:, 1:]
+        self.history = x[:, -1:]
+        return self.lut.take(i)
+
+# Decimator ----------------------------------------------------------------------------------------
+
+class PDMDecimator:
+    """PDM bits to PCM samples at PCM_RATE."""
+    def __init__(self, channels=CHANNELS):
+        rate = PDM_CLK_FREQ
+        self.stages = [
+            PackedFIRDecimator(cic(2, 8), channels),
+            FIRDecimator(lowpass(96,  12e3, rate/8),  8, channels),
+            FIRDecimator(lowpass(120, 7e3,  rate/64), 3, channels),
+        ]
+
+    def process_packed(self, packed):
+        """(channels, n) packed PDM bytes (see stream.decode_packed) to (channels, samples) PCM."""
+        x = packed
+        for stage in self.stages:
+            x = stage.process(x)
+        return x
+
+    def process(self, bits):
+        """(channels, n) PDM bits (n multiple of 8) to (channels, samples) PCM."""
+        assert bits.shape[1] % 8 == 0
+        return self.process_packed(np.packbits(bits, axis=1, bitorder="little"))
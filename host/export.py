@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+# Export decimated audio from stream captures to WAV/RF64 or FLAC.
+#
+# The capture is read, decoded and decimated in fixed-size chunks of packets and the selected channels
+# and/or delay-and-sum beams are appended to the output, so memory use does not depend on the capture
+# length. WAV files reserve a ds64 chunk up front and are turned into RF64 on close when the data
+# grows past 4 GiB. FLAC streams hold at most 8 channels, so FLAC exports are split in files of up to
+# 8 channels encoded in parallel (libsndfile releases the GIL), one chunk in flight while the next
+# one is decoded.
+
+import os
+import time
+import struct
+import argparse
+
+from host import lazy_import, metrics
+from host.array import DelayAndSum, load_positions
+from host.calibrate import load_calibration
+from host.dsp import PDMDecimator, PCM_RATE
+from host.mvdr import MVDR
+from host.stream import (CHANNELS, GROUPS_PER_PACKET, PACKET_BYTES, PDM_CLK_FREQ, SequenceChecker, capture_packets,
+    decode_packed, read_capture)
+
+np      = lazy_import("numpy")
+futures = lazy_import("concurrent.futures")
+
+CHUNK_PACKETS = 1024             # ~31 ms of stream per chunk.
+MAX_GAP       = int(PDM_CLK_FREQ) # Longest gap (groups) filled with silence, longer ones are skipped.
+
+# WAV ----------------------------------------------------------------------------------------------
+
+WAVE_FORMAT_PCM        = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+KSDATAFORMAT_SUFFIX    = b"\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71"
+
+SAMPLE_FORMATS = {
+    # name: (format tag, bytes per sample, numpy dtype, scale)
+    "s16" : (WAVE_FORMAT_PCM,        2, "<i2", 32767),
+    "s32" : (WAVE_FORMAT_PCM,        4, "<i4", 2147483647),
+    "f32" : (WAVE_FORMAT_IEEE_FLOAT, 4, "<f4", None),
+}
+
+class WavWriter:
+    """Streaming multi-channel WAV writer (WAVE_FORMAT_EXTENSIBLE), switching to RF64 past 4 GiB."""
+    def __init__(self, filename, channels, rate, sample_format="s16", rf64=False):
+        self.tag, self.width, self.dtype, self.scale = SAMPLE_FORMATS[sample_format]
+        self.channels = channels
+        self.rf64     = rf64
+        self.frames   = 0
+        self.f        = open(filename, "wb")
+        fmt = struct.pack("<HHIIHHHHI", WAVE_FORMAT_EXTENSIBLE, channels, int(round(rate)),
+            int(round(rate))*channels*self.width, channels*self.width, 8*self.width, 22, 8*self.width, 0)
+        fmt += struct.pack("<I", self.tag) + KSDATAFORMAT_SUFFIX
+        self.f.write(b"RIFF" + struct.pack("<I", 0) + b"WAVE")
+        self.f.write(b"JUNK" + struct.pack("<I", 28) + bytes(28)) # Room for the RF64 ds64 chunk.
+        self.f.write(b"fmt " + struct.pack("<I", len(fmt)) + fmt)
+        self.f.write(b"data" + struct.pack("<I", 0))
+        self.data_offset = self.f.tell()
+
+    def write(self, samples):
+        """Append (channels, n) float samples in [-1, 1]."""
+        if self.scale is not None:
+            # In float64: 2**31 - 1 is not representable in float32 and would round up and wrap.
+            samples = np.clip(np.rint(np.asarray(samples, np.float64)*self.scale), -self.scale - 1, self.scale)
+        self.f.write(np.ascontiguousarray(samples.T, dtype=self.dtype).tobytes())
+        self.frames += samples.shape[1]
+
+    def close(self):
+        data = self.frames*self.channels*self.width
+        if data % 2:
+            self.f.write(b"\x00")
+        riff = self.f.tell() - 8
+        if self.rf64 or riff > 0xffffffff:
+            self.f.seek(0)
+            self.f.write(b"RF64" + struct.pack("<I", 0xffffffff) + b"WAVE")
+            self.f.write(b"ds64" + struct.pack("<IQQQI", 28, riff, data, self.frames, 0))
+            self.f.seek(self.data_offset - 4)
+            self.f.write(struct.pack("<I", 0xffffffff))
+        else:
+            self.f.seek(4)
+            self.f.write(struct.pack("<I", riff))
+            self.f.seek(self.data_offset - 4)
+            self.f.write(struct.pack("<I", data))
+        self.f.close()
+
+# FLAC ---------------------------------------------------------------------------------------------
+
+FLAC_MAX_CHANNELS = 8
+
+class FlacWriter:
+    """FLAC export as files of up to 8 channels (name_chAA-BB.flac when split), encoded in parallel."""
+    def __init__(self, filename, channels, rate, sample_format="s16", jobs=None):
+        import soundfile
+
+        subtype = {"s16": "PCM_16", "s32": "PCM_24", "f32": "PCM_24"}[sample_format]
+        self.groups = [slice(i, min(i + FLAC_MAX_CHANNELS, channels)) for i in range(0, channels, FLAC_MAX_CHANNELS)]
+        base, ext   = os.path.splitext(filename)
+        self.filenames = [filename] if len(self.groups) == 1 else [
+            f"{base}_ch{g.start:02d}-{g.stop - 1:02d}{ext}" for g in self.groups]
+        self.files = [soundfile.SoundFile(name, "w", samplerate=int(round(rate)), channels=g.stop - g.start,
+            format="FLAC", subtype=subtype) for name, g in zip(self.filenames, self.groups)]
+        self.pool    = futures.ThreadPoolExecutor(jobs or min(len(self.files), os.cpu_count() or 1))
+        self.pending = []
+
+    def _wait(self):
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def write(self, samples):
+        self._wait() # Only one chunk in flight.
+        samples = np.clip(samples, -1, 1)
+        self.pending = [self.pool.submit(f.write, samples[g].T) for f, g in zip(self.files, self.groups)]
+
+    def close(self):
+        self._wait()
+        for f in self.files:
+            f.close()
+        self.pool.shutdown()
+
+def open_writer(filename, channels, rate, sample_format="s16", rf64=False, jobs=None):
+    if filename.lower().endswith(".flac"):
+        return FlacWriter(filename, channels, rate, sample_format, jobs)
+    return WavWriter(filename, channels, rate, sample_format, rf64)
+
+# Export -------------------------------------------------------------------------------------------
+
+def fill_gaps(ids, packed, checker):
+    """Insert zero-mean PDM (silence) for packets missing before/within this chunk to keep timing."""
+    first = ids[::GROUPS_PER_PACKET].astype(np.int64)
+    prev  = np.concatenate([[first[0] - GROUPS_PER_PACKET if checker.next is None else checker.next - GROUPS_PER_PACKET],
+        first[:-1]])
+    gaps  = ((first - prev - GROUPS_PER_PACKET) % 2**32)//GROUPS_PER_PACKET
+    gaps[gaps*GROUPS_PER_PACKET > MAX_GAP] = 0
+    if not gaps.any():
+        return packed
+    bytes_per_packet = GROUPS_PER_PACKET//8
+    where = np.repeat(np.arange(len(gaps))*bytes_per_packet, gaps*bytes_per_packet)
+    return np.insert(packed, where, 0x55, axis=1)
+
+def parse_channels(spec):
+    """'0-5,12' -> [0, 1, 2, 3, 4, 5, 12]."""
+    channels = []
+    for part in spec.split(","):
+        lo, _, hi = part.partition("-")
+        channels += range(int(lo), int(hi or lo) + 1)
+    assert all(0 <= c < CHANNELS for c in channels), f"Channels must be in 0-{CHANNELS - 1}"
+    return channels
+
+def export(chunks, writer, channels=None, beamformer=None, progress=None):
+    """Decimate payload chunks and write the selected channels followed by the beams."""
+    channels  = [] if channels is None else list(channels)
+    # Only the selected channels need decimating unless beams are formed.
+    decimated = list(range(CHANNELS)) if beamformer is not None else channels
+    decimator = PDMDecimator(channels=len(decimated))
+    checker   = SequenceChecker()
+    stages    = {name: metrics.stage(f"export.{name}") for name in ("decode", "decimate", "beamform", "write")}
+    metrics.counter("export.lost_groups", lambda: checker.lost)
+    for chunk in chunks:
+        with stages["decode"]:
+            ids, packed = decode_packed(chunk)
+            packed = fill_gaps(ids, packed[decimated], checker)
+            checker.update(ids)
+        stages["decode"].add(len(chunk))
+        with stages["decimate"]:
+            pcm = decimator.process_packed(packed)
+        out = [pcm[channels] if beamformer is not None else pcm] if channels else []
+        if beamformer is not None:
+            with stages["beamform"]:
+                out.append(beamformer.process(pcm))
+        with stages["write"]:
+            out = np.concatenate(out) if len(out) > 1 else out[0]
+            writer.write(out)
+        stages["write"].add(out.nbytes)
+        if progress is not None:
+            progress(checker)
+    return checker
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Export decimated audio from a Kandinsky capture")
+    parser.add_argument("capture",         nargs="?",                    help="Raw or compressed (.kpdm) capture file")
+    parser.add_argument("-o", "--output",  required=True,                help="Output .wav or .flac file")
+    parser.add_argument("--channels",      default=None,                 help="Channels to export, e.g. 0-5,12 (default: all without --beam)")
+    parser.add_argument("--beam",          default=[], action="append",  help="Delay-and-sum beam AZ,EL in degrees (repeatable)")
+    parser.add_argument("--mvdr",          action="store_true",          help="Adaptive MVDR beams instead of delay-and-sum (see host.mvdr)")
+    parser.add_argument("--positions",     default=None,                 help="Microphone positions JSON file")
+    parser.add_argument("--calibration",   default=None,                 help="Calibration file (see host.calibrate)")
+    parser.add_argument("--sample-format", default="s16", choices=SAMPLE_FORMATS, help="Output sample format")
+    parser.add_argument("--rf64",          action="store_true",          help="Always write RF64 (WAV only)")
+    parser.add_argument("--jobs",          default=None, type=int,       help="FLAC encoder threads")
+    parser.add_argument("--chunk-packets", default=CHUNK_PACKETS, type=int, help="Packets per processing chunk")
+    parser.add_argument("--start",         default=0.0, type=float,      help="Export from this time of the capture (s)")
+    parser.add_argument("--duration",      default=None, type=float,     help="Export this many seconds of the capture")
+    parser.add_argument("--synthetic",     default=None, type=float,     help="Export SECONDS of synthetic stream instead of a capture")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args)
+
+    if args.synthetic is not None:
+        from host.synth import SyntheticStream
+        stream  = SyntheticStream()
+        packets = int(args.synthetic*PDM_CLK_FREQ/GROUPS_PER_PACKET)
+        total   = packets*PACKET_BYTES
+        chunks  = (stream.read(min(args.chunk_packets, packets - i)) for i in range(0, packets, args.chunk_packets))
+    elif args.capture is not None:
+        first   = int(args.start*PDM_CLK_FREQ/GROUPS_PER_PACKET)
+        stop    = capture_packets(args.capture)
+        if args.duration is not None:
+            stop = min(stop, first + int(args.duration*PDM_CLK_FREQ/GROUPS_PER_PACKET))
+        total   = max(stop - first, 0)*PACKET_BYTES
+        chunks  = read_capture(args.capture, args.chunk_packets, first, stop)
+    else:
+        parser.error("A capture file or --synthetic is required")
+
+    channels = parse_channels(args.channels) if args.channels else ([] if args.beam else list(range(CHANNELS)))
+    beams    = [tuple(float(v) for v in b.split(",")) for b in args.beam]
+    calibration = None if args.calibration is None else load_calibration(args.calibration)
+    beamformer  = (MVDR if args.mvdr else DelayAndSum)(load_positions(args.positions), PCM_RATE, beams,
+        calibration=calibration) if beams else None
+    writer   = open_writer(args.output, len(channels) + len(beams), PCM_RATE, args.sample_format, args.rf64, args.jobs)
+
+    start = last = time.time()
+    def progress(checker):
+        nonlocal last
+        if time.time() - last < 1.0:
+            return
+        last = time.time()
+        done = checker.groups*PACKET_BYTES/GROUPS_PER_PACKET
+        print(f"\rExporting: {100*done/max(total, 1):5.1f}% ({checker.groups/PDM_CLK_FREQ/(last - start):.1f}x real time)",
+            end="", flush=True)
+    try:
+        checker = export(chunks, writer, channels, beamformer, progress)
+    finally:
+        writer.close()
+    print(f"\nExported {checker.groups/PDM_CLK_FREQ:.1f} s of {len(channels)} channels and {len(beams)} beams "
+          f"in {time.time() - start:.1f} s, {checker.lost} groups lost")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+# Microphone stream format, shared by the gateware (pdm.py, main.py) and the host tools.
+#
+# The PDM core samples the 24 data pins once after each PDM clock edge and emits a group of three
+# 32-bit words per PDM clock period: [packet_id, pins after rising edge, pins after falling edge].
+# UDPStreamer packs 96 groups per UDP packet. Each pin carries two microphones (one per edge), giving
+# 48 channels of 1-bit PDM at sys_clk/16. Plain constants only: importing this module must stay free
+# of numpy, migen and LiteX.
+
+SYS_CLK_FREQ      = 50e6
+PDM_CLK_DIV       = 16                                  # PDM counter period in sys clock cycles.
+PDM_CLK_FREQ      = SYS_CLK_FREQ/PDM_CLK_DIV            # 3.125 MHz, one group per PDM clock.
+PINS              = 24
+SLOTS             = 2                                   # Microphones per pin (one per clock edge).
+CHANNELS          = PINS*SLOTS
+GROUP_WORDS       = 3                                   # packet_id, slot 0 pins, slot 1 pins.
+GROUP_BYTES       = 4*GROUP_WORDS
+GROUPS_PER_PACKET = 96
+PACKET_BYTES      = GROUP_BYTES*GROUPS_PER_PACKET       # 1152 bytes UDP payload.
+UDP_PORT          = 5678
+
+WORD = "<u4"                                            # Stream word (numpy dtype).
+
+TRAFFIC_SEED = 0x2545f491                               # Link qualification PRBS31 seed reset value.
+
+def channel(pin, slot):
+    """Channel index of the microphone on data pin `pin` sampled after edge `slot`."""
+    return SLOTS*pin + slot
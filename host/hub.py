@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+
+# Stream distribution hub: one process owns the stream socket and serves it to local subscribers.
+#
+# - capture:   StreamReceiver (or SyntheticReceiver) blocks are read, and decoded/decimated/beamformed
+#              once per block on an executor thread, only for the streams somebody subscribed to.
+# - fan-out:   an asyncio Unix socket server; each block becomes one message per stream (raw payload,
+#              PCM or beams) shared by all the subscribers of that stream.
+# - subscriber: own bounded queue and writer task. When its queue is full the oldest message is
+#              dropped ("drop") or the subscriber is disconnected ("disconnect"), so a slow consumer
+#              never holds up capture or the other subscribers.
+#
+# Protocol: the subscriber sends one JSON line {"stream", "policy", "queue", "transport"}, the hub
+# answers one JSON line describing the stream, then messages of a HEADER (block sequence number, first
+# packet id, perf_counter receive stamp, payload bytes) and the payload: raw packet payloads for
+# "raw", C-order float32 (channels, samples) for "pcm" and (beams, samples) for "beams". Sequence gaps
+# are drops. With the "shm" transport (default) only the HEADER goes through the socket: each block is
+# written once into a shared memory ring per stream and subscribers copy it out, instead of the hub
+# writing every block to every socket. A slot overwritten before it was read counts as dropped.
+
+import os
+import sys
+import json
+import time
+import mmap
+import select
+import struct
+import socket
+import argparse
+
+from host import lazy_import, metrics
+from host.array import DelayAndSum, load_positions
+from host.dsp import PDMDecimator, PCM_RATE, PCM_DECIMATION
+from host.stream import (CHANNELS, UDP_PORT, GROUP_BYTES, GROUPS_PER_PACKET, PACKET_BYTES, PDM_CLK_FREQ, StreamReceiver,
+    decode, decode_packed)
+
+np      = lazy_import("numpy")
+asyncio = lazy_import("asyncio")
+
+HUB_PATH   = "/tmp/kandinsky_hub.sock"
+SHM_DIR    = "/dev/shm"
+HEADER     = struct.Struct("<QIdI") # seq, first packet id, stamp, payload bytes.
+STREAMS    = ("raw", "pcm", "beams")
+POLICIES   = ("drop", "disconnect")
+TRANSPORTS = ("shm", "socket")
+QUEUE      = 32                     # Default subscriber queue (blocks).
+RING_SLOTS = 64                     # Shared memory ring blocks (shm subscriber queues up to half).
+WRITING    = 2**64 - 1              # Sequence number of a slot being written.
+
+# Shared memory ring -------------------------------------------------------------------------------
+
+class SharedRing:
+    """Ring of `slots` blocks in a shared memory file, each a HEADER and up to `slot_bytes` payload.
+
+    The writer marks the slot's sequence number as WRITING, copies the payload and then writes the
+    header; readers check the sequence number before and after copying a payload out (seqlock).
+    """
+    def __init__(self, path, slots=RING_SLOTS, slot_bytes=0, create=False):
+        self.path  = path
+        self.slots = slots
+        self.size  = HEADER.size + slot_bytes
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT | os.O_TRUNC if create else 0), 0o600)
+        try:
+            if create:
+                os.ftruncate(fd, slots*self.size)
+            self.size = os.fstat(fd).st_size//slots
+            self.mm   = mmap.mmap(fd, slots*self.size)
+        finally:
+            os.close(fd)
+
+    def write(self, seq, first, stamp, data):
+        offset = seq % self.slots*self.size
+        HEADER.pack_into(self.mm, offset, WRITING, 0, 0.0, 0)
+        self.mm[offset + HEADER.size:offset + HEADER.size + len(data)] = data
+        HEADER.pack_into(self.mm, offset, seq, first, stamp, len(data))
+
+    def read(self, seq):
+        """Payload bytes of block `seq`, None if it was overwritten."""
+        offset = seq % self.slots*self.size
+        found, first, stamp, n = HEADER.unpack_from(self.mm, offset)
+        if found != seq:
+            return None
+        data = self.mm[offset + HEADER.size:offset + HEADER.size + n]
+        return data if HEADER.unpack_from(self.mm, offset)[0] == seq else None
+
+    def close(self, unlink=False):
+        self.mm.close()
+        if unlink:
+            os.unlink(self.path)
+
+# Hub ----------------------------------------------------------------------------------------------
+
+class Subscription:
+    def __init__(self, writer, stream, policy, size, transport):
+        self.writer     = writer
+        self.stream     = stream
+        self.policy     = policy
+        self.transport  = transport
+        self.queue      = asyncio.Queue(size)
+        self.sent       = 0
+        self.dropped    = 0
+        self.overflowed = False
+        self.closed     = False
+        self.task       = None
+
+    def offer(self, message):
+        if self.closed:
+            return
+        if self.queue.full():
+            if self.policy == "disconnect":
+                self.overflowed = True
+                self.close()
+                return
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def run(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                self.writer.write(message)
+                await self.writer.drain()
+                self.sent += 1
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+            if self.task is not None and self.task is not asyncio.current_task():
+                self.task.cancel()
+
+class Hub:
+    """Serve the blocks of `receiver` to subscribers on the Unix socket `path`."""
+    def __init__(self, receiver, path=HUB_PATH, beams=(), positions=None, calibration=None):
+        self.receiver      = receiver
+        self.path          = path
+        self.beams         = list(beams)
+        self.decimator     = PDMDecimator()
+        self.beamformer    = DelayAndSum(load_positions(positions), PCM_RATE, self.beams, calibration=calibration) if self.beams else None
+        self.subscriptions = []
+        self.rings         = {}
+        self.blocks        = 0
+        self.disconnected  = 0
+        self.left_dropped  = 0 # Dropped blocks of subscribers that have left.
+        self._stages       = {name: metrics.stage(f"hub.{name}") for name in ("decode", "decimate", "beamform", "fanout")}
+        metrics.gauge("hub.subscribers", lambda: len(self.subscriptions))
+        metrics.counter("hub.dropped", lambda: self.dropped)
+        metrics.counter("hub.disconnected", lambda: self.disconnected)
+
+    @property
+    def dropped(self):
+        """Blocks dropped for slow subscribers since the start, including those that left."""
+        return self.left_dropped + sum(s.dropped for s in self.subscriptions)
+
+    def info(self, stream):
+        info = {"stream": stream, "block_packets": getattr(self.receiver, "block_packets", None)}
+        if stream == "raw":
+            info.update(dtype="<u4", rate=PDM_CLK_FREQ, packet_bytes=PACKET_BYTES)
+        elif stream == "pcm":
+            info.update(dtype="<f4", rate=PCM_RATE, channels=CHANNELS)
+        else:
+            info.update(dtype="<f4", rate=PCM_RATE, channels=len(self.beams), beams=self.beams)
+        return info
+
+    def ring(self, stream):
+        if stream not in self.rings:
+            packets  = self.receiver.block_packets
+            channels = {"raw": None, "pcm": CHANNELS, "beams": len(self.beams)}[stream]
+            nbytes   = packets*PACKET_BYTES if channels is None else 4*channels*-(-packets*GROUPS_PER_PACKET//PCM_DECIMATION)
+            name     = f"kandinsky_hub_{os.getpid()}_{stream}"
+            self.rings[stream] = SharedRing(os.path.join(SHM_DIR, name), slot_bytes=nbytes, create=True)
+        return self.rings[stream]
+
+    def _next(self, wanted):
+        """Next block's messages for the wanted (stream, transport)s (executor thread), None on timeout."""
+        raw = self.receiver.read_raw(timeout=0.1)
+        if raw is None:
+            return None
+        try:
+            payload = raw[1] if raw[0] is None else bytes(raw[1])
+        finally:
+            self.receiver.release(raw[0])
+        first  = int.from_bytes(payload[:4], "little")
+        blocks = {"raw": payload}
+        if {stream for stream, transport in wanted} & {"pcm", "beams"}:
+            with self._stages["decode"]:
+                ids, packed = decode_packed(payload)
+            with self._stages["decimate"]:
+                pcm = self.decimator.process_packed(packed)
+            blocks["pcm"] = pcm
+            if self.beamformer is not None:
+                with self._stages["beamform"]:
+                    blocks["beams"] = self.beamformer.process(pcm).astype(np.float32)
+        messages = {}
+        for stream, transport in wanted:
+            data   = blocks[stream]
+            data   = data if isinstance(data, bytes) else np.ascontiguousarray(data, dtype=np.float32).data.cast("B")
+            header = HEADER.pack(self.blocks, first, raw[2], len(data))
+            if transport == "shm":
+                self.rings[stream].write(self.blocks, first, raw[2], data)
+                messages[stream, transport] = header
+            else:
+                messages[stream, transport] = header + data
+        self.blocks += 1
+        return messages
+
+    async def _client(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            stream  = request.get("stream", "raw")
+            policy  = request.get("policy", "drop")
+            size    = int(request.get("queue", QUEUE))
+            transport = request.get("transport", "shm")
+            if (stream not in STREAMS or policy not in POLICIES or transport not in TRANSPORTS or size < 1 or
+                (transport == "shm" and size > RING_SLOTS//2) or (stream == "beams" and not self.beams)):
+                raise ValueError(f"invalid subscription {request}")
+        except (ValueError, TypeError, AttributeError) as e:
+            writer.write((json.dumps({"error": str(e)}) + "\n").encode())
+            writer.close()
+            return
+        info = self.info(stream)
+        if transport == "shm":
+            # Keep notifications from piling up in the socket so the queue bounds the subscriber lag.
+            info["shm"] = self.ring(stream).path
+            writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            writer.transport.set_write_buffer_limits(high=4*HEADER.size)
+        else:
+            writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 << 20)
+            writer.transport.set_write_buffer_limits(high=1 << 20)
+        writer.write((json.dumps(info) + "\n").encode())
+        subscription = Subscription(writer, stream, policy, size, transport)
+        subscription.task = asyncio.ensure_future(subscription.run())
+        self.subscriptions.append(subscription)
+        try:
+            await subscription.task
+        finally:
+            self.subscriptions.remove(subscription)
+            self.disconnected += subscription.overflowed
+            self.left_dropped += subscription.dropped
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def serve(self, duration=None, status=None):
+        """Capture and serve until `duration` (s) elapses (forever if None)."""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._client, self.path)
+        loop   = asyncio.get_running_loop()
+        start  = time.perf_counter()
+        last   = start
+        self.receiver.start()
+        try:
+            while duration is None or time.perf_counter() - start < duration:
+                wanted   = {(s.stream, s.transport) for s in self.subscriptions}
+                messages = await loop.run_in_executor(None, self._next, wanted)
+                if messages is not None:
+                    with self._stages["fanout"]:
+                        for s in list(self.subscriptions):
+                            if (s.stream, s.transport) in messages:
+                                s.offer(messages[s.stream, s.transport])
+                if status is not None and time.perf_counter() - last >= 1:
+                    last = time.perf_counter()
+                    status(self)
+        finally:
+            server.close()
+            for s in list(self.subscriptions):
+                s.close()
+            await server.wait_closed()
+            self.receiver.close()
+            os.unlink(self.path)
+            for ring in self.rings.values():
+                ring.close(unlink=True)
+
+    def status(self):
+        streams = {stream: sum(s.stream == stream for s in self.subscriptions) for stream in STREAMS}
+        return (f"{self.blocks} blocks | {self.receiver.packets} packets, {self.receiver.overruns} overruns | "
+                f"subscribers: {', '.join(f'{n} {k}' for k, n in streams.items())} | "
+                f"{self.dropped} dropped, {self.disconnected} disconnected")
+
+# Subscriber ---------------------------------------------------------------------------------------
+
+class Subscriber:
+    """Blocking client of a Hub stream."""
+    def __init__(self, stream="raw", policy="drop", queue=QUEUE, path=HUB_PATH, transport="shm"):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        request   = {"stream": stream, "policy": policy, "queue": queue, "transport": transport}
+        self.sock.sendall((json.dumps(request) + "\n").encode())
+        line = bytearray()
+        while not line.endswith(b"\n"):
+            c = self.sock.recv(1)
+            if not c:
+                raise ConnectionError("hub closed the connection")
+            line += c
+        self.info = json.loads(line)
+        if "error" in self.info:
+            raise ValueError(self.info["error"])
+        self.ring   = SharedRing(self.info["shm"]) if "shm" in self.info else None
+        self.blocks = 0
+        self.lost   = 0     # Blocks dropped by the hub for this subscriber.
+        self._next  = None
+
+    def _recv(self, n):
+        data = bytearray(n)
+        view = memoryview(data)
+        got  = 0
+        while got < n:
+            size = self.sock.recv_into(view[got:])
+            if not size:
+                return None
+            got += size
+        return data
+
+    def read(self, timeout=None):
+        """Next (seq, first packet id, stamp, payload), None when the hub closed the stream or after
+        `timeout` seconds without a block."""
+        payload = None
+        while payload is None:
+            if timeout is not None and not select.select([self.sock], [], [], timeout)[0]:
+                return None
+            header = self._recv(HEADER.size)
+            if header is None:
+                return None
+            seq, first, stamp, n = HEADER.unpack(header)
+            if self._next is not None:
+                self.lost += seq - self._next
+            self._next = seq + 1
+            if self.ring is not None:
+                payload = self.ring.read(seq)
+                self.lost += payload is None # Overwritten before it was read.
+            else:
+                payload = self._recv(n)
+                if payload is None:
+                    return None
+        self.blocks += 1
+        return seq, first, stamp, payload
+
+    def array(self, payload):
+        """(channels, samples) float32 view of a "pcm" or "beams" payload."""
+        return np.frombuffer(payload, dtype=self.info["dtype"]).reshape(self.info["channels"], -1)
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+        self.sock.close()
+
+class HubReceiver:
+    """StreamReceiver stand-in reading the raw stream from a Hub, e.g. for the monitor."""
+    def __init__(self, path=HUB_PATH, queue=QUEUE, name="receiver"):
+        self.path          = path
+        self.queue         = queue
+        self.block_packets = None
+        self.packets       = 0
+        self.invalid       = 0
+        self.overruns      = 0
+        self._decode       = metrics.stage(f"{name}.decode")
+
+    def start(self):
+        self.subscriber    = Subscriber("raw", "drop", self.queue, self.path)
+        self.block_packets = self.subscriber.info["block_packets"]
+        return self
+
+    def read_raw(self, timeout=None):
+        lost  = self.subscriber.lost
+        block = self.subscriber.read(timeout)
+        if block is None:
+            return None
+        self.overruns += (self.subscriber.lost - lost)*(self.block_packets or 0)
+        self.packets  += len(block[3])//PACKET_BYTES
+        return None, block[3], block[2]
+
+    def release(self, block):
+        pass
+
+    def read(self, timeout=None, packed=False):
+        raw = self.read_raw(timeout)
+        if raw is None:
+            return None
+        with self._decode:
+            block = (decode_packed if packed else decode)(raw[1])
+        self._decode.add(len(raw[1]))
+        return block
+
+    def close(self):
+        self.subscriber.close()
+
+# Benchmark ----------------------------------------------------------------------------------------
+
+def _subscribe(stream, policy, path, transport, seconds, delay, results):
+    while True:
+        try:
+            sub = Subscriber(stream, policy, path=path, transport=transport)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.1)   # Hub not serving yet.
+    start  = time.perf_counter()
+    nbytes = 0
+    while time.perf_counter() - start < seconds:
+        block = sub.read()
+        if block is None:
+            break
+        nbytes += len(block[3])
+        if delay:
+            time.sleep(delay)
+    elapsed = time.perf_counter() - start
+    results.put((stream, policy, delay, sub.blocks, sub.lost, nbytes/elapsed, block is None))
+    sub.close()
+
+def benchmark(subscribers=12, seconds=10, path=HUB_PATH, block_packets=256, streams=("raw", "pcm"), transport="shm"):
+    """Synthetic full rate stream served to `subscribers` processes (cycling through `streams`) plus
+    one slow raw subscriber of each policy; capture must not overrun and fast subscribers must not
+    lose blocks."""
+    import multiprocessing
+    from host.synth import SyntheticReceiver
+
+    ctx     = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    jobs    = [(streams[k % len(streams)], "drop", 0.0) for k in range(subscribers)]
+    jobs   += [("raw", "drop", 0.05), ("raw", "disconnect", 0.05)]
+    procs   = [ctx.Process(target=_subscribe, args=(stream, policy, path, transport, seconds, delay, results))
+               for stream, policy, delay in jobs]
+    for p in procs:
+        p.start()
+    hub = Hub(SyntheticReceiver(block_packets=block_packets), path)
+    cpu = time.process_time()
+    asyncio.run(hub.serve(seconds + 1.5, status=lambda h: print(h.status())))
+    cpu = time.process_time() - cpu
+    rows = sorted(results.get(timeout=10) for p in procs)
+    for p in procs:
+        p.join()
+    print(f"{len(jobs)} subscribers, {seconds:g} s at {PDM_CLK_FREQ*GROUP_BYTES*8/1e6:.0f} Mbps, "
+          f"hub CPU {100*cpu/(seconds + 1.5):.0f}% of one core")
+    for stream, policy, delay, blocks, lost, rate, closed in rows:
+        print(f"  {stream:<5} {policy:<10} {'slow' if delay else 'fast'}: {blocks} blocks, {lost} lost, "
+              f"{rate/1e6:.1f} MB/s{' (disconnected)' if closed else ''}")
+    fast = [r for r in rows if not r[2]]
+    ok   = hub.receiver.overruns == 0 and all(r[4] == 0 for r in fast)
+    print(f"Capture overruns: {hub.receiver.overruns}, fast subscriber losses: {sum(r[4] for r in fast)}")
+    return ok
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Kandinsky stream distribution hub")
+    parser.add_argument("--port",          default=UDP_PORT, type=int,   help="Stream UDP port")
+    parser.add_argument("--path",          default=HUB_PATH,             help="Hub Unix socket")
+    parser.add_argument("--synthetic",     action="store_true",          help="Serve a synthetic stream instead of the board")
+    parser.add_argument("--block-packets", default=256, type=int,        help="Packets per block/message")
+    parser.add_argument("--beam",          default=[], action="append",  help="Delay-and-sum beam AZ,EL in degrees for the beams stream (repeatable)")
+    parser.add_argument("--positions",     default=None,                 help="Microphone positions JSON file")
+    parser.add_argument("--calibration",   default=None,                 help="Calibration file (see host.calibrate)")
+    parser.add_argument("--duration",      default=None, type=float,     help="Serve duration (s, default: forever)")
+    parser.add_argument("--subscribe",     default=None, choices=STREAMS, help="Subscribe to a running hub and report the received rate")
+    parser.add_argument("--benchmark",     default=None, type=int,       help="Serve a synthetic stream to N subscriber processes and report")
+    parser.add_argument("--seconds",       default=10.0, type=float,     help="Benchmark duration (s)")
+    parser.add_argument("--streams",       default="raw,pcm",            help="Benchmark subscriber streams (cycled)")
+    parser.add_argument("--transport",     default="shm", choices=TRANSPORTS, help="Benchmark/--subscribe transport")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args)
+
+    if args.benchmark is not None:
+        if not benchmark(args.benchmark, args.seconds, args.path, args.block_packets, args.streams.split(","), args.transport):
+            sys.exit(1)
+        return
+
+    if args.subscribe is not None:
+        sub   = Subscriber(args.subscribe, path=args.path, transport=args.transport)
+        print(f"Subscribed: {sub.info}")
+        start, nbytes = time.perf_counter(), 0
+        while (block := sub.read()) is not None:
+            nbytes += len(block[3])
+            if sub.blocks % 100 == 0:
+                print(f"{sub.blocks} blocks, {sub.lost} lost, {nbytes/(time.perf_counter() - start)/1e6:.1f} MB/s")
+        return
+
+    if args.synthetic:
+        from host.synth import SyntheticReceiver
+        receiver = SyntheticReceiver(block_packets=args.block_packets)
+    else:
+        receiver = StreamReceiver(port=args.port, block_packets=args.block_packets)
+    from host.calibrate import load_calibration
+    calibration = None if args.calibration is None else load_calibration(args.calibration)
+    beams = [tuple(float(v) for v in b.split(",")) for b in args.beam]
+    hub   = Hub(receiver, args.path, beams, args.positions, calibration)
+    print(f"Serving {'synthetic stream' if args.synthetic else f'UDP port {args.port}'} on {args.path}")
+    try:
+        asyncio.run(hub.serve(args.duration, status=lambda h: print(h.status())))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
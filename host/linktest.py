@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+
+# Link qualification: verify the traffic generator stream (pdm.py TrafficGenerator) at line rate.
+#
+# Generated groups are [group id, PRBS31 word, PRBS31 word] where the PRBS31 (x^31 + x^28 + 1) bits
+# run on from word to word and group to group. The next word is a fixed GF(2)-linear map of the
+# previous one, applied to whole blocks with four 256-entry lookup tables, so every payload word is
+# checked against its predecessor without a per-word loop. A word that fails this check but matches
+# the prediction from an earlier word (up to LOOKBACK back) only follows a corrupted word, so counts
+# stay exact unless LOOKBACK corrupted words are adjacent. Packet ids give the loss and reorder
+# counts. The checker needs no seed: it follows the stream from its first packet.
+#
+# `--loopback` sends a software generator stream with injected loss, corruption and reordering to
+# localhost and compares the verifier's counts with the injected ones.
+
+import sys
+import time
+import socket
+import argparse
+import functools
+import threading
+
+from host import lazy_import, metrics
+from host.format import TRAFFIC_SEED
+from host.stream import GROUP_WORDS, GROUPS_PER_PACKET, PACKET_BYTES, UDP_PORT, WORD, StreamReceiver
+
+np = lazy_import("numpy")
+
+SEED     = TRAFFIC_SEED # TrafficGenerator seed reset value.
+LOOKBACK = 4            # Preceding words a word is checked against.
+
+# PRBS31 -------------------------------------------------------------------------------------------
+
+def prbs31_next(word):
+    """Next 32 bits of the x^31 + x^28 + 1 sequence following the 32 bits of word (bit 0 first)."""
+    s = [(word >> i) & 1 for i in range(32)]
+    for n in range(32, 64):
+        s.append(s[n - 31] ^ s[n - 28])
+    return sum(b << i for i, b in enumerate(s[32:]))
+
+class Gf2Map:
+    """32x32 GF(2) linear map of uint32 words, given by the images of the 32 unit words."""
+    def __init__(self, columns):
+        self.columns = np.asarray(columns, dtype=WORD)
+        self.tables  = np.zeros((4, 256), dtype=WORD)
+        for b in range(4):
+            for i in range(8):
+                bit = 1 << i
+                v   = np.arange(256)
+                self.tables[b, (v & bit) != 0] ^= self.columns[8*b + i]
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=WORD)
+        t = self.tables
+        return t[0][x & 0xff] ^ t[1][(x >> 8) & 0xff] ^ t[2][(x >> 16) & 0xff] ^ t[3][x >> 24]
+
+    def __matmul__(self, other):
+        """self after other."""
+        return Gf2Map(self(other.columns))
+
+    def __pow__(self, k):
+        result, square = Gf2Map(1 << np.arange(32, dtype=WORD)), self
+        while k:
+            if k & 1:
+                result = square @ result
+            square = square @ square
+            k    >>= 1
+        return result
+
+@functools.cache
+def next_map():
+    """Gf2Map from a PRBS31 word to the next one."""
+    return Gf2Map([prbs31_next(1 << i) for i in range(32)])
+
+class Prbs31:
+    """PRBS31 words following seed, produced a segment at a time (one table lookup per word)."""
+    def __init__(self, seed=SEED, segment=1 << 16):
+        step      = next_map()
+        self.jump = step**segment
+        words     = np.empty(segment, dtype=WORD)
+        words[0]  = step(seed)
+        n         = 1
+        while n < segment:
+            words[n:2*n] = step(words[:min(n, segment - n)])
+            n, step = 2*n, step @ step
+        self.segment = words
+        self.offset  = 0
+
+    def read(self, n):
+        out = np.empty(n, dtype=WORD)
+        i   = 0
+        while i < n:
+            if self.offset == len(self.segment):
+                self.segment, self.offset = self.jump(self.segment), 0
+            k = min(n - i, len(self.segment) - self.offset)
+            out[i:i + k] = self.segment[self.offset:self.offset + k]
+            i += k
+            self.offset += k
+        return out
+
+# Software Generator -------------------------------------------------------------------------------
+
+class SoftwareGenerator:
+    """TrafficGenerator stand-in with injected faults, keeping the counts the verifier should find.
+
+    Packets are dropped with probability `loss`, swapped with the next packet with probability
+    `reorder` and PRBS words flipped (one bit) with probability `corrupt`. The first PRBS word of
+    a packet is never flipped: after a lost or reordered packet it has no predecessor to be checked
+    against, so the expected counts stay exact.
+    """
+    def __init__(self, seed=SEED, loss=0.0, corrupt=0.0, reorder=0.0, rng_seed=0):
+        self.prbs      = Prbs31(seed)
+        self.loss      = loss
+        self.corrupt   = corrupt
+        self.reorder   = reorder
+        self.rng       = np.random.default_rng(rng_seed)
+        self.groups    = 0
+        self.packets   = 0
+        self.sent      = 0
+        self.dropped   = 0
+        self.lost      = 0 # Dropped before the last sent packet (detectable).
+        self.swapped   = 0
+        self.flipped   = 0
+
+    def read(self, packets):
+        """Payload of the next `packets` packets, faults applied."""
+        n     = packets*GROUPS_PER_PACKET
+        words = np.empty((packets, GROUPS_PER_PACKET, GROUP_WORDS), dtype=WORD)
+        words[..., 0]  = ((self.groups + np.arange(n)) & 0xffffffff).reshape(packets, -1)
+        words[..., 1:] = self.prbs.read(2*n).reshape(packets, -1, 2)
+        self.groups   += n
+        self.packets  += packets
+
+        keep = self.rng.random(packets) >= self.loss
+        if keep.any():
+            self.lost = self.dropped + int((~keep[:np.flatnonzero(keep)[-1]]).sum())
+        self.dropped += int((~keep).sum())
+        words = words[keep]
+
+        prbs  = words[..., 1:].reshape(len(words), -1)
+        flips = self.rng.binomial(prbs[:, 1:].size, self.corrupt) if self.corrupt else 0
+        if flips:
+            where = self.rng.choice(prbs[:, 1:].size, flips, replace=False)
+            rows, cols = np.divmod(where, prbs.shape[1] - 1)
+            prbs[rows, cols + 1] ^= (1 << self.rng.integers(0, 32, flips)).astype(WORD)
+            words[..., 1:] = prbs.reshape(len(words), -1, 2)
+            self.flipped += flips
+
+        order = np.arange(len(words))
+        i = 0
+        while self.reorder and i < len(words) - 1:
+            if self.rng.random() < self.reorder:
+                order[i], order[i + 1] = order[i + 1], order[i]
+                self.swapped += 1
+                i += 1
+            i += 1
+        self.sent += len(words)
+        return words[order].tobytes()
+
+def send_loopback(generator, port, mbps, stop):
+    """Send the generator stream to localhost at mbps (payload) until stop is set."""
+    sock   = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16 << 20)
+    period = PACKET_BYTES*8/(mbps*1e6)
+    start  = time.perf_counter()
+    while not stop.is_set():
+        payload = memoryview(generator.read(64))
+        for i in range(len(payload)//PACKET_BYTES):
+            sock.sendto(payload[i*PACKET_BYTES:(i + 1)*PACKET_BYTES], ("127.0.0.1", port))
+        delay = start + generator.packets*period - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    sock.close()
+
+# Verifier -----------------------------------------------------------------------------------------
+
+class Verifier:
+    """Check every word and packet id of a traffic generator stream.
+
+    Until the first packet with contiguous ids and mostly valid (non-zero, chained) PRBS words,
+    packets are skipped: the PDM stream, or groups of it sharing a packet with the first generated
+    groups.
+    """
+    def __init__(self):
+        self.steps      = [None] + [next_map()**j for j in range(1, LOOKBACK + 1)]
+        self.synced     = False
+        self.skipped    = 0
+        self.packets    = 0
+        self.groups     = 0
+        self.bytes      = 0
+        self.lost       = 0  # Packets.
+        self.reordered  = 0  # Packets arriving after a later one.
+        self.id_errors  = 0  # Group ids out of sequence within a packet.
+        self.checked    = 0  # PRBS words with a predecessor to check against.
+        self.corrupted  = 0
+        self.error_bits = 0
+        self._prev      = np.zeros(LOOKBACK, dtype=WORD) # Last PRBS words,
+        self._run       = 0                              # the contiguous ones of them.
+        self._last_id   = None                    # Last group id.
+        self._first     = None                    # Unwrapped first id of the last packet.
+        self._highest   = None                    # Highest unwrapped first id seen.
+        self._check     = metrics.stage("linktest.check")
+        metrics.counter("linktest.lost",      lambda: self.lost)
+        metrics.counter("linktest.corrupted", lambda: self.corrupted)
+
+    def _sync(self, words):
+        ids  = words[..., 0]
+        prbs = words[..., 1:].reshape(len(words), -1)
+        chain = (self.steps[1](prbs[:, :-1]) == prbs[:, 1:]) & (prbs[:, 1:] != 0)
+        good  = (np.diff(ids, axis=1) == 1).all(axis=1) & (chain.mean(axis=1) > 0.5)
+        if not good.any():
+            self.skipped += len(words)
+            return words[:0]
+        first = int(np.argmax(good))
+        self.skipped += first
+        self.synced   = True
+        return words[first:]
+
+    def process(self, payload):
+        """Check one block of whole packets."""
+        with self._check:
+            words = np.frombuffer(payload, dtype=WORD).reshape(-1, GROUPS_PER_PACKET, GROUP_WORDS)
+            if not self.synced:
+                words = self._sync(words)
+                if not len(words):
+                    return
+            self._packets(words[:, :, 0])
+            self._words(words.reshape(-1, GROUP_WORDS))
+        self._check.add(len(payload))
+
+    def _packets(self, ids):
+        n     = len(ids)
+        first = ids[:, 0].astype(np.int64)
+        inner = (ids - ids[:, :1]) & 0xffffffff != np.arange(GROUPS_PER_PACKET)
+        self.id_errors += int(inner.sum())
+        prev  = first[0] - GROUPS_PER_PACKET if self._first is None else self._first
+        step  = (np.diff(first, prepend=prev & 0xffffffff) + 2**31) % 2**32 - 2**31
+        u     = prev + np.cumsum(step)
+        hi    = np.maximum.accumulate(np.concatenate(([prev if self._highest is None else self._highest], u)))
+        ahead = u - hi[:-1]
+        late  = int((ahead <= 0).sum())
+        self.lost      += int(((ahead[ahead > 0] - GROUPS_PER_PACKET)//GROUPS_PER_PACKET).sum()) - late
+        self.reordered += late
+        self._first, self._highest = int(u[-1]), int(hi[-1])
+        self.packets   += n
+        self.groups    += n*GROUPS_PER_PACKET
+        self.bytes     += n*PACKET_BYTES
+
+    def _words(self, groups):
+        ids   = groups[:, 0]
+        last  = ids[0] if self._last_id is None else self._last_id
+        cont  = np.diff(ids, prepend=np.uint32(last)) == 1 # Group follows the previous one.
+        c1    = np.repeat(cont, 2)
+        c1[1::2] = True                                     # Second word of a group follows the first.
+        x     = np.concatenate((self._prev, groups[:, 1:].ravel()))
+        w     = x[LOOKBACK:]
+        idx   = np.arange(len(w))
+        avail = idx - np.maximum.accumulate(np.where(c1, -self._run, idx)) # Contiguous predecessors.
+        pred  = lambda j, k: w[k] ^ self.steps[j](x[LOOKBACK + k - j])
+
+        k   = np.flatnonzero(avail > 0)
+        bad = k[pred(1, k) != 0]
+        # A word predicted by an earlier intact word is good, only its predecessor is corrupted.
+        for j in range(2, LOOKBACK + 1):
+            test = bad[avail[bad] >= j]
+            bad  = np.setdiff1d(bad, test[pred(j, test) == 0], assume_unique=True)
+        # Error bits against the prediction from the last intact word.
+        after = np.diff(bad, prepend=-2) == 1
+        run   = idx[:len(bad)] - np.maximum.accumulate(np.where(after, 0, idx[:len(bad)]))
+        j     = np.where(run < np.minimum(avail[bad], LOOKBACK), run + 1, 1)
+        for step in np.unique(j):
+            self.error_bits += int(np.bitwise_count(pred(step, bad[j == step])).sum())
+        self.checked   += len(k)
+        self.corrupted += len(bad)
+        self._prev    = x[-LOOKBACK:].copy()
+        self._run     = int(min(LOOKBACK, avail[-1] + 1))
+        self._last_id = int(ids[-1])
+
+    def summary(self):
+        return (f"{self.packets} packets, {self.lost} lost, {self.reordered} reordered, {self.id_errors} id errors | "
+                f"{self.corrupted}/{self.checked} words corrupted ({self.error_bits} bit errors)")
+
+def verify(receiver, verifier, seconds, report=1.0):
+    """Feed receiver blocks to verifier for seconds, printing throughput every report seconds."""
+    start = last = time.perf_counter()
+    mark  = 0
+    while time.perf_counter() - start < seconds:
+        raw = receiver.read_raw(timeout=0.1)
+        if raw is not None:
+            try:
+                verifier.process(raw[1])
+            finally:
+                receiver.release(raw[0])
+        now = time.perf_counter()
+        if now - last >= report:
+            print(f"{(verifier.bytes - mark)*8/(now - last)/1e6:6.0f} Mbps | {verifier.summary()} | "
+                  f"{receiver.overruns} host overruns")
+            mark, last = verifier.bytes, now
+
+def drain(receiver, verifier):
+    """Verify the blocks still queued once the stream stopped."""
+    while (raw := receiver.read_raw(timeout=0.2)) is not None:
+        try:
+            verifier.process(raw[1])
+        finally:
+            receiver.release(raw[0])
+
+# Board --------------------------------------------------------------------------------------------
+
+def program(bus, mbps, burst=0, gap=0.0, seed=SEED, enable=True):
+    """Program the board's traffic generator CSRs (gap in s) and select it as stream source."""
+    clk  = float(bus.csrs.constants.get("config_clock_frequency", 50e6))
+    rate = round(mbps*1e6/32/clk*2**32)
+    if not 0 < rate < 2**32:
+        raise ValueError(f"{mbps} Mbps is not between 0 and {32*clk/1e6:.0f} Mbps")
+    regs = bus.regs
+    regs.traffic_enable.write(0)
+    regs.traffic_rate.write(rate)
+    regs.traffic_burst_length.write(burst)
+    regs.traffic_burst_gap.write(round(gap*clk))
+    regs.traffic_seed.write(seed)
+    regs.traffic_enable.write(int(enable))
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify the Kandinsky link qualification traffic")
+    parser.add_argument("--port",     default=UDP_PORT,       type=int,   help="Stream UDP port")
+    parser.add_argument("--seconds",  default=10.0,           type=float, help="Test duration")
+    parser.add_argument("--mbps",     default=None,           type=float, help="Payload rate (default: 500 board, 200 loopback)")
+    parser.add_argument("--board",    default=None,                       help="Program and run the generator of the board at this IP (Etherbone)")
+    parser.add_argument("--csr-csv",  default="csr.csv",                  help="CSR map of the board's build (--with-traffic)")
+    parser.add_argument("--burst",    default=0,              type=int,   help="Groups per burst (0: continuous)")
+    parser.add_argument("--gap",      default=0.0,            type=float, help="Idle time between bursts (us)")
+    parser.add_argument("--seed",     default=hex(SEED),                  help="PRBS31 seed")
+    parser.add_argument("--loopback", action="store_true",                help="Verify a software generator stream sent to localhost")
+    parser.add_argument("--loss",     default=0.0,            type=float, help="Loopback: packet drop probability")
+    parser.add_argument("--corrupt",  default=0.0,            type=float, help="Loopback: word bit flip probability")
+    parser.add_argument("--reorder",  default=0.0,            type=float, help="Loopback: packet swap probability")
+    parser.add_argument("--strict",   action="store_true",                help="Exit with an error on any fault (loopback: on any miscount)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args)
+
+    seed     = int(args.seed, 0)
+    receiver = StreamReceiver(port=args.port, name="linktest.receiver").start()
+    verifier = Verifier()
+
+    if args.loopback:
+        generator = SoftwareGenerator(seed, args.loss, args.corrupt, args.reorder)
+        stop      = threading.Event()
+        sender    = threading.Thread(target=send_loopback, args=(generator, args.port, args.mbps or 200, stop), daemon=True)
+        sender.start()
+        try:
+            verify(receiver, verifier, args.seconds)
+        finally:
+            stop.set()
+            sender.join()
+            drain(receiver, verifier)
+            receiver.close()
+        print(f"Verified: {verifier.summary()}, {receiver.overruns} host overruns")
+        print(f"Injected: {generator.sent} packets sent, {generator.lost} lost, {generator.swapped} reordered | "
+              f"{generator.flipped} words corrupted ({generator.flipped} bit errors)")
+        expected = (generator.sent, generator.lost, generator.swapped, 0, generator.flipped, generator.flipped)
+        found    = (verifier.packets, verifier.lost, verifier.reordered, verifier.id_errors, verifier.corrupted, verifier.error_bits)
+        if args.strict and receiver.overruns:
+            sys.exit(f"{receiver.overruns} host overruns, counts not comparable (lower --mbps)")
+        if args.strict and expected != found:
+            sys.exit(f"Verifier counts {found} differ from the injected {expected}")
+        return
+
+    if args.board is None:
+        parser.error("--board or --loopback is required")
+    from etherbone import Etherbone
+
+    bus = Etherbone(args.board, csr_csv=args.csr_csv)
+    try:
+        groups, stalls = bus.regs.traffic_groups.read(), bus.regs.traffic_stalls.read()
+        program(bus, args.mbps or 500, args.burst, args.gap*1e-6, seed)
+        try:
+            verify(receiver, verifier, args.seconds)
+        finally:
+            program(bus, args.mbps or 500, args.burst, args.gap*1e-6, seed, enable=False)
+            receiver.close()
+        groups = (bus.regs.traffic_groups.read() - groups) % 2**32
+        stalls = (bus.regs.traffic_stalls.read() - stalls) % 2**32
+    finally:
+        bus.close()
+    print(f"Verified: {verifier.summary()}, {receiver.overruns} host overruns, {verifier.skipped} packets before sync")
+    print(f"Board: {groups} groups generated ({groups/GROUPS_PER_PACKET:.0f} packets), {stalls} stall cycles")
+    faults = verifier.lost + verifier.reordered + verifier.id_errors + verifier.corrupted + receiver.overruns
+    if args.strict and faults:
+        sys.exit(f"{faults} faults")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+# Hot-path instrumentation of the host stages.
+#
+# Stages time their work with monotonic-clock spans into log-linear (HDR style, 16 sub-buckets per
+# power of two, ~6% resolution) latency histograms and count the bytes they process. Queue depths,
+# drop counters and other state are read through callbacks only when metrics are collected, so they
+# cost nothing on the hot path. Metrics are off unless enable() is called (the tools do it for
+# --metrics-port/--metrics-dump) before the stages are created: stage() then returns a shared no-op
+# stage. Collected metrics are served as Prometheus-style text (/metrics) and JSON (/metrics.json) on a
+# local HTTP port and/or appended to a JSON lines file periodically.
+
+import json
+import atexit
+import time
+import argparse
+import threading
+
+SUB_BITS    = 4
+SUB_BUCKETS = 1 << SUB_BITS
+BUCKETS     = 64*SUB_BUCKETS
+QUANTILES   = (0.5, 0.9, 0.99, 0.999)
+
+# Histogram ----------------------------------------------------------------------------------------
+
+def bucket(ns):
+    shift = max(ns.bit_length() - SUB_BITS - 1, 0)
+    return (shift << SUB_BITS) + (ns >> shift)
+
+def bucket_value(index):
+    """Lower bound (ns) of a bucket."""
+    shift = max((index >> SUB_BITS) - 1, 0)
+    return (index - (shift << SUB_BITS)) << shift
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0]*BUCKETS
+        self.count  = 0
+        self.total  = 0
+        self.max    = 0
+
+    def record(self, ns):
+        self.counts[bucket(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def quantile(self, q):
+        target = q*self.count
+        seen   = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= target:
+                return min(bucket_value(index + 1), self.max)
+        return 0
+
+# Stages -------------------------------------------------------------------------------------------
+
+class Stage:
+    """Context manager timing one stage; each stage is used from a single thread."""
+    __slots__ = ("name", "histogram", "bytes", "_start")
+
+    def __init__(self, name):
+        self.name      = name
+        self.histogram = Histogram()
+        self.bytes     = 0
+        self._start    = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.record(time.perf_counter_ns() - self._start)
+
+    def add(self, nbytes):
+        self.bytes += nbytes
+
+    def snapshot(self):
+        h = self.histogram
+        return {
+            "count"   : h.count,
+            "bytes"   : self.bytes,
+            "total_s" : h.total/1e9,
+            "max_s"   : h.max/1e9,
+            **{f"p{100*q:g}_s": h.quantile(q)/1e9 for q in QUANTILES},
+        }
+
+class NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def add(self, nbytes):
+        pass
+
+NULL_STAGE = NullStage()
+
+class Registry:
+    def __init__(self):
+        self.enabled  = False
+        self.stages   = {}
+        self.gauges   = {}
+        self.counters = {}
+        self.lock     = threading.Lock()
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        with self.lock:
+            return self.stages.setdefault(name, Stage(name))
+
+    def gauge(self, name, read):
+        """Current value (queue depth, buffer fill...) read when metrics are collected."""
+        if self.enabled:
+            self.gauges[name] = read
+
+    def counter(self, name, read):
+        """Monotonic total (drops, losses...) read when metrics are collected."""
+        if self.enabled:
+            self.counters[name] = read
+
+    def snapshot(self):
+        with self.lock:
+            stages = list(self.stages.values())
+        return {
+            "time"     : time.time(),
+            "stages"   : {s.name: s.snapshot() for s in stages},
+            "gauges"   : {name: read() for name, read in list(self.gauges.items())},
+            "counters" : {name: read() for name, read in list(self.counters.items())},
+        }
+
+    def text(self):
+        snap  = self.snapshot()
+        lines = ["# TYPE kandinsky_stage_seconds summary"]
+        for name, s in snap["stages"].items():
+            for q in QUANTILES:
+                lines.append(f'kandinsky_stage_seconds{{stage="{name}",quantile="{q}"}} {s[f"p{100*q:g}_s"]:.9f}')
+            lines.append(f'kandinsky_stage_seconds_sum{{stage="{name}"}} {s["total_s"]:.9f}')
+            lines.append(f'kandinsky_stage_seconds_count{{stage="{name}"}} {s["count"]}')
+        lines.append("# TYPE kandinsky_stage_bytes_total counter")
+        lines += [f'kandinsky_stage_bytes_total{{stage="{name}"}} {s["bytes"]}' for name, s in snap["stages"].items()]
+        lines.append("# TYPE kandinsky_gauge gauge")
+        lines += [f'kandinsky_gauge{{name="{name}"}} {v}' for name, v in snap["gauges"].items()]
+        lines.append("# TYPE kandinsky_total counter")
+        lines += [f'kandinsky_total{{name="{name}"}} {v}' for name, v in snap["counters"].items()]
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+stage    = REGISTRY.stage
+gauge    = REGISTRY.gauge
+counter  = REGISTRY.counter
+
+def enable():
+    REGISTRY.enabled = True
+
+# Export -------------------------------------------------------------------------------------------
+
+def serve(port, host="127.0.0.1", registry=REGISTRY):
+    """Serve /metrics (text) and /metrics.json on a background thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics.json":
+                body, kind = json.dumps(registry.snapshot()).encode(), "application/json"
+            elif self.path in ("/", "/metrics"):
+                body, kind = registry.text().encode(), "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", kind)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def dump(filename, interval=10.0, registry=REGISTRY):
+    """Append a JSON snapshot to filename every interval seconds on a background thread and at exit."""
+    def write():
+        with open(filename, "a") as f:
+            f.write(json.dumps(registry.snapshot()) + "\n")
+    def run():
+        while True:
+            time.sleep(interval)
+            write()
+    threading.Thread(target=run, daemon=True).start()
+    atexit.register(write)
+
+def add_arguments(parser):
+    parser.add_argument("--metrics-port",     default=None, type=int,   help="Serve stage metrics on this local HTTP port")
+    parser.add_argument("--metrics-dump",     default=None,             help="Append stage metrics as JSON lines to this file")
+    parser.add_argument("--metrics-interval", default=10.0, type=float, help="Metrics dump interval (s)")
+
+def setup(args):
+    """Enable metrics if requested on the command line (before creating the stages)."""
+    if args.metrics_port is None and args.metrics_dump is None:
+        return
+    enable()
+    if args.metrics_port is not None:
+        serve(args.metrics_port)
+        print(f"Metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+    if args.metrics_dump is not None:
+        dump(args.metrics_dump, args.metrics_interval)
+
+# Benchmark ----------------------------------------------------------------------------------------
+
+def benchmark(blocks=400, block_packets=64):
+    """Span cost and overhead on the decode + decimate path with metrics disabled and enabled."""
+    from host.dsp import PDMDecimator
+    from host.stream import decode_packed
+    from host.synth import SyntheticStream
+
+    spans = 200000
+    for enabled in (False, True):
+        REGISTRY.enabled = enabled
+        s     = stage("benchmark.span")
+        start = time.perf_counter()
+        for i in range(spans):
+            with s:
+                pass
+        print(f"span {'enabled' if enabled else 'disabled'}: {1e9*(time.perf_counter() - start)/spans:.0f} ns")
+
+    stream   = SyntheticStream()
+    payloads = [stream.read(block_packets) for i in range(blocks)]
+    results  = {}
+    for enabled in (False, True, False, True):
+        REGISTRY.enabled = enabled
+        decode, decimate = stage("benchmark.decode"), stage("benchmark.decimate")
+        decimator = PDMDecimator()
+        start = time.perf_counter()
+        for payload in payloads:
+            with decode:
+                ids, packed = decode_packed(payload)
+            decode.add(len(payload))
+            with decimate:
+                decimator.process_packed(packed)
+        results[enabled] = min(results.get(enabled, float("inf")), time.perf_counter() - start)
+    REGISTRY.enabled = False
+    overhead = results[True]/results[False] - 1
+    print(f"decode + decimate of {blocks} blocks: {1e3*results[False]:.1f} ms disabled, {1e3*results[True]:.1f} ms "
+          f"enabled ({100*overhead:+.2f}%)")
+    return overhead
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Host stage metrics")
+    parser.add_argument("--url", default=None, help="Print the metrics served at this URL (default: measure the overhead)")
+    args = parser.parse_args()
+    if args.url is not None:
+        from urllib.request import urlopen
+        print(urlopen(args.url).read().decode())
+    else:
+        benchmark()
+
+if __name__ == "__main__":
+    main()
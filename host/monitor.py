@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+# Live monitor of the microphone stream: per-microphone levels, rolling spectrogram and direction map.
+#
+# Capture, processing and rendering run on separate threads and never wait on each other:
+# - capture:    StreamReceiver socket thread filling preallocated packet blocks (drops on overrun),
+# - processing: decode, decimate, levels, shared STFT (host.stft) feeding the spectrogram and the
+#               direction map, colormapped at display resolution into the back buffer of a
+#               DoubleBuffer, published at the frame rate,
+# - rendering:  dearpygui loop (or the headless loop) copying the front buffer into its textures.
+
+import sys
+import time
+import argparse
+import threading
+import functools
+
+from host import lazy_import, metrics
+from host.array import SRPMap, load_positions
+from host.calibrate import load_calibration
+from host.dsp import PDMDecimator, PCM_RATE
+from host.stft import STFT
+from host.stream import CHANNELS, UDP_PORT, StreamReceiver, SequenceChecker
+
+np = lazy_import("numpy")
+
+# Display ------------------------------------------------------------------------------------------
+
+SPECTROGRAM_NFFT    = 512              # Shared with the direction map.
+SPECTROGRAM_COLUMNS = 256
+SPECTROGRAM_RANGE   = (-110.0, -20.0)  # dB mapped to the colormap.
+LEVEL_FLOOR         = -100.0           # dBFS.
+LEVEL_DECAY         = 30.0             # dB/s fall back of the level bars.
+MAP_AZIMUTHS        = range(0, 360, 4)
+MAP_ELEVATIONS      = range(0, 91, 10)
+
+VIRIDIS = [ # Colormap anchors.
+    [0.267, 0.005, 0.329], [0.231, 0.322, 0.545], [0.129, 0.569, 0.549], [0.369, 0.788, 0.384], [0.993, 0.906, 0.144]
+]
+
+@functools.cache
+def colormap_table():
+    """(256, 4) RGBA interpolated between the VIRIDIS anchors."""
+    anchors = np.array(VIRIDIS)
+    table   = np.ones((256, 4), dtype=np.float32)
+    for i in range(3):
+        table[:, i] = np.interp(np.linspace(0, 1, 256), np.linspace(0, 1, len(anchors)), anchors[:, i])
+    return table
+
+def colormap(x, out):
+    """Map x in [0, 1] to RGBA into out (x.shape + (4,))."""
+    np.take(colormap_table(), np.clip(x*255, 0, 255).astype(np.intp), axis=0, out=out)
+
+def draw_buffers():
+    return {
+        "levels"      : np.full(CHANNELS, LEVEL_FLOOR, dtype=np.float32),
+        "spectrogram" : np.zeros((SPECTROGRAM_NFFT//2, SPECTROGRAM_COLUMNS, 4), dtype=np.float32),
+        "map"         : np.zeros((len(MAP_ELEVATIONS), len(MAP_AZIMUTHS), 4), dtype=np.float32),
+    }
+
+class DoubleBuffer:
+    """Front/back pair of preallocated draw data.
+
+    The writer fills the back buffer and swaps only if the reader is not copying the front one at that
+    moment (otherwise the swap is skipped and retried at the next publish), so neither side waits.
+    """
+    def __init__(self, make):
+        self._buffers  = [make(), make()]
+        self._front    = 0
+        self._lock     = threading.Lock()
+        self.version   = 0
+        self.stamp     = None # perf_counter() of the last swap.
+        self.intervals = []   # Between swaps (s).
+        self.skipped   = 0
+
+    @property
+    def back(self):
+        return self._buffers[1 - self._front]
+
+    def swap(self):
+        if not self._lock.acquire(blocking=False):
+            self.skipped += 1
+            return False
+        now = time.perf_counter()
+        if self.stamp is not None:
+            self.intervals.append(now - self.stamp)
+        self._front   = 1 - self._front
+        self.version += 1
+        self.stamp    = now
+        self._lock.release()
+        return True
+
+    def read(self, dst, version=None):
+        """Copy the front buffer into dst if it changed since version, return the current (version, stamp)."""
+        with self._lock:
+            if self.version != version:
+                for name, data in self._buffers[self._front].items():
+                    np.copyto(dst[name], data)
+            return self.version, self.stamp
+
+# Monitor ------------------------------------------------------------------------------------------
+
+class Monitor:
+    def __init__(self, receiver, positions, fps=60, map_rate=15, channel=0, calibration=None):
+        self.receiver   = receiver
+        self.channel    = channel
+        self.decimator  = PDMDecimator()
+        self.sequence   = SequenceChecker()
+        self.srp        = SRPMap(positions, PCM_RATE, azimuths=MAP_AZIMUTHS, elevations=MAP_ELEVATIONS,
+            nfft=SPECTROGRAM_NFFT, calibration=calibration)
+        self.stft       = STFT(nfft=SPECTROGRAM_NFFT, hop=SPECTROGRAM_NFFT//2)
+        self.stft.subscribe(self._spectrogram)
+        self.display    = DoubleBuffer(draw_buffers)
+        self.period     = 1/fps
+        self.map_period = 1/map_rate
+
+        self.levels   = np.full(CHANNELS, LEVEL_FLOOR, dtype=np.float32)
+        self.spec     = np.full((SPECTROGRAM_NFFT//2, SPECTROGRAM_COLUMNS), SPECTROGRAM_RANGE[0], dtype=np.float32)
+        self.spec_col = 0
+        self.map_rgba = draw_buffers()["map"]
+        self.peak     = (0, 0)
+
+        self.audio    = 0.0 # Seconds of stream processed.
+        self.busy     = 0.0 # Seconds spent processing.
+        self._stop    = threading.Event()
+        self._thread  = threading.Thread(target=self._run, daemon=True)
+
+        self._decimate = metrics.stage("monitor.decimate")
+        self._levels   = metrics.stage("monitor.levels")
+        self._stft     = metrics.stage("monitor.stft")
+        self._map      = metrics.stage("monitor.map")
+        self._publish  = metrics.stage("monitor.publish")
+        metrics.counter("monitor.lost_groups",   lambda: self.sequence.lost)
+        metrics.counter("monitor.skipped_swaps", lambda: self.display.skipped)
+        metrics.gauge("monitor.load", lambda: self.busy/max(self.audio, 1e-9))
+
+    def start(self):
+        self.receiver.start()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.receiver.close()
+
+    def _run(self):
+        next_frame = next_map = time.perf_counter()
+        while not self._stop.is_set():
+            block = self.receiver.read(timeout=self.period, packed=True)
+            start = time.perf_counter()
+            if block is not None:
+                self.process(*block)
+            if start >= next_frame:
+                if start >= next_map:
+                    self.update_map()
+                    next_map = start + self.map_period
+                self.publish()
+                # Stay on the frame grid (frames land on block arrivals), resync after falling behind.
+                next_frame = max(next_frame + self.period, start)
+            self.busy += time.perf_counter() - start
+
+    def process(self, ids, packed):
+        self.sequence.update(ids)
+        with self._decimate:
+            pcm = self.decimator.process_packed(packed)
+        self._decimate.add(packed.nbytes)
+        n   = pcm.shape[1]
+        if not n:
+            return
+        self.audio += n/PCM_RATE
+
+        # Levels (AC RMS) with a slow fall back.
+        with self._levels:
+            rms    = np.std(pcm, axis=1)
+            levels = 20*np.log10(np.maximum(rms, 1e-5))
+            self.levels = np.maximum(levels, self.levels - LEVEL_DECAY*n/PCM_RATE)
+
+        with self._stft:
+            self.stft.process(pcm)
+
+    def _spectrogram(self, frames, first):
+        """STFT consumer: one spectrogram column per frame."""
+        mono = frames[:, self.channel] if self.channel >= 0 else frames.mean(axis=1)
+        spec = np.abs(mono[:, 1:])**2
+        cols = (self.spec_col + np.arange(len(frames))) % SPECTROGRAM_COLUMNS
+        self.spec[:, cols] = 10*np.log10(np.maximum(spec/SPECTROGRAM_NFFT, 1e-20)).T[::-1]
+        self.spec_col = (self.spec_col + len(frames)) % SPECTROGRAM_COLUMNS
+
+    def update_map(self):
+        if not self.stft.count:
+            return
+        with self._map:
+            power = self.srp.from_spectrum(self.stft.last()[0])
+        self.peak = np.unravel_index(power.argmax(), power.shape)
+        lo, hi = power.min(), power.max()
+        colormap((power - lo)/max(hi - lo, 1e-12), self.map_rgba)
+
+    def publish(self):
+        with self._publish:
+            back = self.display.back
+            back["levels"][:] = self.levels
+            lo, hi = SPECTROGRAM_RANGE
+            spec = np.roll(self.spec, -self.spec_col, axis=1) # Oldest column first.
+            colormap((spec - lo)/(hi - lo), back["spectrogram"])
+            back["map"][:] = self.map_rgba
+            self.display.swap()
+
+    def status(self):
+        peak_el, peak_az = self.peak
+        load = self.busy/max(self.audio, 1e-9)
+        return (f"Source: az {MAP_AZIMUTHS[peak_az]} deg, el {MAP_ELEVATIONS[peak_el]} deg | "
+                f"processing load {100*load:.0f}% | {self.sequence.lost} groups lost | "
+                f"{self.receiver.overruns} overruns | {self.display.skipped} skipped swaps")
+
+# Frame timing -------------------------------------------------------------------------------------
+
+class FrameTimer:
+    """Frame times as published by the processing thread, and the age of the data when displayed.
+
+    Frame times are the intervals between DoubleBuffer swaps, so a slow processing thread shows up
+    however fast the render loop runs. tick() is called on every render pass and only records the age
+    of versions it has not seen yet.
+    """
+    def __init__(self, display):
+        self.display = display
+        self.ages    = []
+        self.version = None
+
+    @property
+    def intervals(self):
+        return self.display.intervals
+
+    def tick(self, version, stamp):
+        if version == self.version or stamp is None:
+            return
+        self.ages.append(time.perf_counter() - stamp)
+        self.version = version
+
+    @property
+    def fps(self):
+        return len(self.intervals)/sum(self.intervals) if self.intervals else 0.0
+
+    def percentiles(self, q=(50, 90, 99, 100), values=None):
+        values = self.intervals if values is None else values
+        if not values:
+            return {}
+        return dict(zip(q, np.percentile(1e3*np.array(values), q)))
+
+    def report(self):
+        p = self.percentiles()
+        if not p:
+            return "No frames"
+        fmt = lambda p: ", ".join(f"{'max' if q == 100 else f'p{q}'} {v:.2f}" for q, v in p.items())
+        return f"{self.fps:.1f} fps, frame time (ms): {fmt(p)} | data age (ms): {fmt(self.percentiles(values=self.ages))}"
+
+# Rendering ----------------------------------------------------------------------------------------
+
+def run_headless(monitor, fps, duration):
+    """Render loop without a window: copies the front buffer at the frame rate like the GUI does."""
+    textures = draw_buffers()
+    timer    = FrameTimer(monitor.display)
+    version  = None
+    start    = time.perf_counter()
+    next_frame = start
+    while time.perf_counter() - start < duration:
+        version, stamp = monitor.display.read(textures, version)
+        timer.tick(version, stamp)
+        next_frame += 1/fps
+        delay = next_frame - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_frame = time.perf_counter()
+    return timer
+
+def run_gui(monitor):
+    import dearpygui.dearpygui as dpg
+
+    textures = draw_buffers()
+    timer    = FrameTimer(monitor.display)
+    version  = None
+    spec_h, spec_w = textures["spectrogram"].shape[:2]
+    map_h,  map_w  = textures["map"].shape[:2]
+
+    # Raw textures reference these arrays directly: they are updated in place between frames.
+    spec_tex = np.zeros(spec_h*spec_w*4, dtype=np.float32)
+    map_tex  = np.zeros(map_h*map_w*4,   dtype=np.float32)
+
+    dpg.create_context()
+    with dpg.texture_registry():
+        dpg.add_raw_texture(spec_w, spec_h, spec_tex, format=dpg.mvFormat_Float_rgba, tag="spectrogram")
+        dpg.add_raw_texture(map_w,  map_h,  map_tex,  format=dpg.mvFormat_Float_rgba, tag="map")
+    with dpg.window(tag="main"):
+        with dpg.plot(label=f"Levels (dB above {LEVEL_FLOOR:.0f} dBFS)", height=220, width=-1):
+            dpg.add_plot_axis(dpg.mvXAxis, label="Channel")
+            with dpg.plot_axis(dpg.mvYAxis):
+                dpg.set_axis_limits(dpg.last_item(), 0, -LEVEL_FLOOR)
+                dpg.add_bar_series(list(range(CHANNELS)), [0.0]*CHANNELS, weight=0.8, tag="levels")
+        dpg.add_text(f"Spectrogram (channel {monitor.channel if monitor.channel >= 0 else 'mix'}, 0-{PCM_RATE/2/1e3:.1f} kHz)")
+        dpg.add_image("spectrogram", width=3*spec_w, height=spec_h)
+        dpg.add_text(f"Direction map (azimuth 0-360 deg, elevation {MAP_ELEVATIONS[-1]}-0 deg)")
+        dpg.add_image("map", width=8*map_w, height=16*map_h)
+        dpg.add_text("", tag="status")
+        dpg.add_text("", tag="frames")
+
+    dpg.create_viewport(title="Kandinsky Monitor", width=820, height=900, vsync=True)
+    dpg.setup_dearpygui()
+    dpg.show_viewport()
+    dpg.set_primary_window("main", True)
+    while dpg.is_dearpygui_running():
+        updated, stamp = monitor.display.read(textures, version)
+        if updated != version:
+            version = updated
+            np.copyto(spec_tex, textures["spectrogram"].ravel())
+            np.copyto(map_tex,  textures["map"][::-1].ravel()) # Highest elevation on top.
+            dpg.set_value("levels", [list(range(CHANNELS)), (textures["levels"] - LEVEL_FLOOR).tolist()])
+            dpg.set_value("status", monitor.status())
+            if len(timer.ages) % 60 == 0:
+                dpg.set_value("frames", timer.report())
+        dpg.render_dearpygui_frame()
+        timer.tick(version, stamp)
+    dpg.destroy_context()
+    return timer
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Kandinsky live stream monitor")
+    parser.add_argument("--port",          default=UDP_PORT, type=int,   help="Stream UDP port")
+    parser.add_argument("--synthetic",     action="store_true",          help="Use a synthetic stream instead of the board")
+    parser.add_argument("--hub",           default=None,                 help="Read the stream from a host.hub Unix socket instead of the UDP port")
+    parser.add_argument("--positions",     default=None,                 help="Microphone positions JSON file")
+    parser.add_argument("--calibration",   default=None,                 help="Calibration file (see host.calibrate)")
+    parser.add_argument("--channel",       default=0,   type=int,        help="Spectrogram channel (-1: mix of all channels)")
+    parser.add_argument("--fps",           default=60,  type=float,      help="Display frame rate")
+    parser.add_argument("--map-rate",      default=15,  type=float,      help="Direction map update rate")
+    parser.add_argument("--block-packets", default=256, type=int,        help="Packets per capture block")
+    parser.add_argument("--headless",      action="store_true",          help="No window, report frame-time percentiles")
+    parser.add_argument("--duration",      default=10,  type=float,      help="Headless run duration (s)")
+    parser.add_argument("--strict",        action="store_true",          help="Headless: exit with an error below 30 fps or on capture losses")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args)
+
+    if args.synthetic:
+        from host.synth import SyntheticReceiver
+        receiver = SyntheticReceiver(block_packets=args.block_packets)
+    elif args.hub is not None:
+        from host.hub import HubReceiver
+        receiver = HubReceiver(args.hub)
+    else:
+        receiver = StreamReceiver(port=args.port, block_packets=args.block_packets)
+    calibration = None if args.calibration is None else load_calibration(args.calibration)
+    monitor = Monitor(receiver, load_positions(args.positions), fps=args.fps, map_rate=args.map_rate,
+        channel=args.channel, calibration=calibration).start()
+
+    try:
+        if args.headless:
+            timer = run_headless(monitor, args.fps, args.duration)
+        else:
+            timer = run_gui(monitor)
+    finally:
+        monitor.stop()
+    print(monitor.status())
+    print(timer.report())
+
+    if args.headless and args.strict:
+        p = timer.percentiles()
+        if not p or timer.fps < 30 or p[99] > 1e3/30 or monitor.receiver.overruns or monitor.sequence.lost:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+# Merge the streams of several boards into one time-aligned (boards*48, samples) array.
+#
+# Each board (distinct --ip/--mac/--port in main.py) runs on its own oscillator. Its clock is modelled
+# as host time = offset + group*period, fitted on the lower envelope of (packet_id, receive time)
+# pairs: the earliest arrival in each bucket has the least network/scheduling delay, and a line
+# through those gives the offset and the drift against the nominal PDM clock. Every board is decoded
+# and decimated on its own, then resampled (windowed-sinc, polyphase) onto the sample clock of the
+# first board. Reading is a k-way merge: the board whose buffered data ends earliest is read next, so
+# buffers stay bounded; a board falling more than `max_buffer` behind (or silent) is zero filled
+# rather than holding back the others.
+#
+# Receive timestamps align boards to within the delay jitter (a few us on a quiet link). Any constant
+# difference in link latency remains and shows up as per-channel delays in host.calibrate.
+
+import sys
+import time
+import argparse
+from collections import deque
+
+from host import lazy_import, metrics
+from host.array import fractional_delay
+from host.dsp import PDMDecimator, PCM_DECIMATION, PCM_RATE
+from host.export import MAX_GAP, fill_gaps, open_writer
+from host.stream import CHANNELS, PDM_CLK_FREQ, UDP_PORT, SequenceChecker, StreamReceiver, decode_packed
+
+np = lazy_import("numpy")
+
+MAX_BUFFER = 0.5   # Seconds a board may lead the slowest one before that one is zero filled.
+TAPS       = 32    # Resampler taps.
+PHASES     = 512   # Resampler fractional delay steps.
+MIN_BLOCK  = 256   # Output samples merged at once (unless a board stalls).
+
+# Clock model --------------------------------------------------------------------------------------
+
+class BoardClock:
+    """Host time of a board's PDM groups from the lower envelope of (group, receive time) pairs."""
+    def __init__(self, bucket=0.25, buckets=240):
+        self.bucket  = int(bucket*PDM_CLK_FREQ)
+        self.minima  = deque(maxlen=buckets) # [bucket, group, host time - group/PDM_CLK_FREQ]
+        self.offset  = None                  # Host time of group 0.
+        self.slope   = 0.0                   # Period error (s per group).
+
+    def update(self, group, stamp):
+        residual = stamp - group/PDM_CLK_FREQ
+        bucket   = group//self.bucket
+        if self.minima and self.minima[-1][0] == bucket:
+            if residual < self.minima[-1][2]:
+                self.minima[-1] = [bucket, group, residual]
+            return
+        self.minima.append([bucket, group, residual])
+        self.fit()
+
+    def fit(self):
+        closed = np.array(self.minima)[:-1] if len(self.minima) > 1 else np.array(self.minima)
+        g, r   = closed[:, 1], closed[:, 2]
+        if len(closed) >= 4:
+            g0 = g.mean()
+            self.slope  = ((g - g0)*(r - r.mean())).sum()/((g - g0)**2).sum()
+            self.offset = r.mean() - self.slope*g0
+        else:
+            self.offset = r.min()
+
+    @property
+    def drift(self):
+        """Fractional clock rate error (positive: board runs fast)."""
+        return -self.slope*PDM_CLK_FREQ/(1 + self.slope*PDM_CLK_FREQ)
+
+    def time(self, group):
+        return self.offset + group*(1/PDM_CLK_FREQ + self.slope)
+
+    def group(self, t):
+        return (t - self.offset)/(1/PDM_CLK_FREQ + self.slope)
+
+# Boards -------------------------------------------------------------------------------------------
+
+class Board:
+    """Decoded, decimated and clock-stamped stream of one board."""
+    def __init__(self, receiver, name="board"):
+        self.receiver  = receiver
+        self.clock     = BoardClock()
+        self.decimator = PDMDecimator()
+        self.checker   = SequenceChecker()
+        self.pcm       = np.zeros((CHANNELS, 0), dtype=np.float32)
+        self.start     = 0.0  # PCM index (group/PCM_DECIMATION) of pcm[:, 0].
+        self.last_id   = None
+        self.group     = 0    # Unwrapped group index of the last received group.
+        self.resets    = 0
+        self.underruns = 0    # Output samples zero filled.
+        self.stale     = False
+        self._feed     = metrics.stage(f"{name}.feed")
+        metrics.gauge(f"{name}.buffered_samples", lambda: self.pcm.shape[1])
+        metrics.counter(f"{name}.lost_groups", lambda: self.checker.lost)
+        metrics.counter(f"{name}.resets",      lambda: self.resets)
+        metrics.counter(f"{name}.zero_filled", lambda: self.underruns)
+
+    @property
+    def end(self):
+        """Host time up to which samples are buffered (-inf before the first block)."""
+        if self.clock.offset is None:
+            return -np.inf
+        return self.clock.time((self.start + self.pcm.shape[1])*PCM_DECIMATION)
+
+    def feed(self, payload, stamp):
+        if not len(payload):
+            return
+        with self._feed:
+            self._feed.add(len(payload))
+            self._decode(payload, stamp)
+
+    def _decode(self, payload, stamp):
+        ids, packed = decode_packed(payload)
+        first = 0 if self.last_id is None else self.group + (int(ids[0]) - self.last_id) % 2**32
+        if first <= self.group and self.last_id is not None:
+            return # Reordered or duplicated: the packets are already behind.
+        if self.last_id is None or first - self.group - 1 > MAX_GAP:
+            if self.last_id is not None:
+                self.resets += 1
+            self.decimator = PDMDecimator()
+            self.checker   = SequenceChecker()
+            self.pcm       = self.pcm[:, :0]
+            self.start     = first/PCM_DECIMATION
+        packed = fill_gaps(ids, packed, self.checker)
+        self.checker.update(ids)
+        self.last_id = int(ids[-1])
+        self.group   = first + (self.last_id - int(ids[0])) % 2**32
+        self.clock.update(self.group + 1, stamp)
+        self.pcm = np.concatenate([self.pcm, self.decimator.process_packed(packed)], axis=1)
+
+    def position(self, t):
+        """Fractional column of pcm sampled at host times t."""
+        return self.clock.group(t)/PCM_DECIMATION - self.start
+
+    def trim(self, column):
+        column = int(min(max(column, 0), self.pcm.shape[1]))
+        self.pcm    = self.pcm[:, column:]
+        self.start += column
+
+class Resampler:
+    """Windowed-sinc interpolation of (channels, n) samples at fractional positions."""
+    def __init__(self, taps=TAPS, phases=PHASES):
+        self.taps   = taps
+        self.phases = phases
+        # Row p interpolates x[i + p/phases] from x[i - taps/2 + 1 : i + taps/2 + 1].
+        self.table  = np.stack([fractional_delay(p/phases - 1, taps, taps//2) for p in range(phases + 1)]).astype(np.float32)
+
+    def __call__(self, x, position):
+        """Interpolate x at position (n,); positions without a full window are zero (returned count)."""
+        i       = np.floor(position).astype(np.int64)
+        phase   = np.rint((position - i)*self.phases).astype(np.int64)
+        first   = i - self.taps//2 + 1
+        valid   = (first >= 0) & (first + self.taps <= x.shape[1])
+        out     = np.zeros((x.shape[0], len(position)), dtype=np.float32)
+        if valid.any():
+            windows = np.lib.stride_tricks.sliding_window_view(x, self.taps, axis=1)[:, first[valid]]
+            out[:, valid] = np.einsum("cnt,nt->cn", windows, self.table[phase[valid]])
+        return out, int((~valid).sum())
+
+# Merger -------------------------------------------------------------------------------------------
+
+class BoardMerger:
+    """k-way merge of several board receivers into (boards*CHANNELS, n) blocks on board 0's clock.
+
+    Receivers are StreamReceiver-like (read_raw/release); the first one is the reference and must be
+    streaming for any output to be produced.
+    """
+    def __init__(self, receivers, max_buffer=MAX_BUFFER, taps=TAPS):
+        self.boards     = [Board(r, f"board{k}") for k, r in enumerate(receivers)]
+        self.max_buffer = max_buffer
+        self.resampler  = Resampler(taps)
+        self.next       = None # Next output sample (board 0 PCM index).
+        self.samples    = 0
+        self._resample  = metrics.stage("multiboard.resample")
+
+    def start(self):
+        for board in self.boards:
+            board.receiver.start()
+        return self
+
+    def close(self):
+        for board in self.boards:
+            board.receiver.close()
+
+    def _pull(self, board, timeout):
+        raw = board.receiver.read_raw(timeout)
+        if raw is None:
+            return False
+        try:
+            board.feed(raw[1], raw[2])
+        finally:
+            board.receiver.release(raw[0])
+        return True
+
+    def read(self, timeout=0.1):
+        """Next merged block, None if nothing could be merged within timeout."""
+        while True:
+            for board in self.boards:
+                if board.stale:
+                    self._pull(board, 0) # Stale boards are polled, never waited for.
+            live    = [b for b in self.boards if not b.stale] or self.boards
+            laggard = min(live, key=lambda b: b.end)
+            if not self._pull(laggard, timeout):
+                self._update_stale(force=laggard)
+                return self._merge(1)
+            out = self._merge()
+            if out is not None:
+                return out
+
+    def _update_stale(self, force=None):
+        ends = [b.end for b in self.boards]
+        head = max(ends)
+        for board, end in zip(self.boards, ends):
+            board.stale = head > -np.inf and (end < head - self.max_buffer or (board is force and end < head))
+
+    def _merge(self, min_block=MIN_BLOCK):
+        self._update_stale()
+        reference = self.boards[0].clock
+        live = [b for b in self.boards if not b.stale and b.clock.offset is not None]
+        if reference.offset is None or not live:
+            return None
+        if self.next is None:
+            if any(b.clock.offset is None and not b.stale for b in self.boards):
+                return None
+            # Start once every board has data (or is given up on), where the latest one starts.
+            start     = max(b.clock.time((b.start + self.resampler.taps)*PCM_DECIMATION) for b in live)
+            self.next = int(np.ceil(reference.group(start)/PCM_DECIMATION))
+        half  = self.resampler.taps//2
+        limit = min(reference.group(b.clock.time((b.start + b.pcm.shape[1] - half)*PCM_DECIMATION))/PCM_DECIMATION
+                    for b in live)
+        n = int(np.floor(limit)) - self.next
+        if n < min_block:
+            return None
+        t   = reference.time((self.next + np.arange(n))*PCM_DECIMATION)
+        out = np.empty((len(self.boards)*CHANNELS, n), dtype=np.float32)
+        with self._resample:
+            for k, board in enumerate(self.boards):
+                if board.clock.offset is None:
+                    out[k*CHANNELS:(k + 1)*CHANNELS] = 0
+                    board.underruns += n
+                    continue
+                position = board.position(t)
+                out[k*CHANNELS:(k + 1)*CHANNELS], missing = self.resampler(board.pcm, position)
+                board.underruns += missing
+                board.trim(np.floor(position[-1]) - half)
+                # Bound the buffer of a board that is ahead of a stalled merge.
+                board.trim(board.pcm.shape[1] - 2*self.max_buffer*PCM_RATE)
+        self._resample.add(out.nbytes)
+        self.next    += n
+        self.samples += n
+        return out
+
+    def status(self):
+        return " | ".join(
+            f"board {k}: drift {1e6*b.clock.drift:+.1f} ppm, {b.checker.lost} groups lost, {b.resets} resets, "
+            f"{b.underruns} zero filled, {b.receiver.overruns} overruns"
+            for k, b in enumerate(self.boards))
+
+# Synthetic check ----------------------------------------------------------------------------------
+
+def check_synthetic(boards=3, seconds=10.0, drift_ppm=50.0, loss=0.01, settle=2.0, tone=1000.0):
+    """Merge synthetic boards with injected drift, offsets and packet loss, return the per-board drift
+    estimation error (ppm) and residual misalignment (us) of the merged tone against board 0."""
+    from host.synth import SyntheticBoard
+
+    rng     = np.random.default_rng(1)
+    drifts  = np.concatenate([[0.0], rng.uniform(-drift_ppm, drift_ppm, boards - 1)*1e-6])
+    offsets = rng.uniform(0, 5e-3, boards)
+    sources = [SyntheticBoard(drift=d, offset=o, loss=loss, first_id=int(rng.integers(2**32)), tone=(tone, 0.5),
+        seed=k) for k, (d, o) in enumerate(zip(drifts, offsets))]
+    merger  = BoardMerger(sources).start()
+    blocks  = []
+    start   = time.perf_counter()
+    while merger.samples < seconds*PCM_RATE:
+        out = merger.read()
+        if out is not None:
+            blocks.append(out)
+    elapsed = time.perf_counter() - start
+    merged  = np.concatenate(blocks, axis=1)[:, int(settle*PCM_RATE):]
+
+    # Relative tone phase of each board's channel 0 against board 0.
+    z     = merged[::CHANNELS] @ np.exp(-2j*np.pi*tone*np.arange(merged.shape[1])/PCM_RATE)
+    skew  = 1e6*np.angle(z*np.conj(z[0]))/(2*np.pi*tone)
+    error = np.array([1e6*(b.clock.drift - d) for b, d in zip(merger.boards, drifts)])
+    print(f"{boards} boards, {merged.shape[1]/PCM_RATE:.1f} s merged into {merged.shape[0]} channels "
+          f"({seconds/elapsed:.1f}x real time)")
+    for k, board in enumerate(merger.boards):
+        print(f"  board {k}: drift {1e6*drifts[k]:+7.2f} ppm, estimated {1e6*board.clock.drift:+7.2f} ppm, "
+              f"skew {skew[k]:+6.1f} us, {board.checker.lost} groups lost, {board.underruns} zero filled")
+    merger.close()
+    return error, skew
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the streams of several Kandinsky boards")
+    parser.add_argument("--ports",         default=str(UDP_PORT),          help="Comma separated UDP ports, one per board")
+    parser.add_argument("--duration",      default=10.0, type=float,       help="Duration (s)")
+    parser.add_argument("--output",        default=None,                   help="Merged .wav or .flac file")
+    parser.add_argument("--sample-format", default="s16",                  help="Output sample format")
+    parser.add_argument("--max-buffer",    default=MAX_BUFFER, type=float, help="Lead (s) before a slow board is zero filled")
+    parser.add_argument("--synthetic",     default=None, type=int,         help="Merge N synthetic boards with drift and loss")
+    parser.add_argument("--drift-ppm",     default=50.0, type=float,       help="Synthetic: maximum clock drift (ppm)")
+    parser.add_argument("--loss",          default=0.01, type=float,       help="Synthetic: packet loss probability")
+    parser.add_argument("--strict",        action="store_true",            help="Synthetic: exit with an error on drift error > 1 ppm or skew > 10 us")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.setup(args)
+
+    if args.synthetic is not None:
+        error, skew = check_synthetic(args.synthetic, args.duration, args.drift_ppm, args.loss)
+        if args.strict and (np.abs(error).max() > 1 or np.abs(skew).max() > 10):
+            sys.exit(1)
+        return
+
+    ports  = [int(p) for p in args.ports.split(",")]
+    merger = BoardMerger([StreamReceiver(port=p, name=f"board{k}.receiver") for k, p in enumerate(ports)],
+        max_buffer=args.max_buffer).start()
+    writer = None if args.output is None else open_writer(args.output, len(ports)*CHANNELS, PCM_RATE, args.sample_format)
+    start  = last = time.time()
+    try:
+        while time.time() - start < args.duration:
+            out = merger.read()
+            if out is not None and writer is not None:
+                writer.write(out)
+            if time.time() - last >= 1.0:
+                last = time.time()
+                print(f"{merger.samples/PCM_RATE:.1f} s merged | {merger.status()}")
+    finally:
+        merger.close()
+        if writer is not None:
+            writer.close()
+
+if __name__ == "__main__":
+    main()
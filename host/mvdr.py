@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+# Adaptive frequency domain MVDR (Capon) beams.
+#
+# All channels go through the shared STFT (host/stft.py, square root Hann analysis and synthesis
+# windows). Each bin of the band keeps a spatial covariance matrix, updated recursively from the new
+# frames of every block with an exponential forgetting factor. Every `update` frames the matrices are
+# diagonally loaded and the weights R^-1 d / (d^H R^-1 d) of all look directions d (unit gain towards
+# d, least output power from other directions) are computed from one factorization per bin: an LU
+# solve with the beams as right-hand sides for fewer beams than channels, else the inverse Cholesky
+# factor L^-1 applied to all of them (y = L^-1 d, w = L^-H y / |y|^2). Bins outside the band keep
+# delay-and-sum weights. All of this is batched NumPy linear algebra over bins, split into bin ranges
+# on a thread pool (LAPACK and matmul release the GIL).
+
+import os
+import time
+import argparse
+
+from host import lazy_import
+from host.array import default_positions, delays, directions_list
+from host.dsp import PCM_RATE
+from host.stft import STFT
+
+np      = lazy_import("numpy")
+futures = lazy_import("concurrent.futures")
+
+# Beamformer ---------------------------------------------------------------------------------------
+
+def sqrt_hann(nfft):
+    return np.sqrt(0.5 - 0.5*np.cos(2*np.pi*np.arange(nfft)/nfft))
+
+class MVDR:
+    """Streaming MVDR beams over (channels, samples) PCM blocks, (beams, samples) out.
+
+    The output is delayed by nfft samples and has as many samples as the input, like DelayAndSum.
+    `memory` is the covariance time constant (s) and `loading` the diagonal loading relative to the
+    mean microphone power. `calibration` is an optional (delays, gains) pair from host.calibrate.
+    With `adapt` False the weights are frozen.
+    """
+    def __init__(self, positions, rate, beams, nfft=512, hop=256, band=(300, 6000), memory=0.5, loading=1e-2,
+                 update=4, calibration=None, workers=None):
+        assert nfft % hop == 0
+        channels     = len(positions)
+        window       = sqrt_hann(nfft)
+        self.nfft    = nfft
+        self.hop     = hop
+        self.stft    = STFT(channels, nfft, hop, window=window)
+        self.synth   = (window/(window**2).reshape(-1, hop).sum(axis=0).repeat(nfft//hop)).astype(np.float32)
+        self.forget  = np.exp(-hop/(rate*memory))
+        self.loading = loading
+        self.update  = update
+        self.adapt   = True
+        freqs        = np.fft.rfftfreq(nfft, 1/rate)
+        self.band    = np.flatnonzero((freqs >= band[0]) & (freqs <= band[1]))
+        tau          = delays(positions, directions_list(beams))                     # (beams, chans).
+        gains        = np.ones(channels)
+        if calibration is not None:
+            tau, gains = tau + calibration[0], np.asarray(calibration[1])
+        # Steering vectors: the spectrum of a unit plane wave from each beam direction, (bins, beams, chans).
+        steer        = np.exp(-2j*np.pi*freqs[:, None, None]*tau[None])/gains
+        self.steer   = steer.astype(np.complex64)
+        self.weights = (steer/(np.abs(steer)**2).sum(axis=2, keepdims=True)).conj().astype(np.complex64)
+        self.cov     = np.zeros((len(self.band), channels, channels), dtype=np.complex64)
+        self.pending = 0 # Frames since the last weights update.
+        self.output  = np.zeros((len(beams), nfft), dtype=np.float32) # Samples not yet read (latency).
+        self.overlap = np.zeros((len(beams), nfft - hop), dtype=np.float32)
+        self.workers = workers or os.cpu_count() or 1
+        self.pool    = futures.ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+        n            = -(-len(self.band)//self.workers)
+        self.chunks  = [slice(i, min(i + n, len(self.band))) for i in range(0, len(self.band), n)]
+
+    def _bins(self, chunk, frames, solve):
+        """Covariance update and, if solve, new weights of the band bins in chunk."""
+        x = frames[:, self.band[chunk]].transpose(1, 2, 0)                           # (bins, chans, frames).
+        n = x.shape[2]
+        scale = ((1 - self.forget)*self.forget**np.arange(n - 1, -1, -1)).astype(np.float32)
+        self.cov[chunk] *= self.forget**n
+        self.cov[chunk] += (x*scale) @ x.conj().transpose(0, 2, 1)
+        if not solve:
+            return
+        cov   = self.cov[chunk]
+        power = np.trace(cov, axis1=1, axis2=2).real/cov.shape[1]
+        load  = self.loading*power + 1e-12
+        cov   = cov + load[:, None, None]*np.eye(cov.shape[1], dtype=np.complex64)
+        d     = self.steer[self.band[chunk]].transpose(0, 2, 1)                      # (bins, chans, beams).
+        if d.shape[2] < d.shape[1]:
+            # One LU factorization per bin, the beams are its right-hand sides.
+            w = np.linalg.solve(cov, d)
+            w = w/(d.conj()*w).sum(axis=1, keepdims=True).real
+        else:
+            # Inverse Cholesky factor, shared by all beams through matrix products.
+            linv = np.linalg.inv(np.linalg.cholesky(cov))
+            y    = linv @ d
+            w    = linv.conj().transpose(0, 2, 1) @ (y/(np.abs(y)**2).sum(axis=1, keepdims=True))
+        self.weights[self.band[chunk]] = w.conj().transpose(0, 2, 1)
+
+    def process(self, x):
+        out = []
+        # Chunks of at most the STFT ring of frames.
+        step = self.stft.ring*self.hop
+        for i in range(0, x.shape[1], step):
+            n = self.stft.process(x[:, i:i + step])
+            if n:
+                out.append(self._frames(self.stft.last(n)))
+        self.output = np.concatenate([self.output] + out, axis=1)
+        y, self.output = self.output[:, :x.shape[1]], self.output[:, x.shape[1]:]
+        return y
+
+    def _frames(self, frames):
+        """(beams, n*hop) output samples completed by n new (n, chans, bins) frames."""
+        frames = frames.transpose(0, 2, 1)                                           # (n, bins, chans).
+        if self.adapt and len(self.band):
+            self.pending += len(frames)
+            solve = self.pending >= self.update
+            if solve:
+                self.pending = 0
+            if self.pool is None:
+                self._bins(slice(None), frames, solve)
+            else:
+                list(self.pool.map(lambda chunk: self._bins(chunk, frames, solve), self.chunks))
+        beams  = self.weights @ frames.transpose(1, 2, 0)                            # (bins, beams, n).
+        blocks = np.fft.irfft(beams.transpose(2, 1, 0), self.nfft, axis=-1)*self.synth
+        out    = np.empty((blocks.shape[1], len(blocks)*self.hop), dtype=np.float32)
+        tail   = self.overlap
+        for k, block in enumerate(blocks):
+            block[:, :tail.shape[1]] += tail
+            out[:, k*self.hop:(k + 1)*self.hop] = block[:, :self.hop]
+            tail = block[:, self.hop:]
+        self.overlap = tail
+        return out
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+# Synthetic ----------------------------------------------------------------------------------------
+
+def plane_waves(positions, rate, samples, sources, band=(300, 6000), seed=0):
+    """Band-limited noise plane waves [(azimuth, elevation, rms), ...] on the array.
+
+    Returns each source's (channels, samples) PCM on the array and its signal at the array origin.
+    """
+    rng   = np.random.default_rng(seed)
+    freqs = np.fft.rfftfreq(samples, 1/rate)
+    mask  = (freqs >= band[0]) & (freqs <= band[1])
+    waves, refs = [], []
+    for azimuth, elevation, rms in sources:
+        spectrum  = np.where(mask, np.exp(2j*np.pi*rng.random(len(freqs))), 0)
+        spectrum *= rms/np.sqrt((np.abs(spectrum)**2).sum()*2/samples**2)
+        tau       = delays(positions, directions_list([(azimuth, elevation)]))[0]
+        waves.append(np.fft.irfft(spectrum*np.exp(-2j*np.pi*freqs*tau[:, None]), samples).astype(np.float32))
+        refs.append(np.fft.irfft(spectrum, samples))
+    return waves, refs
+
+def check_synthetic(target=(45, 30), interferer=(200, 10), ratio=20, noise=0.01, seconds=4.0, nfft=512, workers=None,
+                    strict=False):
+    """Suppression of a `ratio` dB stronger interferer by MVDR vs delay-and-sum, target gain."""
+    positions   = default_positions()
+    samples     = int(seconds*PCM_RATE)
+    alone, refs = plane_waves(positions, PCM_RATE, samples, [(*target, 1.0), (*interferer, 10**(ratio/20))])
+    sensors     = noise*np.random.default_rng(1).standard_normal(alone[0].shape).astype(np.float32)
+    mixture     = alone[0] + alone[1] + sensors
+
+    mvdr  = MVDR(positions, PCM_RATE, [target], nfft=nfft, hop=nfft//2, workers=workers)
+    start = time.perf_counter()
+    mvdr.process(mixture)
+    elapsed = time.perf_counter() - start
+    mvdr.close()
+
+    skip = samples//2 # Converged half, past the output latency.
+    def powers(weights):
+        """Output powers of each source alone through fixed weights (None: delay-and-sum)."""
+        out = []
+        for signal in alone:
+            beamformer = MVDR(positions, PCM_RATE, [target], nfft=nfft, hop=nfft//2, workers=1)
+            beamformer.adapt = False
+            if weights is not None:
+                beamformer.weights = weights
+            out.append(beamformer.process(signal)[0, skip:])
+        return [np.mean(o**2) for o in out], out[0]
+    print(f"Target {target}, interferer {interferer} {ratio} dB stronger, {seconds:.0f} s at {PCM_RATE:.0f} Hz "
+          f"({elapsed/seconds:.2f} s/s MVDR adaptation)")
+    results = {}
+    for name, weights in (("delay-and-sum", None), ("MVDR", mvdr.weights)):
+        (target_power, interferer_power), out = powers(weights)
+        ref  = refs[0][skip - nfft:samples - nfft]
+        gain = 10*np.log10(target_power/np.mean(ref**2))
+        err  = 10*np.log10(np.mean((out - ref)**2)/np.mean(ref**2))
+        sir  = 10*np.log10(target_power/interferer_power)
+        results[name] = (sir, gain)
+        print(f"  {name:14s} output SIR {sir:6.1f} dB (input {-ratio:.0f} dB), target gain {gain:+5.2f} dB, "
+              f"target error {err:6.1f} dB")
+    gain = results["MVDR"][0] - results["delay-and-sum"][0]
+    print(f"  MVDR suppression over delay-and-sum: {gain:.1f} dB")
+    if strict and (gain < 10 or abs(results["MVDR"][1]) > 1):
+        raise SystemExit("MVDR does not suppress the interferer by 10 dB over delay-and-sum with unit target gain")
+
+# Benchmark ----------------------------------------------------------------------------------------
+
+def benchmark(nffts=(256, 512, 1024), seconds=2.0, max_beams=1024, update=4, workers=None):
+    """Largest number of beams formed in real time (doubling) for each FFT size."""
+    positions = default_positions()
+    rng       = np.random.default_rng(0)
+    pcm       = rng.standard_normal((len(positions), int(seconds*PCM_RATE))).astype(np.float32)
+    block     = 1024
+    print(f"{len(positions)} channels at {PCM_RATE:.0f} Hz, {seconds:.0f} s, weights every {update} frames, "
+          f"{workers or os.cpu_count()} workers")
+    for nfft in nffts:
+        best  = None
+        beams = 1
+        while beams <= max_beams:
+            grid  = [(az, el) for el in (10, 30, 50, 70) for az in np.linspace(0, 360, -(-beams//4), endpoint=False)][:beams]
+            mvdr  = MVDR(positions, PCM_RATE, grid, nfft=nfft, hop=nfft//2, update=update, workers=workers)
+            start = time.perf_counter()
+            for i in range(0, pcm.shape[1], block):
+                mvdr.process(pcm[:, i:i + block])
+            load  = (time.perf_counter() - start)/seconds
+            mvdr.close()
+            bins  = len(mvdr.band)
+            print(f"  nfft {nfft:4d}: {beams:4d} beams x {bins:3d} bins = {beams*bins:6d} beam-bins: {load:6.2f} s/s")
+            if load > 1:
+                break
+            best   = (beams, bins)
+            beams *= 2
+        if best is None:
+            print(f"  nfft {nfft:4d}: not real time with one beam")
+        else:
+            print(f"  nfft {nfft:4d}: {best[0]*best[1]} beam-bins ({best[0]} beams x {best[1]} bins) in real time")
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="MVDR beamformer check and benchmark")
+    parser.add_argument("--synthetic", action="store_true",              help="Interferer suppression vs delay-and-sum on a synthetic array signal")
+    parser.add_argument("--strict",    action="store_true",              help="Exit with an error when the suppression is below 10 dB")
+    parser.add_argument("--benchmark", action="store_true",              help="Beams x bins formed in real time")
+    parser.add_argument("--nfft",      default=None,  type=int,          help="FFT size (default: 512, benchmark 256/512/1024)")
+    parser.add_argument("--seconds",   default=None,  type=float,        help="Signal duration (default: 4, benchmark 2)")
+    parser.add_argument("--update",    default=4,     type=int,          help="Frames between weights updates")
+    parser.add_argument("--workers",   default=None,  type=int,          help="Threads (default: one per core)")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark((args.nfft,) if args.nfft else (256, 512, 1024), args.seconds or 2.0, update=args.update, workers=args.workers)
+    else:
+        check_synthetic(seconds=args.seconds or 4.0, nfft=args.nfft or 512, workers=args.workers, strict=args.strict)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# Pin identification from ios_stream.py captures.
+#
+# With the ios_stream.py bitstream every FPGA pad transmits its own ball name ("A10\n", then one idle
+# character time, repeated) as 8N1 UART. Probing the board's connectors and test points with a logic
+# analyzer or USB serial adapters and decoding the channels gives the connector to ball map.
+#
+# Logic captures are decoded on all channels at once: each step follows one UART frame on every
+# channel with vector operations (sample the 10 bit centers, check the framing, jump to the next start
+# edge), so decoding costs a loop over frames, not over channels and samples. Serial ports are read
+# concurrently on one thread each.
+
+import os
+import re
+import json
+import time
+import zipfile
+import argparse
+import threading
+from collections import Counter
+
+from host import lazy_import
+
+np = lazy_import("numpy")
+
+BAUDRATE   = 115200
+NAME_CHARS = 4              # ROM characters per pad: name padded with spaces, then "\n".
+SLOTS      = NAME_CHARS + 1 # Character times per repetition: the ROM characters and one idle.
+FRAME_BITS = 10             # Start, 8 data bits (LSB first), stop.
+MIN_COUNT  = 3              # Repetitions of a name needed to identify a channel.
+MIN_RATIO  = 0.8            # Fraction of the decoded names that must agree.
+
+# Stream format ------------------------------------------------------------------------------------
+
+def name_text(name):
+    """ROM characters of a pad (shared with the gateware)."""
+    assert len(name) < NAME_CHARS
+    return name.ljust(NAME_CHARS - 1) + "\n"
+
+def levels(names, t, baudrate=BAUDRATE):
+    """(len(names), len(t)) line levels of the pads at times t (s) since the first start bit, as the
+    gateware drives them: all pads switch on the same baud ticks."""
+    ticks = np.floor(np.asarray(t)*baudrate).astype(np.int64)
+    bit   = ticks % FRAME_BITS
+    slot  = ticks // FRAME_BITS % SLOTS
+    text  = np.array([[ord(c) for c in name_text(name)] for name in names], dtype=np.uint16)
+    frame = np.pad((text << 1) | (1 << 9), ((0, 0), (0, 1)), constant_values=0x3ff) # Start 0, stop 1, idle.
+    out   = (frame[:, slot] >> bit) & 1
+    out[:, ticks < 0] = 1
+    return out.astype(np.uint8)
+
+# Logic decoder ------------------------------------------------------------------------------------
+
+def decode_uart(samples, samplerate, baudrate=BAUDRATE):
+    """Decode (channels, n) 0/1 samples of 8N1 UART lines: returns the received bytes per channel.
+
+    Decoding starts on each channel at the first start edge after a full idle frame and then follows
+    the stream frame by frame; a framing error falls back to the next start edge after an idle frame.
+    """
+    samples = np.ascontiguousarray(samples, dtype=np.uint8)
+    channels, n = samples.shape
+    spb     = samplerate/baudrate
+    if spb < 3:
+        raise ValueError(f"{samplerate} Hz sampling is too slow for {baudrate} baud (3 samples per bit needed)")
+    stride  = n - 1
+    fall    = np.flatnonzero(samples[:, :-1] > samples[:, 1:])   # Keys ch*stride + t: x[t] = 1, x[t + 1] = 0.
+    rise    = np.flatnonzero(samples[:, :-1] < samples[:, 1:])
+    # Start edges after an idle frame: the line has been high for FRAME_BITS bits (or since the start).
+    before  = rise[np.maximum(np.searchsorted(rise, fall) - 1, 0)] if len(rise) else np.full(len(fall), -1)
+    base    = fall//stride*stride
+    before  = np.where((before >= base) & (before < fall), before, base - 1)
+    sync    = fall[fall - before >= (FRAME_BITS - 0.5)*spb]
+
+    offsets = (np.arange(FRAME_BITS) + 0.5)*spb
+    weights = 1 << np.arange(8)
+    ch      = np.arange(channels)
+    frame   = (FRAME_BITS - 0.5)*spb
+
+    def first(keys, after):
+        """First key at or after `after` (ch*stride + t) on the same channel, or -1."""
+        i = np.minimum(np.searchsorted(keys, after), len(keys) - 1)
+        k = keys[i] if len(keys) else np.full(len(after), -1)
+        return np.where((len(keys) > 0) & (k >= after) & (k < (after//stride + 1)*stride), k, -1)
+
+    edge = first(sync, ch*stride)
+    got  = []
+    while True:
+        active = np.flatnonzero((edge >= 0) & (edge % stride + 0.5 + FRAME_BITS*spb < n))
+        if not len(active):
+            break
+        t      = edge[active] % stride + 0.5
+        bits   = samples[active[:, None], np.rint(t[:, None] + offsets).astype(np.int64)]
+        valid  = (bits[:, 0] == 0) & (bits[:, -1] == 1)
+        value  = bits[:, 1:9] @ weights
+        got.append((active[valid], value[valid]))
+        after  = active*stride + np.ceil(t + frame).astype(np.int64)
+        edge[active] = np.where(valid, first(fall, after), first(sync, after))
+    received = np.concatenate([c for c, v in got] + [np.zeros(0, dtype=np.int64)])
+    values   = np.concatenate([v for c, v in got] + [np.zeros(0, dtype=np.int64)]).astype(np.uint8)
+    order    = np.argsort(received, kind="stable")
+    split    = np.searchsorted(received[order], np.arange(1, channels))
+    return [v.tobytes() for v in np.split(values[order], split)]
+
+# Captures -----------------------------------------------------------------------------------------
+
+def parse_rate(text):
+    value, unit = re.fullmatch(r"\s*([\d.]+)\s*([kMG]?)(Hz)?\s*", text).group(1, 2)
+    return float(value)*{"": 1, "k": 1e3, "M": 1e6, "G": 1e9}[unit]
+
+def unpack_logic(data, unitsize, probes):
+    """(probes, n) samples from packed little endian samples of `unitsize` bytes."""
+    raw = np.frombuffer(data, dtype=np.uint8)
+    raw = raw[:len(raw)//unitsize*unitsize].reshape(-1, unitsize)
+    return np.unpackbits(raw, axis=1, bitorder="little")[:, :probes].T
+
+def read_sigrok(filename):
+    """(names, samples, samplerate) of a sigrok session (.sr) file."""
+    with zipfile.ZipFile(filename) as z:
+        meta = {}
+        for line in z.read("metadata").decode().splitlines():
+            if "=" in line:
+                key, value = line.split("=", 1)
+                meta[key.strip()] = value.strip()
+        probes = int(meta["total probes"])
+        names  = [meta.get(f"probe{i + 1}", f"D{i}") for i in range(probes)]
+        prefix = meta.get("capturefile", "logic-1")
+        chunks = sorted((n for n in z.namelist() if n == prefix or n.startswith(prefix + "-")),
+                        key=lambda n: int(n.rsplit("-", 1)[1]) if n != prefix else 0)
+        data   = b"".join(z.read(n) for n in chunks)
+    return names, unpack_logic(data, int(meta.get("unitsize", 1)), probes), parse_rate(meta["samplerate"])
+
+def read_serial(ports, seconds, baudrate=BAUDRATE):
+    """Bytes received on each serial port during `seconds`, ports read concurrently."""
+    import serial
+
+    out = {}
+    def run(port):
+        with serial.Serial(port, baudrate, timeout=0.1) as s:
+            data = bytearray()
+            end  = time.monotonic() + seconds
+            while time.monotonic() < end:
+                data += s.read(4096)
+            out[port] = bytes(data)
+    threads = [threading.Thread(target=run, args=(p,)) for p in ports]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return [out.get(p, b"") for p in ports]
+
+# Pin map ------------------------------------------------------------------------------------------
+
+def identify(data, known=None, min_count=MIN_COUNT, min_ratio=MIN_RATIO):
+    """(name, count, ratio) of the pad name repeated in received bytes, name None if not identified."""
+    tokens = data.decode("ascii", "replace").split()
+    if known is not None:
+        tokens = [t for t in tokens if t in known]
+    if not tokens:
+        return None, 0, 0.0
+    name, count = Counter(tokens).most_common(1)[0]
+    ratio = count/len(tokens)
+    return (name if count >= min_count and ratio >= min_ratio else None), count, ratio
+
+def pin_map(channels, received, known=None, min_count=MIN_COUNT):
+    """{channel: pad name or None} and a per channel report."""
+    mapping, report = {}, []
+    for channel, data in zip(channels, received):
+        name, count, ratio = identify(data, known, min_count)
+        mapping[channel] = name
+        report.append(f"{channel:>16}: {name or '?':<4} ({count} names, {100*ratio:.0f}% agree, {len(data)} bytes)")
+    return mapping, report
+
+def load_pads(iodb="iodb.json", package="CABGA256"):
+    with open(iodb) as f:
+        return list(json.load(f)["packages"][package].keys())
+
+# Synthetic check ----------------------------------------------------------------------------------
+
+def check_synthetic(channels=64, samplerate=1e6, baudrate=BAUDRATE, seconds=0.05, seed=0):
+    """Decode synthetic probed pads (random capture start, per channel skew and glitches, some
+    unconnected channels) and compare the map with the truth."""
+    rng   = np.random.default_rng(seed)
+    pads  = load_pads() if os.path.exists("iodb.json") else [f"{r}{c}" for r in "ABCDEFGHJKLMNPRT" for c in range(1, 17)]
+    names = list(rng.choice(pads, channels, replace=False))
+    t     = rng.uniform(0, 1) + np.arange(int(seconds*samplerate))/samplerate
+    skew  = rng.uniform(0, 0.2/baudrate, channels)
+    x     = np.stack([levels([name], t - s, baudrate)[0] for name, s in zip(names, skew)])
+    flips = rng.random(x.shape) < 1e-5
+    x[flips] ^= 1
+    floating = rng.choice(channels, channels//8, replace=False)
+    x[floating] = rng.random((len(floating), x.shape[1])) < 0.5
+    truth = [None if c in floating else name for c, name in enumerate(names)]
+
+    start    = time.time()
+    received = decode_uart(x, samplerate, baudrate)
+    elapsed  = time.time() - start
+    mapping, report = pin_map(range(channels), received, set(pads))
+    wrong = [c for c in range(channels) if mapping[c] != truth[c]]
+    print(f"Decoded {channels} channels x {x.shape[1]} samples ({seconds*1e3:.0f} ms at {samplerate/1e6:g} MHz) in "
+          f"{1e3*elapsed:.0f} ms: {channels - len(wrong)}/{channels} channels mapped correctly")
+    for c in wrong:
+        print(f"  channel {c}: expected {truth[c]}, got {mapping[c]}")
+    return not wrong
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Pin map from ios_stream.py logic or serial captures")
+    parser.add_argument("captures",     nargs="*",                   help="sigrok .sr sessions, raw logic (with --samplerate) or received serial bytes")
+    parser.add_argument("--serial",     default=None,                help="Read these serial ports concurrently, e.g. /dev/ttyUSB0,/dev/ttyUSB1")
+    parser.add_argument("--seconds",    default=2.0, type=float,     help="Serial read duration (s)")
+    parser.add_argument("--samplerate", default=None, type=parse_rate, help="Raw logic capture sample rate, e.g. 24MHz")
+    parser.add_argument("--unitsize",   default=1, type=int,         help="Raw logic capture bytes per sample")
+    parser.add_argument("--baudrate",   default=BAUDRATE, type=int,  help="ios_stream.py UART baudrate")
+    parser.add_argument("--iodb",       default="iodb.json",         help="Pad database (only its names are accepted)")
+    parser.add_argument("--output",     default=None,                help="Write the {channel: pad} map to this JSON file")
+    parser.add_argument("--synthetic",  default=None, type=int,      help="Decode N synthetic probed channels and check the map")
+    parser.add_argument("--strict",     action="store_true",         help="Synthetic: exit with an error on any wrong channel")
+    args = parser.parse_args()
+
+    if args.synthetic is not None:
+        ok = check_synthetic(args.synthetic, baudrate=args.baudrate)
+        if args.strict and not ok:
+            raise SystemExit("Synthetic pin map check failed")
+        return
+
+    channels, received = [], []
+    for filename in args.captures:
+        base = os.path.basename(filename)
+        if filename.endswith(".sr") or args.samplerate is not None:
+            if filename.endswith(".sr"):
+                names, samples, rate = read_sigrok(filename)
+            else:
+                with open(filename, "rb") as f:
+                    samples = unpack_logic(f.read(), args.unitsize, 8*args.unitsize)
+                names, rate = [f"D{i}" for i in range(len(samples))], args.samplerate
+            channels += [f"{base}:{name}" for name in names]
+            received += decode_uart(samples, rate, args.baudrate)
+        else:
+            with open(filename, "rb") as f:
+                channels.append(base)
+                received.append(f.read())
+    if args.serial is not None:
+        ports     = args.serial.split(",")
+        channels += ports
+        received += read_serial(ports, args.seconds, args.baudrate)
+    if not channels:
+        parser.error("Captures, --serial or --synthetic required")
+
+    known = set(load_pads(args.iodb)) if os.path.exists(args.iodb) else None
+    mapping, report = pin_map(channels, received, known)
+    print("\n".join(report))
+    print(f"{sum(name is not None for name in mapping.values())}/{len(mapping)} channels identified")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(mapping, f, indent=1)
+
+if __name__ == "__main__":
+    main()
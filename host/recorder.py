@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+# Line-rate recorder of the microphone stream to raw capture files (host.stream/read_capture format).
+#
+# Packets are received from an AF_PACKET TPACKET_V3 ring mapped into the process (needs CAP_NET_RAW),
+# filtered in the kernel with a BPF program on the UDP destination port. A retired ring block holds
+# thousands of packets; their payloads are copied into the current disk buffer with one strided copy
+# when they are evenly laid out, which is the case for the fixed-size stream packets. Without the
+# capability (or with --socket) a plain UDP socket receives straight into the disk buffers instead.
+#
+# Disk buffers are page-aligned, a whole number of packets and of 4 KiB pages. A separate thread
+# writes full buffers, checks the packet_id sequence and drops written pages from the page cache, so
+# a long recording neither stalls the receiver nor fills the memory. Files are rotated on buffer
+# boundaries by size and/or age.
+
+import os
+import sys
+import mmap
+import time
+import queue
+import select
+import signal
+import socket
+import struct
+import ctypes
+import argparse
+import threading
+
+from host import lazy_import
+from host.stream import GROUP_WORDS, PACKET_BYTES, PDM_CLK_FREQ, GROUPS_PER_PACKET, UDP_PORT, WORD, SequenceChecker
+
+np = lazy_import("numpy")
+
+BUFFER_BYTES = 256*36864 # 9 MiB: 8192 packets, 2304 pages.
+BUFFERS      = 4
+
+# Disk ---------------------------------------------------------------------------------------------
+
+class DiskWriter:
+    """Writes full buffers on its own thread, rotating files by size and/or age."""
+    def __init__(self, prefix, buffers=BUFFERS, buffer_bytes=BUFFER_BYTES, rotate_bytes=None, rotate_seconds=None):
+        self.prefix         = prefix
+        self.buffer_bytes   = buffer_bytes
+        self.rotate_bytes   = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.free    = queue.Queue()
+        self.full    = queue.Queue()
+        for i in range(buffers):
+            self.free.put(mmap.mmap(-1, buffer_bytes)) # Anonymous maps are page-aligned.
+        self.sequence = SequenceChecker()
+        self.files    = []
+        self.written  = 0
+        self.fd       = None
+        self._thread  = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def get(self):
+        """A free buffer, None if the disk is behind."""
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            return None
+
+    def put(self, buf, size):
+        self.full.put((buf, size))
+
+    def close(self):
+        self.full.put((None, 0))
+        self._thread.join()
+
+    def _open(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        name = f"{self.prefix}_{time.strftime('%Y%m%d-%H%M%S')}_{len(self.files):04d}.bin"
+        self.fd       = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.opened   = time.time()
+        self.size     = 0
+        self.files.append(name)
+
+    def _run(self):
+        while True:
+            buf, size = self.full.get()
+            if buf is None:
+                break
+            if size:
+                words = np.frombuffer(buf, dtype=WORD, count=size//4)
+                self.sequence.update(words[::GROUP_WORDS])
+                if (self.fd is None or self.rotate_bytes and self.size + size > self.rotate_bytes or
+                    self.rotate_seconds and time.time() - self.opened >= self.rotate_seconds):
+                    self._open()
+                view = memoryview(buf)[:size]
+                while view:
+                    view = view[os.write(self.fd, view):]
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(self.fd, self.size, size, os.POSIX_FADV_DONTNEED)
+                self.size    += size
+                self.written += size
+            self.free.put(buf)
+        if self.fd is not None:
+            os.close(self.fd)
+
+# Receivers ----------------------------------------------------------------------------------------
+
+class Receiver:
+    """Fills disk buffers with packet payloads on a receive thread."""
+    def __init__(self, writer):
+        self.writer   = writer
+        self.packets  = 0
+        self.invalid  = 0
+        self.dropped  = 0 # Packets lost because no disk buffer was free.
+        self.buf      = None
+        self.pos      = 0
+        self._stop    = threading.Event()
+        self._thread  = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+    def kernel_drops(self):
+        return 0
+
+    def flush(self):
+        if self.buf is not None and self.pos:
+            self.writer.put(self.buf, self.pos)
+            self.buf, self.pos = None, 0
+
+    def room(self):
+        """Packets that fit in the current buffer, getting a new one when needed (0: disk behind)."""
+        if self.buf is not None and self.pos == self.writer.buffer_bytes:
+            self.flush()
+        if self.buf is None:
+            self.buf = self.writer.get()
+            self.pos = 0
+            if self.buf is None:
+                return 0
+        return (self.writer.buffer_bytes - self.pos)//PACKET_BYTES
+
+class SocketReceiver(Receiver):
+    """Plain UDP socket receiving straight into the disk buffers."""
+    def __init__(self, writer, port=UDP_PORT, host="0.0.0.0", rcvbuf=256 << 20):
+        Receiver.__init__(self, writer)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind((host, port))
+        self.sock.settimeout(0.1)
+        self.scratch = bytearray(65536)
+
+    def _run(self):
+        while not self._stop.is_set():
+            room = self.room()
+            try:
+                if not room:
+                    self.sock.recv_into(self.scratch)
+                    self.dropped += 1
+                    continue
+                # One byte more than a packet so oversize datagrams show, via scratch at the buffer end.
+                short = self.writer.buffer_bytes - self.pos <= PACKET_BYTES
+                dst   = self.scratch if short else memoryview(self.buf)[self.pos:self.pos + PACKET_BYTES + 1]
+                size  = self.sock.recv_into(dst)
+            except socket.timeout:
+                self.flush() # Stream paused: hand over what we have.
+                continue
+            if size != PACKET_BYTES:
+                self.invalid += 1
+                continue
+            if short:
+                self.buf[self.pos:self.pos + PACKET_BYTES] = self.scratch[:PACKET_BYTES]
+            self.packets += 1
+            self.pos     += PACKET_BYTES
+        self.sock.close()
+
+# TPACKET_V3 ---------------------------------------------------------------------------------------
+
+SOL_PACKET         = 263
+PACKET_RX_RING     = 5
+PACKET_STATISTICS  = 6
+PACKET_VERSION     = 10
+TPACKET_V3         = 2
+TP_STATUS_KERNEL   = 0
+TP_STATUS_USER     = 1
+SO_ATTACH_FILTER   = 26
+ETH_P_IP           = 0x0800
+PACKET_OUTGOING    = 4
+
+TPACKET3_HDR = struct.Struct("<IIIIIIHH") # next_offset, sec, nsec, snaplen, len, status, mac, net.
+
+def udp_port_filter(port):
+    """Classic BPF: incoming IPv4 UDP (unfragmented) to port."""
+    return [
+        (0x20, 0, 0, 0xfffff004),  # ld  pkttype
+        (0x15, 10, 0, PACKET_OUTGOING), # jeq outgoing -> drop
+        (0x28, 0, 0, 12),          # ldh ethertype
+        (0x15, 0, 8, ETH_P_IP),    # jne IPv4 -> drop
+        (0x30, 0, 0, 23),          # ldb protocol
+        (0x15, 0, 6, 17),          # jne UDP -> drop
+        (0x28, 0, 0, 20),          # ldh flags/fragment offset
+        (0x45, 4, 0, 0x1fff),      # jset fragment -> drop
+        (0xb1, 0, 0, 14),          # ldxb 4*([14] & 0xf)
+        (0x48, 0, 0, 16),          # ldh [x + 16] destination port
+        (0x15, 0, 1, port),        # jne port -> drop
+        (0x06, 0, 0, 0x40000),     # ret accept
+        (0x06, 0, 0, 0),           # ret drop
+    ]
+
+class RingReceiver(Receiver):
+    """AF_PACKET TPACKET_V3 memory-mapped ring."""
+    def __init__(self, writer, port=UDP_PORT, interface=None, block_bytes=4 << 20, blocks=64, frame_bytes=2048,
+                 timeout_ms=10):
+        Receiver.__init__(self, writer)
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_IP))
+        program = b"".join(struct.pack("<HBBI", *insn) for insn in udp_port_filter(port))
+        self._program = ctypes.create_string_buffer(program)
+        self.sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+            struct.pack("HL", len(program)//8, ctypes.addressof(self._program)))
+        self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack("IIIIIII",
+            block_bytes, blocks, frame_bytes, block_bytes//frame_bytes*blocks, timeout_ms, 0, 0))
+        if interface is not None:
+            self.sock.bind((interface, 0))
+        self.ring        = mmap.mmap(self.sock.fileno(), block_bytes*blocks)
+        self.bytes       = np.frombuffer(self.ring, dtype=np.uint8)
+        self.words       = np.frombuffer(self.ring, dtype="<u4")
+        self.block_bytes = block_bytes
+        self.blocks      = blocks
+        self.drops       = 0
+        self.freezes     = 0
+        # Keep a bound UDP socket so the kernel does not answer the stream with port unreachable.
+        self.sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sink.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.sink.bind(("0.0.0.0", port))
+
+    def kernel_drops(self):
+        if self.sock.fileno() >= 0:
+            _, drops, freezes = struct.unpack("III", self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))
+            self.drops   += drops # Counters reset on each read.
+            self.freezes += freezes
+        return self.drops
+
+    def _run(self):
+        poll  = select.poll()
+        poll.register(self.sock, select.POLLIN | select.POLLERR)
+        block = 0
+        while not self._stop.is_set():
+            base = block*self.block_bytes
+            if not self.words[base//4 + 2] & TP_STATUS_USER:
+                if not poll.poll(100):
+                    self.flush()
+                continue
+            self._block(base)
+            self.words[base//4 + 2] = TP_STATUS_KERNEL
+            block = (block + 1) % self.blocks
+        self.kernel_drops()
+        del self.bytes, self.words
+        self.ring.close()
+        self.sock.close()
+        self.sink.close()
+
+    def _payloads(self, base):
+        """(offset of the first payload, stride, count) of evenly laid out stream packets, None otherwise."""
+        count, first = struct.unpack_from("<II", self.ring, base + 12)
+        offset = base + first
+        step, _, _, snaplen, _, _, mac, net = TPACKET3_HDR.unpack_from(self.ring, offset)
+        if count > 1:
+            headers = offset + step*np.arange(count)
+            if not step or not ((self.words[headers[:-1]//4] == step).all() and
+                                (self.words[headers//4 + 3] == snaplen).all() and
+                                (self.bytes[headers + net] == 0x45).all()):
+                return None
+        if snaplen - (net - mac) != 20 + 8 + PACKET_BYTES or self.bytes[offset + net] != 0x45:
+            return None
+        return offset + net + 20 + 8, step, count
+
+    def _block(self, base):
+        layout = self._payloads(base)
+        if layout is None:
+            return self._block_slow(base)
+        offset, step, count = layout
+        while count:
+            room = self.room()
+            if not room:
+                self.dropped += count
+                return
+            n   = min(room, count)
+            src = np.lib.stride_tricks.as_strided(self.bytes[offset:], shape=(n, PACKET_BYTES), strides=(step, 1))
+            dst = np.frombuffer(self.buf, dtype=np.uint8, count=n*PACKET_BYTES, offset=self.pos)
+            dst.reshape(n, PACKET_BYTES)[:] = src
+            self.pos     += n*PACKET_BYTES
+            self.packets += n
+            offset       += n*step
+            count        -= n
+
+    def _block_slow(self, base):
+        count, offset = struct.unpack_from("<II", self.ring, base + 12)
+        offset += base
+        for i in range(count):
+            step, _, _, snaplen, _, _, mac, net = TPACKET3_HDR.unpack_from(self.ring, offset)
+            ip     = offset + net
+            header = 4*(self.ring[ip] & 0xf)
+            if snaplen - (net - mac) != header + 8 + PACKET_BYTES:
+                self.invalid += 1
+            elif not self.room():
+                self.dropped += 1
+            else:
+                start = ip + header + 8
+                self.buf[self.pos:self.pos + PACKET_BYTES] = self.ring[start:start + PACKET_BYTES]
+                self.pos     += PACKET_BYTES
+                self.packets += 1
+            offset += step
+
+# Loopback source ----------------------------------------------------------------------------------
+
+def send_loopback(port, mbps, stop):
+    """Send a synthetic stream to localhost at mbps (payload) until stop is set."""
+    from host.synth import SyntheticStream
+
+    stream = SyntheticStream(seconds=0.05)
+    sock   = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16 << 20)
+    period = PACKET_BYTES*8/(mbps*1e6)
+    start  = time.perf_counter()
+    sent   = 0
+    while not stop.is_set():
+        payload = memoryview(stream.read(64))
+        for i in range(64):
+            sock.sendto(payload[i*PACKET_BYTES:(i + 1)*PACKET_BYTES], ("127.0.0.1", port))
+        sent += 64
+        delay = start + sent*period - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    sock.close()
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Record the Kandinsky stream to raw capture files")
+    parser.add_argument("prefix",                                         help="Output file prefix (prefix_DATE-TIME_NNNN.bin)")
+    parser.add_argument("--port",           default=UDP_PORT, type=int,   help="Stream UDP port")
+    parser.add_argument("--interface",      default=None,                 help="Receive interface (ring mode, default: all)")
+    parser.add_argument("--socket",         action="store_true",          help="Use a plain UDP socket instead of the packet ring")
+    parser.add_argument("--buffers",        default=BUFFERS, type=int,    help="Disk buffers (9 MiB each)")
+    parser.add_argument("--rotate-mb",      default=None, type=float,     help="Start a new file every N MB")
+    parser.add_argument("--rotate-seconds", default=None, type=float,     help="Start a new file every N seconds")
+    parser.add_argument("--duration",       default=None, type=float,     help="Stop after N seconds (default: until SIGINT/SIGTERM)")
+    parser.add_argument("--loopback-mbps",  default=None, type=float,     help="Record a synthetic stream sent to localhost at this rate")
+    parser.add_argument("--strict",         action="store_true",          help="Exit with an error on any drop")
+    args = parser.parse_args()
+
+    rotate = None if args.rotate_mb is None else max(1, int(args.rotate_mb*1e6)//BUFFER_BYTES)*BUFFER_BYTES
+    writer = DiskWriter(args.prefix, args.buffers, rotate_bytes=rotate, rotate_seconds=args.rotate_seconds)
+    receiver = None
+    if not args.socket:
+        try:
+            receiver = RingReceiver(writer, args.port, args.interface)
+        except (PermissionError, OSError) as e:
+            print(f"Packet ring unavailable ({e}), using a UDP socket")
+    if receiver is None:
+        receiver = SocketReceiver(writer, args.port)
+    print(f"Recording with {type(receiver).__name__} to {args.prefix}_*.bin")
+
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    sender = None
+    if args.loopback_mbps is not None:
+        sender = threading.Thread(target=send_loopback, args=(args.port, args.loopback_mbps, stop), daemon=True)
+        sender.start()
+
+    receiver.start()
+    start = last = time.time()
+    cpu   = time.process_time()
+    bytes_last = 0
+    while not stop.wait(1.0):
+        now   = time.time()
+        rate  = (receiver.packets*PACKET_BYTES - bytes_last)*8/(now - last)/1e6
+        bytes_last, last = receiver.packets*PACKET_BYTES, now
+        print(f"{receiver.packets} packets ({rate:.0f} Mbps), {writer.written/1e9:.2f} GB in {len(writer.files)} files | "
+              f"drops: {receiver.kernel_drops()} kernel, {receiver.dropped} disk, {writer.sequence.lost} groups in "
+              f"sequence | {receiver.invalid} invalid | CPU {100*(time.process_time() - cpu)/(now - start):.0f}%")
+        if args.duration is not None and now - start >= args.duration:
+            stop.set()
+    if sender is not None:
+        sender.join()
+    receiver.stop()
+    writer.close()
+
+    elapsed = time.time() - start
+    drops   = receiver.kernel_drops() + receiver.dropped + writer.sequence.lost//GROUPS_PER_PACKET
+    print(f"Recorded {writer.written/1e9:.2f} GB ({writer.sequence.groups/PDM_CLK_FREQ:.1f} s of stream) in "
+          f"{elapsed:.1f} s, {8*writer.written/elapsed/1e6:.0f} Mbps average, "
+          f"{100*(time.process_time() - cpu)/elapsed:.0f}% CPU, {drops} packets dropped")
+    if args.strict and drops:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
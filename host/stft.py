@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# Shared sliding-window STFT of all channels.
+#
+# PCM blocks are appended to a short input history; every complete hop produces one frame and all new
+# frames of a block are transformed with a single batched rFFT across channels, written straight into
+# a ring of recent frames. The ring is mirrored (each frame is stored at slot i and i + ring), so any
+# run of up to `ring` consecutive frames is a contiguous read-only view that consumers get without
+# copying.
+
+import time
+import argparse
+
+from host import lazy_import
+from host.stream import CHANNELS
+
+np = lazy_import("numpy")
+
+WINDOWS = { # numpy window functions.
+    "hann"     : "hanning",
+    "hamming"  : "hamming",
+    "blackman" : "blackman",
+    "rect"     : "ones",
+}
+
+class STFT:
+    def __init__(self, channels=CHANNELS, nfft=512, hop=256, window="hann", ring=64):
+        assert 0 < hop <= nfft and ring > 0
+        self.channels = channels
+        self.nfft     = nfft
+        self.hop      = hop
+        self.bins     = nfft//2 + 1
+        self.window   = (getattr(np, WINDOWS[window])(nfft) if isinstance(window, str) else np.asarray(window)).astype(np.float32)
+        self.ring     = ring
+        self._frames  = np.zeros((2*ring, channels, self.bins), dtype=np.complex64)
+        self.count    = 0 # Frames produced so far.
+        self.history  = np.zeros((channels, 0), dtype=np.float32)
+        self.consumers = []
+
+    def subscribe(self, callback):
+        """Call callback(frames, first) with each batch of new (n, channels, bins) frames; `first` is
+        the index of the first one. The view is only valid until `ring` more frames are produced."""
+        self.consumers.append(callback)
+        return callback
+
+    def frames(self, first, n):
+        """Read-only view of n frames starting at frame index first (within the last `ring`)."""
+        assert self.count - self.ring <= first and first + n <= self.count and n <= self.ring
+        start = first % self.ring
+        view  = self._frames[start:start + n]
+        view.flags.writeable = False
+        return view
+
+    def last(self, n=1):
+        return self.frames(self.count - n, n)
+
+    def process(self, pcm):
+        x = np.concatenate([self.history, pcm], axis=1)
+        n = (x.shape[1] - self.nfft)//self.hop + 1
+        if n <= 0:
+            self.history = x
+            return 0
+        windows = np.lib.stride_tricks.sliding_window_view(x, self.nfft, axis=1)[:, ::self.hop][:, :n]
+        windows = windows.transpose(1, 0, 2)*self.window  # (frames, channels, nfft).
+        first   = self.count
+        # Blocks longer than the ring only keep (and publish) their last `ring` frames.
+        for start in range(max(0, n - self.ring), n, self.ring):
+            self._write(windows[start:start + self.ring], first + start)
+        self.count  += n
+        self.history = x[:, n*self.hop:]
+        published = max(first, self.count - self.ring)
+        for callback in self.consumers:
+            callback(self.frames(published, self.count - published), published)
+        return n
+
+    def _write(self, windows, first):
+        slot = first % self.ring
+        head = min(len(windows), self.ring - slot)
+        np.fft.rfft(windows[:head], axis=-1, out=self._frames[slot:slot + head])
+        if head < len(windows):
+            np.fft.rfft(windows[head:], axis=-1, out=self._frames[:len(windows) - head])
+        # Mirror: slots [0, ring) and [ring, 2*ring) hold the same frames.
+        self._frames[slot + self.ring:slot + self.ring + head] = self._frames[slot:slot + head]
+        if head < len(windows):
+            self._frames[self.ring:self.ring + len(windows) - head] = self._frames[:len(windows) - head]
+
+# Benchmark ----------------------------------------------------------------------------------------
+
+def benchmark(seconds=10.0, rate=16276, block=512, nfft=512, hop=256, consumers=3):
+    """Frames/s of the shared STFT feeding `consumers` vs each consumer windowing and transforming the
+    same frames itself."""
+    rng = np.random.default_rng(0)
+    pcm = rng.standard_normal((CHANNELS, int(seconds*rate))).astype(np.float32)
+
+    stft = STFT(nfft=nfft, hop=hop)
+    seen = [0]*consumers
+    for c in range(consumers):
+        stft.subscribe(lambda frames, first, c=c: seen.__setitem__(c, seen[c] + len(frames)))
+    start = time.perf_counter()
+    for i in range(0, pcm.shape[1], block):
+        stft.process(pcm[:, i:i + block])
+    shared = time.perf_counter() - start
+
+    window  = np.hanning(nfft).astype(np.float32)
+    history = [np.zeros((CHANNELS, 0), dtype=np.float32) for c in range(consumers)]
+    start = time.perf_counter()
+    for i in range(0, pcm.shape[1], block):
+        for c in range(consumers):
+            x = np.concatenate([history[c], pcm[:, i:i + block]], axis=1)
+            n = max((x.shape[1] - nfft)//hop + 1, 0)
+            for k in range(n):
+                np.fft.rfft(x[:, k*hop:k*hop + nfft]*window, axis=-1)
+            history[c] = x[:, n*hop:]
+    separate = time.perf_counter() - start
+
+    frames = stft.count
+    assert all(s == frames for s in seen)
+    print(f"{frames} frames of {CHANNELS} channels (nfft {nfft}, hop {hop}), {consumers} consumers:")
+    print(f"  shared STFT:           {frames/shared:9.0f} frames/s ({shared:.3f} s)")
+    print(f"  per-consumer frames:   {frames/separate:9.0f} frames/s ({separate:.3f} s)")
+    print(f"  speedup:               {separate/shared:9.1f}x")
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared STFT benchmark")
+    parser.add_argument("--seconds",   default=10.0, type=float, help="PCM duration")
+    parser.add_argument("--nfft",      default=512,  type=int,   help="FFT size")
+    parser.add_argument("--hop",       default=256,  type=int,   help="Hop size")
+    parser.add_argument("--block",     default=512,  type=int,   help="PCM samples per block")
+    parser.add_argument("--consumers", default=3,    type=int,   help="Number of consumers")
+    args = parser.parse_args()
+    benchmark(args.seconds, block=args.block, nfft=args.nfft, hop=args.hop, consumers=args.consumers)
+
+if __name__ == "__main__":
+    main()
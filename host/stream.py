@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+# Microphone stream decoder and UDP receiver (format in host/format.py).
+
+import os
+import time
+import queue
+import socket
+import argparse
+import threading
+
+from host import lazy_import, metrics
+from host.format import (SYS_CLK_FREQ, PDM_CLK_DIV, PDM_CLK_FREQ, PINS, SLOTS, CHANNELS, GROUP_WORDS, GROUP_BYTES,
+    GROUPS_PER_PACKET, PACKET_BYTES, UDP_PORT, WORD, channel)
+
+np = lazy_import("numpy")
+
+# Decoder ------------------------------------------------------------------------------------------
+
+def _pin_bytes(payload):
+    words = np.frombuffer(payload, dtype=WORD)
+    words = words[:len(words) - len(words) % GROUP_WORDS].reshape(-1, GROUP_WORDS)
+    # (3, SLOTS, groups) planes of pins 8k..8k+7 (little-endian words: pin n is bit n%8 of byte n//8).
+    planes = words.view(np.uint8).reshape(-1, GROUP_WORDS, 4)[:, 1:, :PINS//8]
+    return words[:, 0].copy(), np.ascontiguousarray(planes.transpose(2, 1, 0))
+
+def decode(payload):
+    """Decode concatenated packet payloads into (packet_ids, bits).
+
+    packet_ids is the per-group counter (one per PDM clock period), bits a (CHANNELS, groups) uint8
+    array of PDM bits (0/1).
+    """
+    ids, planes = _pin_bytes(payload)
+    # Unpacking along the plane axis gives (pin, slot, group), i.e. channel-major order.
+    return ids, np.unpackbits(planes, axis=0, bitorder="little").reshape(CHANNELS, -1)
+
+def _transpose8(x):
+    # 8x8 bit matrix transpose of each uint64 (bit 8i+j <-> bit 8j+i).
+    t = (x ^ (x >> np.uint64(7)))  & np.uint64(0x00aa00aa00aa00aa)
+    x = x ^ t ^ (t << np.uint64(7))
+    t = (x ^ (x >> np.uint64(14))) & np.uint64(0x0000cccc0000cccc)
+    x = x ^ t ^ (t << np.uint64(14))
+    t = (x ^ (x >> np.uint64(28))) & np.uint64(0x00000000f0f0f0f0)
+    return x ^ t ^ (t << np.uint64(28))
+
+def decode_packed(payload):
+    """Decode into (packet_ids, packed) with packed a (CHANNELS, groups//8) uint8 array holding 8
+    consecutive PDM bits per byte (first bit in the LSB), the layout used by the decimator.
+    """
+    ids, planes = _pin_bytes(payload)
+    n = planes.shape[2] - planes.shape[2] % 8
+    # Each run of 8 groups of a plane is an 8x8 (time, pin) bit matrix: transpose it to (pin, time).
+    t = _transpose8(np.ascontiguousarray(planes[:, :, :n]).view(np.uint64))
+    t = t.view(np.uint8).reshape(PINS//8, SLOTS, n//8, 8)
+    return ids, np.ascontiguousarray(t.transpose(0, 3, 1, 2)).reshape(CHANNELS, n//8)
+
+def encode(bits, first_id=0):
+    """Encode (CHANNELS, groups) PDM bits into packet payloads (inverse of decode)."""
+    n     = bits.shape[1]
+    pins  = np.zeros((n, SLOTS, 32), dtype=np.uint8)
+    pins[:, :, :PINS] = bits.reshape(PINS, SLOTS, n).transpose(2, 1, 0)
+    words = np.empty((n, GROUP_WORDS), dtype=WORD)
+    words[:, 0]  = (first_id + np.arange(n)) & 0xffffffff
+    words[:, 1:] = np.packbits(pins, axis=2, bitorder="little").view(WORD)[:, :, 0]
+    return words.tobytes()
+
+def is_container(filename):
+    """True for compressed (.kpdm, see host.container) captures."""
+    with open(filename, "rb") as f:
+        return f.read(4) == b"KPDM"
+
+def capture_packets(filename):
+    """Number of packets in a raw or compressed capture."""
+    if is_container(filename):
+        from host.container import ContainerReader
+        reader = ContainerReader(filename)
+        reader.close()
+        return reader.packets
+    return os.path.getsize(filename)//PACKET_BYTES
+
+def read_capture(filename, packets=1024, start=0, stop=None):
+    """Iterate over packets [start, stop) of a raw capture (concatenated packet payloads) `packets`
+    packets at a time, or of a compressed capture one container chunk at a time.
+
+    The same buffer is reused for every chunk: consume (decode) each chunk before the next one.
+    """
+    if is_container(filename):
+        from host.container import read_container
+        yield from read_container(filename, start, stop)
+        return
+    buf = bytearray(packets*PACKET_BYTES)
+    with open(filename, "rb", buffering=0) as f:
+        f.seek(start*PACKET_BYTES)
+        left = None if stop is None else (stop - start)*PACKET_BYTES
+        while left is None or left > 0:
+            n = f.readinto(buf if left is None or left >= len(buf) else memoryview(buf)[:left])
+            n -= n % PACKET_BYTES
+            if not n:
+                return
+            if left is not None:
+                left -= n
+            yield memoryview(buf)[:n]
+
+class SequenceChecker:
+    """Count groups lost between consecutive decoded blocks from packet_id gaps."""
+    def __init__(self):
+        self.next   = None
+        self.groups = 0
+        self.lost   = 0
+
+    def update(self, ids):
+        if not len(ids):
+            return 0
+        ids  = ids.astype(np.int64)
+        prev = ids[0] - 1 if self.next is None else self.next - 1
+        gaps = (np.diff(ids, prepend=prev) - 1) % 2**32
+        lost = int(gaps[gaps < 2**31].sum()) # Backward jumps (reordering) are not losses.
+        self.next    = (int(ids[-1]) + 1) % 2**32
+        self.groups += len(ids)
+        self.lost   += lost
+        return lost
+
+# Receiver -----------------------------------------------------------------------------------------
+
+class StreamReceiver:
+    """Receive stream packets on a background thread into a pool of preallocated blocks.
+
+    The socket thread never waits on consumers: when no free block is available the packets are
+    dropped and counted in `overruns`.
+    """
+    def __init__(self, port=UDP_PORT, host="0.0.0.0", block_packets=64, blocks=32, rcvbuf=64 << 20, name="receiver"):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind((host, port))
+        self.sock.settimeout(0.1)
+        self.block_packets = block_packets
+        self.free    = queue.Queue()
+        self.full    = queue.Queue()
+        for i in range(blocks):
+            self.free.put(bytearray(block_packets*PACKET_BYTES))
+        self.packets  = 0
+        self.invalid  = 0
+        self.overruns = 0
+        self._stop    = threading.Event()
+        self._thread  = threading.Thread(target=self._run, daemon=True)
+        self._decode  = metrics.stage(f"{name}.decode")
+        metrics.gauge(f"{name}.queued_blocks", self.full.qsize)
+        metrics.counter(f"{name}.packets",  lambda: self.packets)
+        metrics.counter(f"{name}.overruns", lambda: self.overruns)
+        metrics.counter(f"{name}.invalid",  lambda: self.invalid)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        scratch = bytearray(65536)
+        block, view, n = None, None, 0
+        stamp = None
+        while not self._stop.is_set():
+            if block is None:
+                try:
+                    block = self.free.get_nowait()
+                    view, n = memoryview(block), 0
+                except queue.Empty:
+                    pass
+            try:
+                if block is None:
+                    self.sock.recv_into(scratch)
+                    self.overruns += 1
+                    continue
+                # One byte more than a packet so oversize datagrams show, via scratch for the last one.
+                last  = n == self.block_packets - 1
+                size  = self.sock.recv_into(scratch if last else view[n*PACKET_BYTES:])
+                stamp = time.perf_counter()
+            except socket.timeout:
+                if block is not None and n:
+                    self.full.put((block, n, stamp)) # Flush partial blocks when the stream pauses.
+                    block = None
+                continue
+            except OSError:
+                break
+            if size != PACKET_BYTES:
+                self.invalid += 1
+                continue
+            if last:
+                view[n*PACKET_BYTES:] = scratch[:PACKET_BYTES]
+            self.packets += 1
+            n += 1
+            if n == self.block_packets:
+                self.full.put((block, n, stamp))
+                block = None
+
+    def read_raw(self, timeout=None):
+        """Next block as (buffer, payload, stamp), None on timeout. The buffer goes back with release().
+
+        stamp is the time.perf_counter() receive time of the last packet of the block.
+        """
+        try:
+            block, n, stamp = self.full.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return block, memoryview(block)[:n*PACKET_BYTES], stamp
+
+    def release(self, block):
+        self.free.put(block)
+
+    def read(self, timeout=None, packed=False):
+        """Next decoded block as (packet_ids, bits) (see decode/decode_packed), None on timeout."""
+        raw = self.read_raw(timeout)
+        if raw is None:
+            return None
+        try:
+            with self._decode:
+                block = (decode_packed if packed else decode)(raw[1])
+            self._decode.add(len(raw[1]))
+            return block
+        finally:
+            self.release(raw[0])
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.sock.close()
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Kandinsky microphone stream receiver")
+    parser.add_argument("--port",     default=UDP_PORT, type=int,   help="UDP port")
+    parser.add_argument("--duration", default=10.0,     type=float, help="Capture duration (s)")
+    parser.add_argument("--output",   default=None,                 help="Raw capture file (packet payloads)")
+    args = parser.parse_args()
+
+    rx    = StreamReceiver(port=args.port).start()
+    seq   = SequenceChecker()
+    out   = None if args.output is None else open(args.output, "wb")
+    start = time.time()
+    last  = start
+    while time.time() - start < args.duration:
+        raw = rx.read_raw(timeout=0.1)
+        if raw is not None:
+            seq.update(np.frombuffer(raw[1], dtype=WORD)[::GROUP_WORDS])
+            if out is not None:
+                out.write(raw[1])
+            rx.release(raw[0])
+        if time.time() - last >= 1.0:
+            last = time.time()
+            rate = seq.groups/(last - start)
+            print(f"{rx.packets} packets, {rate/1e6:.3f} Mgroups/s ({rate/PDM_CLK_FREQ*100:.1f}% of line rate), "
+                  f"{seq.lost} groups lost, {rx.overruns} overruns, {rx.invalid} invalid")
+    rx.close()
+    if out is not None:
+        out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+# Synthetic microphone stream for running the host tools without the board.
+#
+# Plane-wave tones from given directions plus noise are sigma-delta modulated (first order) into PDM
+# bits for each microphone and encoded in the stream format. A loop of `seconds` is generated once and
+# replayed with continuing packet ids, so producing the stream costs little more than a memcpy.
+
+import time
+
+from host import lazy_import, metrics
+from host.array import default_positions, directions, delays
+from host.stream import (CHANNELS, PDM_CLK_FREQ, GROUPS_PER_PACKET, GROUP_WORDS, WORD, encode, decode,
+    decode_packed)
+
+np = lazy_import("numpy")
+
+# Modulator ----------------------------------------------------------------------------------------
+
+def sigma_delta(x, state=None):
+    """First order sigma-delta of (channels, n) samples in [-1, 1]: returns (bits, state).
+
+    The quantization error feedback loop of a first order modulator has a closed form: the output is
+    the increment of floor(running sum of the input mapped to [0, 1]).
+    """
+    state = np.zeros(len(x)) if state is None else state
+    s     = state[:, None] + np.cumsum((x + 1)/2, axis=1)
+    q     = np.floor(s + 0.5)
+    bits  = np.diff(q, axis=1, prepend=np.floor(state + 0.5)[:, None])
+    return bits.astype(np.uint8), s[:, -1] - np.floor(s[:, -1])
+
+# Source -------------------------------------------------------------------------------------------
+
+class SyntheticStream:
+    """Stream of plane-wave `sources` [(azimuth, elevation, frequency, amplitude)] at full PDM rate.
+
+    A frequency of None is a broadband (100 Hz - 6 kHz) noise source. `mismatch` optionally gives
+    per-channel extra arrival delays (s) and sensitivities, as a miscalibrated array would have.
+    """
+    def __init__(self, sources=((45, 30, 1000, 0.5),), noise=0.05, seconds=0.1, positions=None, seed=0,
+                 mismatch=None, chunk=1 << 16):
+        positions = default_positions() if positions is None else positions
+        rng       = np.random.default_rng(seed)
+        groups    = int(seconds*PDM_CLK_FREQ) // GROUPS_PER_PACKET*GROUPS_PER_PACKET
+        loop      = groups/PDM_CLK_FREQ
+        extra, gains = (np.zeros(CHANNELS), np.ones(CHANNELS)) if mismatch is None else mismatch
+        waves     = []
+        for azimuth, elevation, freq, amplitude in sources:
+            tau = delays(positions, directions([azimuth], [elevation])[0, 0]) + extra
+            if freq is None:
+                # Periodic band-limited noise, delayed by whole PDM samples.
+                f        = np.fft.rfftfreq(groups, 1/PDM_CLK_FREQ)
+                spectrum = np.where((f >= 100) & (f <= 6000), np.exp(2j*np.pi*rng.random(len(f))), 0)
+                signal   = np.fft.irfft(spectrum, groups)
+                signal  *= amplitude/2/signal.std()
+                waves.append((signal, np.rint(tau*PDM_CLK_FREQ).astype(np.int64), gains))
+            else:
+                freq = round(freq*loop)/loop # Whole number of periods per loop.
+                waves.append((freq, tau, amplitude*gains))
+        payload = []
+        state   = None
+        for start in range(0, groups, chunk):
+            n = start + np.arange(min(chunk, groups - start))
+            x = noise*rng.standard_normal((CHANNELS, len(n)))
+            for wave, tau, gain in waves:
+                if isinstance(wave, np.ndarray):
+                    x += gain[:, None]*wave[(n[None, :] - tau[:, None]) % groups]
+                else:
+                    x += gain[:, None]*np.sin(2*np.pi*wave*(n[None, :]/PDM_CLK_FREQ - tau[:, None]))
+            bits, state = sigma_delta(np.clip(x, -1, 1), state)
+            payload.append(encode(bits, start))
+        self.loop    = np.frombuffer(b"".join(payload), dtype=WORD).reshape(-1, GROUPS_PER_PACKET*GROUP_WORDS)
+        self.packets = 0
+
+    def read(self, packets):
+        """Payload of the next `packets` packets."""
+        idx   = (self.packets + np.arange(packets)) % len(self.loop)
+        words = self.loop[idx]
+        first = self.packets*GROUPS_PER_PACKET
+        ids   = first + np.arange(packets*GROUPS_PER_PACKET)
+        words.reshape(-1, GROUP_WORDS)[:, 0] = ids & 0xffffffff
+        self.packets += packets
+        return words.tobytes()
+
+# Receiver -----------------------------------------------------------------------------------------
+
+class SyntheticReceiver:
+    """StreamReceiver stand-in serving a SyntheticStream at the stream rate.
+
+    Like a socket that is not drained in time, blocks that are more than `blocks` late are dropped
+    (counted in overruns) instead of slowing the stream down.
+    """
+    def __init__(self, stream=None, block_packets=64, blocks=32, realtime=True):
+        self.stream        = SyntheticStream() if stream is None else stream
+        self.block_packets = block_packets
+        self.blocks        = blocks
+        self.realtime      = realtime
+        self.packets       = 0
+        self.invalid       = 0
+        self.overruns      = 0
+        self._decode       = metrics.stage("receiver.decode")
+        metrics.counter("receiver.packets",  lambda: self.packets)
+        metrics.counter("receiver.overruns", lambda: self.overruns)
+
+    def start(self):
+        self._start = time.perf_counter()
+        return self
+
+    def read_raw(self, timeout=None):
+        """Next block as (None, payload, stamp) like StreamReceiver.read_raw, None on timeout."""
+        if self.realtime:
+            due  = self._start + (self.packets + self.overruns + self.block_packets)*GROUPS_PER_PACKET/PDM_CLK_FREQ
+            late = int((time.perf_counter() - due)*PDM_CLK_FREQ/GROUPS_PER_PACKET)
+            if late > self.blocks*self.block_packets:
+                self.stream.packets += late   # Packets lost while the consumer was behind.
+                self.overruns       += late
+            elif late < 0:
+                delay = due - time.perf_counter()
+                if timeout is not None and delay > timeout:
+                    time.sleep(timeout)
+                    return None
+                time.sleep(delay)
+        self.packets += self.block_packets
+        return None, self.stream.read(self.block_packets), time.perf_counter()
+
+    def release(self, block):
+        pass
+
+    def read(self, timeout=None, packed=False):
+        raw = self.read_raw(timeout)
+        if raw is None:
+            return None
+        with self._decode:
+            block = (decode_packed if packed else decode)(raw[1])
+        self._decode.add(len(raw[1]))
+        return block
+
+    def close(self):
+        pass
+
+# Boards -------------------------------------------------------------------------------------------
+
+class SyntheticBoard:
+    """Stand-in for one of several boards, each running on its own oscillator.
+
+    All microphones hear a `tone` (frequency, amplitude) in host time; the board's PDM clock runs
+    `drift` (fractional) fast and its group 0 is sampled at host time `offset`. Packets are lost with
+    probability `loss` and read_raw() returns blocks immediately (no pacing) stamped with the arrival
+    time of their last packet: host time plus a `latency` and exponential `jitter`.
+    """
+    def __init__(self, drift=0.0, offset=0.0, loss=0.0, first_id=0, tone=(1000, 0.5), latency=100e-6,
+                 jitter=200e-6, block_packets=64, seed=0):
+        self.rate          = PDM_CLK_FREQ*(1 + drift)
+        self.offset        = offset
+        self.loss          = loss
+        self.first_id      = first_id
+        self.tone          = tone
+        self.latency       = latency
+        self.jitter        = jitter
+        self.block_packets = block_packets
+        self.rng           = np.random.default_rng(seed)
+        self.groups        = 0
+        self.state         = None
+        self.packets       = 0
+        self.invalid       = 0
+        self.overruns      = 0
+
+    def start(self):
+        return self
+
+    def read_raw(self, timeout=None):
+        freq, amplitude = self.tone
+        n = self.groups + np.arange(self.block_packets*GROUPS_PER_PACKET)
+        x = amplitude*np.sin(2*np.pi*freq*(self.offset + n/self.rate)) + 0.01*self.rng.standard_normal(len(n))
+        bits, self.state = sigma_delta(np.clip(x, -1, 1)[None], self.state)
+        words = np.empty((len(n), GROUP_WORDS), dtype=WORD)
+        words[:, 0]  = (self.first_id + n) & 0xffffffff
+        words[:, 1:] = (bits[0].astype(WORD)*0xffffff)[:, None]   # Same bit on every pin and slot.
+        keep  = np.flatnonzero(self.rng.random(self.block_packets) >= self.loss)
+        self.groups  += len(n)
+        self.packets += len(keep)
+        end   = self.groups if not len(keep) else n[0] + (keep[-1] + 1)*GROUPS_PER_PACKET
+        stamp = self.offset + end/self.rate + self.latency + self.rng.exponential(self.jitter)
+        return None, words.reshape(self.block_packets, -1)[keep].tobytes(), stamp
+
+    def release(self, block):
+        pass
+
+    def close(self):
+        pass
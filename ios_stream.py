@@ -78,10 +78,113 @@ class IOStreamer(Module):
         self.comb += phy.sink.data.eq(port.dat_r)
         self.sync += If(phy.sink.ready, port.adr.eq(port.adr + 1))
 
+# IOs ----------------------------------------------------------------------------------------------
+
+def get_ios():
+    """CABGA256 IOs from the JSON database, minus the clock input."""
+    import json
+    json_file = open("iodb.json")
+    json_data = json.load(json_file)
+    json_file.close()
+    ios = list(json_data["packages"]["CABGA256"].keys())
+
+    excludes = []
+    excludes += ["P6"]
+    for exclude in excludes:
+        ios.remove(exclude)
+    return ios
+
+# IOsStreamer --------------------------------------------------------------------------------------
+
+class IOsStreamer(Module):
+    """Stream the name of every pad over UART from one shared name ROM (see host/pinmap.py).
+
+    The baud generator and the bit/character counters are shared by all pads. After each baud tick
+    the ROM is swept once, one pad per cycle, and the next bit of every pad is shifted into a shadow
+    register that drives the pads from the following tick on, so all pads switch on the same edge.
+    """
+    def __init__(self, names, pads, sys_clk_freq, baudrate):
+        from host.pinmap import NAME_CHARS, SLOTS, FRAME_BITS, name_text
+        n = len(names)
+        assert NAME_CHARS & (NAME_CHARS - 1) == 0
+        assert sys_clk_freq/baudrate >= n + 2, f"{baudrate} baud too fast to sweep {n} pads per bit"
+
+        # Name ROM (pad p, character c at p*NAME_CHARS + c)
+        mem  = Memory(8, n*NAME_CHARS, init=[ord(c) for name in names for c in name_text(name)])
+        port = mem.get_port()
+        self.specials += mem, port
+
+        # Baud tick
+        tick  = Signal()
+        phase = Signal(32)
+        self.sync += Cat(phase, tick).eq(phase + int((baudrate/sys_clk_freq)*2**32))
+
+        # Bit (0: start, 1-8: data, 9: stop) and character slot (last: idle) of the next bit
+        bit    = Signal(max=FRAME_BITS, reset=FRAME_BITS - 1)
+        slot   = Signal(max=SLOTS, reset=SLOTS - 1)
+        pad    = Signal(max=n + 1, reset=n) # ROM sweep position, n when done.
+        valid  = Signal()
+        shadow = Signal(n, reset=2**n - 1)
+        out    = Signal(n, reset=2**n - 1)
+        self.sync += [
+            If(tick,
+                out.eq(shadow),
+                pad.eq(0),
+                If(bit == FRAME_BITS - 1,
+                    bit.eq(0),
+                    If(slot == SLOTS - 1,
+                        slot.eq(0)
+                    ).Else(
+                        slot.eq(slot + 1)
+                    )
+                ).Else(
+                    bit.eq(bit + 1)
+                )
+            ).Elif(pad != n,
+                pad.eq(pad + 1)
+            ),
+            valid.eq(pad != n),
+        ]
+
+        # ROM sweep: the byte of pad p comes out one cycle after its address, its bit is shifted in
+        frame = Cat(0, port.dat_r, 1)
+        value = Signal()
+        self.comb += [
+            port.adr.eq(Cat(slot[:log2_int(NAME_CHARS)], pad)),
+            value.eq((slot == SLOTS - 1) | Array(frame[i] for i in range(FRAME_BITS))[bit]),
+        ]
+        self.sync += If(valid, shadow.eq(Cat(shadow[1:], value)))
+        self.comb += [pads[i].eq(out[i]) for i in range(n)]
+
+def simulate(names, sys_clk_freq=int(25e6), baudrate=115200, repeats=3):
+    """Run IOsStreamer in simulation and decode its pads with the host pin map decoder."""
+    import numpy as np
+    from host.pinmap import SLOTS, FRAME_BITS, decode_uart, pin_map
+
+    pads    = [Signal() for name in names]
+    dut     = IOsStreamer(names, pads, sys_clk_freq, baudrate)
+    cycles  = int((repeats + 1)*SLOTS*FRAME_BITS*sys_clk_freq/baudrate)
+    samples = []
+    def generator():
+        for i in range(cycles):
+            samples.append((yield Cat(*pads)))
+            yield
+    run_simulation(dut, generator())
+
+    size = (len(names) + 7)//8
+    raw  = np.frombuffer(b"".join(v.to_bytes(size, "little") for v in samples), dtype=np.uint8)
+    x    = np.unpackbits(raw.reshape(-1, size), axis=1, bitorder="little")[:, :len(names)].T
+    mapping, report = pin_map(names, decode_uart(x, sys_clk_freq, baudrate), min_count=repeats)
+    wrong = [name for name in names if mapping[name] != name]
+    print(f"Simulated {cycles} cycles: {len(names) - len(wrong)}/{len(names)} pads decoded")
+    for name in wrong:
+        print(f"  {name}: got {mapping[name]}")
+    return not wrong
+
 # IOsStreamSoC -------------------------------------------------------------------------------------
 
 class IOsStreamSoC(SoCMini):
-    def __init__(self, sys_clk_freq=int(25e6)):
+    def __init__(self, sys_clk_freq=int(25e6), quarter=None, baudrate=115200):
         platform = Platform(toolchain="trellis")
 
         # CRG --------------------------------------------------------------------------------------
@@ -90,33 +193,25 @@ class IOsStreamSoC(SoCMini):
         # SoC Mini ---------------------------------------------------------------------------------
         SoCMini.__init__(self, platform, sys_clk_freq)
 
-        # Get IOs from JSON database ---------------------------------------------------------------
-        import json
-        json_file = open("iodb.json")
-        json_data = json.load(json_file)
-        json_file.close()
-        ios = list(json_data["packages"]["CABGA256"].keys())
-
-        # Exclude some IOs -------------------------------------------------------------------------
-        excludes = []
-        excludes += ["P6"]
-        for exclude in excludes:
-            ios.remove(exclude)
-
-        # Reduce number of IOs ---------------------------------------------------------------------
-        ios = ios[0*len(ios)//4:1*len(ios)//4]
-        #ios = ios[1*len(ios)//4:2*len(ios)//4]
-        #ios = ios[2*len(ios)//4:3*len(ios)//4]
-        #ios = ios[3*len(ios)//4:4*len(ios)//4]
+        # Get IOs ----------------------------------------------------------------------------------
+        ios = get_ios()
+
+        # Reduce number of IOs (one streamer per IO only fits a quarter of them) -------------------
+        if quarter is not None:
+            ios = ios[quarter*len(ios)//4:(quarter + 1)*len(ios)//4]
 
         # Create platform IOs ----------------------------------------------------------------------
         for io in ios:
             platform.add_extension([(io, 0, Pins(io), IOStandard("LVCMOS33"), Misc("DRIVE=4"))])
 
         # Stream IOs' identifiers to IOs -----------------------------------------------------------
-        for io in ios:
-            io_streamer = IOStreamer(io, platform.request(io), sys_clk_freq, baudrate=9600)
-            self.submodules += io_streamer
+        if quarter is not None:
+            for io in ios:
+                io_streamer = IOStreamer(io, platform.request(io), sys_clk_freq, baudrate=9600)
+                self.submodules += io_streamer
+        else:
+            self.submodules.ios_streamer = IOsStreamer(ios, [platform.request(io) for io in ios],
+                sys_clk_freq, baudrate)
 
 # Build --------------------------------------------------------------------------------------------
 
@@ -124,9 +219,17 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--build", action="store_true", help="build bitstream")
     parser.add_argument("--load", action="store_true", help="load bitstream")
+    parser.add_argument("--quarter", default=None, type=int, choices=range(4), help="only stream this quarter of the IOs, one UART per IO at 9600 baud (default: all IOs, shared ROM)")
+    parser.add_argument("--baudrate", default=115200, type=int, help="UART baudrate of the all-IOs streamer")
+    parser.add_argument("--sim", action="store_true", help="simulate the all-IOs streamer and decode it with host/pinmap.py")
     args = parser.parse_args()
 
-    soc     = IOsStreamSoC()
+    if args.sim:
+        if not simulate(get_ios(), baudrate=args.baudrate):
+            sys.exit(1)
+        return
+
+    soc     = IOsStreamSoC(quarter=args.quarter, baudrate=args.baudrate)
     builder = Builder(soc, output_dir="build")
     builder.build(build_name="ios_stream", run=args.build)
 
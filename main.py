@@ -16,8 +16,13 @@ from litex.soc.interconnect import stream
 from liteeth.phy.ecp5rgmii import LiteEthPHYRGMII
 from liteeth.core import LiteEthUDPIPCore
 from liteeth.common import convert_ip
+from liteeth.frontend.etherbone import LiteEthEtherbone
+from litespi.modules import W25Q32JV
+from litespi.opcodes import SpiNorFlashOpCodes as Codes
 from hw import Platform
-from pdm import PDM, UDPStreamer, UDPFake500Mbps
+from pdm import PDM, UDPStreamer, TrafficGenerator
+from host.format import SYS_CLK_FREQ, UDP_PORT
+from toolchain import build, toolchain_args, toolchain_argdict
 
 # Clock and Reset Generator --------------------------------------------------------------------------------
 
@@ -70,7 +75,8 @@ class BarebonesUDP(SoCMini):
     specials: Any
     submodules: Any
     platform: Any
-    def __init__(self, platform, ip_address, host_ip_address, port, mac_address, sys_clk_freq=int(50e6)):
+    def __init__(self, platform, ip_address, host_ip_address, port, mac_address, sys_clk_freq=int(SYS_CLK_FREQ),
+        with_flash=False, with_traffic=False):
         # Clock / Reset Generator
         self.crg = _CRG(platform, sys_clk_freq)
         self.submodules.crg = self.crg  # Add to submodules
@@ -101,6 +107,17 @@ class BarebonesUDP(SoCMini):
         self.platform.add_period_constraint(eth_tx_clk, 1e9 / self.ethphy.tx_clk_freq)
         self.platform.add_false_path_constraints(self.crg.cd_sys.clk, eth_rx_clk, eth_tx_clk)
 
+        # Etherbone (CSR and bulk flash access from the host, see etherbone.py/spiflash.py)
+        if with_flash or with_traffic:
+            self.etherbone = LiteEthEtherbone(self.ethcore.udp, 1234, mode="master")
+            self.bus.add_master(name="etherbone", master=self.etherbone.wishbone.bus)
+
+        # SPI Flash
+        if with_flash:
+            # Deep master FIFOs so a whole page program frame is queued from a single packet.
+            self.add_spi_flash(mode="1x", module=W25Q32JV(Codes.READ_1_1_1_FAST), with_master=True,
+                master_tx_fifo_depth=128, master_rx_fifo_depth=128)
+
         # PDM Clock (~3.125 MHz from 50 MHz sys clock)
         self.platform.add_source("cores/pdm_core.v")
         # pdm_clk_sig = Signal()
@@ -112,9 +129,14 @@ class BarebonesUDP(SoCMini):
         # self.comb += pdm_clk_pad.eq(pdm_clk_sig)
         # self.platform.add_period_constraint(pdm_clk_pad, 1e9 / (sys_clk_freq / 16))
 
-        # Fake 500 Mbps data generator (replaces PDM-to-UDP path for throughput test)
         self.submodules.pdm = PDM(platform.request("pdm_clk"), platform.request("pdm_data"))
-        # self.submodules.pdm = UDPFake500Mbps(data_width=32, clk_freq=self.clk_freq)
+        source = self.pdm.source
+
+        # Link qualification traffic, selected at runtime instead of the PDM stream (see host/linktest.py)
+        if with_traffic:
+            self.submodules.traffic = TrafficGenerator(clk_freq=self.clk_freq)
+            self.comb += self.pdm.source.connect(self.traffic.sink)
+            source = self.traffic.source
 
         # # PDM Data (two mics on one data line: rising-edge = Mic0, falling-edge = Mic1)
         # pdm_data_pads = platform.request("pdm_data", 0)  # 2-bit bus in platform; use bit 0 as shared line
@@ -130,7 +152,7 @@ class BarebonesUDP(SoCMini):
         )
 
         self.submodules += udp_streamer
-        self.comb += self.pdm.source.connect(udp_streamer.sink)
+        self.comb += source.connect(udp_streamer.sink)
         self.comb += udp_streamer.source.connect(udp_port.sink)
         # # UDP Sender Module
         # PACKET_WORDS = 512
@@ -153,7 +175,10 @@ def main():
     parser.add_argument("--ip", default="192.168.1.20", help="FPGA IP address")
     parser.add_argument("--host-ip", default="192.168.1.1", help="Host IP address")
     parser.add_argument("--mac", default="0x726b895bc2e2", help="FPGA MAC address")
-    parser.add_argument("--port", default=5678, type=int, help="UDP Port")
+    parser.add_argument("--port", default=UDP_PORT, type=int, help="UDP Port")
+    parser.add_argument("--with-flash", action="store_true", help="Add Etherbone and SPI Flash access")
+    parser.add_argument("--with-traffic", action="store_true", help="Add Etherbone and the link qualification traffic generator")
+    toolchain_args(parser)
 
     args = parser.parse_args()
 
@@ -165,11 +190,13 @@ def main():
         host_ip_address=args.host_ip,
         port=args.port,
         mac_address=int(args.mac, 0),
+        with_flash=args.with_flash,
+        with_traffic=args.with_traffic,
     )
 
     # Build the design
     builder = Builder(soc, output_dir="build", csr_csv="csr.csv")
-    builder.build(build_name="kandinsky", run=args.build)
+    build(builder, build_name="kandinsky", run=args.build, **toolchain_argdict(args))
 
     # Load the bitstream if required
     if args.load:
@@ -1,5 +1,10 @@
 from re import I
 from liteeth.common import *
+from litex.soc.interconnect.csr import *
+from host.format import SYS_CLK_FREQ, PDM_CLK_DIV, PINS, GROUP_WORDS, GROUPS_PER_PACKET, PACKET_BYTES, TRAFFIC_SEED
+
+# The PDM timing below (4-bit count, edges at 0 and 8) is written for this divider.
+assert PDM_CLK_DIV == 16
 
 # pyright: reportOperatorIssue=false
 # pyright: reportAttributeAccessIssue=false
@@ -12,7 +17,7 @@ class PDM(Module):
         count = Signal(4) # ranges from 0 to 15
         packet_id = Signal(32)
 
-        data_reg = Signal(24) 
+        data_reg = Signal(PINS)
 
         # add packet id as header
         statement = If((count & 15) == 0,
@@ -50,7 +55,7 @@ class UDPStreamer(Module):
 
         ip_address = convert_ip(ip_address)
 
-        max_packet = 96 # e.g., [packet_id, half0_word, half1_word] repeated 96 times
+        max_packet = GROUPS_PER_PACKET # e.g., [packet_id, half0_word, half1_word] repeated 96 times
         packet_counter = Signal(max=max_packet+1)
 
         self.submodules.fifo = fifo = stream.SyncFIFO([("data", data_width)], fifo_depth, buffered=True)
@@ -68,7 +73,7 @@ class UDPStreamer(Module):
             source.src_port.eq(udp_port),
             source.dst_port.eq(udp_port),
             source.ip_address.eq(ip_address),
-            source.length.eq(3 * 4 * max_packet),
+            source.length.eq(PACKET_BYTES),
             source.data.eq(fifo.source.data),
             source.last_be.eq({32:0b1000, 8:0b1}[data_width]),
             If(source.ready,
@@ -85,90 +90,115 @@ class UDPStreamer(Module):
         )
 
 
-class UDPFake500Mbps(Module):
-    def __init__(self, data_width=32, clk_freq=int(50e6)):
-        # Generates continuous 12-byte groups: [packet_id, word0, word1]
-        # first asserted on packet_id, last asserted on word1.
-        # Average payload rate ~500 Mbps at clk_freq=50 MHz.
-        # Stream interface matches UDPStreamer.sink layout.
-        assert data_width in (8, 32)
-        self.source = source = stream.Endpoint(eth_tty_tx_description(data_width))
+# Traffic Generator --------------------------------------------------------------------------------
 
-        # Rate control: target_words_per_cycle = 500e6 / (data_width * clk_freq)
-        # For data_width=32 and clk=50e6 => 0.3125 = 5/16 words/cycle.
-        # Implement fractional accumulator with numerator/denominator = 5/16.
-        numerator   = 5
-        denominator = 16
+def prbs31_next(word):
+    """Next 32 bits of the x^31 + x^28 + 1 sequence following the 32 bits of word (bit 0 first)."""
+    s = [word[i] for i in range(32)]
+    for n in range(32, 64):
+        s.append(s[n - 31] ^ s[n - 28])
+    return Cat(*s[32:])
 
-        acc       = Signal(max=denominator)  # 0..15
-        pending   = Signal()                 # pending word to send (valid must stay high until accepted)
+class TrafficGenerator(Module, AutoCSR):
+    """Link qualification traffic in the stream format, or the sink (PDM) stream passed through.
 
-        packet_id       = Signal(32)
-        payload_counter = Signal(32)
-        word_index      = Signal(2)  # 0: header, 1: word0, 2: word1
+    Generated groups are [group id, PRBS31 word, PRBS31 word]: one PRBS31 bit stream continues from
+    seed across groups, so host/linktest.py can check every payload word. Words are sent at
+    rate/2**32 per cycle, in bursts of burst_length groups (0: continuous) separated by burst_gap idle
+    cycles. Writing enable switches between the PDM stream and the generator between groups of both
+    streams; the group id and PRBS restart on every switch to the generator.
+    """
+    def __init__(self, data_width=32, clk_freq=int(SYS_CLK_FREQ)):
+        self.sink   = sink   = stream.Endpoint([("data", 32)])
+        self.source = source = stream.Endpoint(eth_tty_tx_description(data_width))
 
-        emit_strobe = Signal()
+        self.enable       = CSRStorage(description="Send generated traffic instead of the PDM stream.")
+        self.rate         = CSRStorage(32, reset=int(500e6/(32*clk_freq)*2**32), description="Words per cycle * 2**32.")
+        self.burst_length = CSRStorage(16, description="Groups per burst (0: continuous).")
+        self.burst_gap    = CSRStorage(32, description="Idle cycles between bursts.")
+        self.seed         = CSRStorage(32, reset=TRAFFIC_SEED, description="PRBS31 seed (bits 1-31 not all zero).")
+        self.groups       = CSRStatus(32, description="Generated groups.")
+        self.stalls       = CSRStatus(32, description="Cycles with a word waiting on a not ready sink.")
 
-        # Fractional accumulator to generate average emission rate.
-        self.sync += [
-            If(acc + numerator >= denominator,
-                acc.eq(acc + numerator - denominator),
-                emit_strobe.eq(1)
-            ).Else(
-                acc.eq(acc + numerator),
-                emit_strobe.eq(0)
-            )
-        ]
+        # # #
 
-        # Manage pending/handshake.
-        sent = Signal()
-        self.comb += [
-            sent.eq(source.valid & source.ready)
-        ]
+        active   = Signal()
+        transfer = Signal()
+        self.comb += transfer.eq(source.valid & source.ready)
+
+        # Switch between groups of both streams (the PDM source ignores ready).
+        source_boundary = Signal(reset=1)
+        sink_boundary   = Signal(reset=1)
         self.sync += [
-            If(sent,
-                pending.eq(0)
-            ).Elif(emit_strobe,
-                pending.eq(1)
+            If(transfer, source_boundary.eq(source.last)),
+            If(sink.valid, sink_boundary.eq(sink.last)),
+            If(source_boundary & sink_boundary & ~source.valid & ~sink.valid,
+                active.eq(self.enable.storage)
             )
         ]
 
-        # Drive stream signals.
-        self.comb += [
-            source.valid.eq(pending),
-            source.first.eq(word_index == 0),
-            source.last.eq(word_index == 2)
-        ]
-
-        # Data mux per word within the 12-byte group.
-        with_payload0 = Signal(data_width)
-        with_payload1 = Signal(data_width)
-
-        # Payload generation (simple incrementing pattern)
-        self.comb += [
-            with_payload0.eq(payload_counter[:data_width]),
-            with_payload1.eq((payload_counter + 1)[:data_width])
-        ]
-
-        self.comb += [
-            If(word_index == 0,
-                source.data.eq(packet_id[:data_width])
-            ).Elif(word_index == 1,
-                source.data.eq(with_payload0)
+        # Rate credits, bursts and PRBS
+        phase  = Signal(32)
+        carry  = Signal()
+        credit = Signal(4)
+        gap    = Signal(32)
+        burst  = Signal(16)
+        word   = Signal(max=GROUP_WORDS) # 0: group id, 1-2: PRBS words.
+        group  = Signal(32)
+        prbs   = Signal(32)
+        valid  = Signal()
+        # No new group once disabled, so that the switch back happens.
+        self.comb += valid.eq((credit != 0) & (gap == 0) & ~((word == 0) & ~self.enable.storage))
+
+        self.comb += If(active,
+            sink.ready.eq(1),
+            source.valid.eq(valid),
+            source.first.eq(word == 0),
+            source.last.eq(word == GROUP_WORDS - 1),
+            If(word == 0,
+                source.data.eq(group)
             ).Else(
-                source.data.eq(with_payload1)
+                source.data.eq(prbs31_next(prbs))
             )
-        ]
+        ).Else(
+            sink.connect(source)
+        )
 
-        # Advance on successful handshake; maintain format and counters.
         self.sync += [
-            If(sent,
-                If(word_index == 2,
-                    word_index.eq(0),
-                    packet_id.eq(packet_id + 1),
-                    payload_counter.eq(payload_counter + 2)
-                ).Else(
-                    word_index.eq(word_index + 1)
+            Cat(phase, carry).eq(phase + self.rate.storage),
+            If(~active,
+                credit.eq(0),
+                gap.eq(0),
+                burst.eq(0),
+                word.eq(0),
+                group.eq(0),
+                prbs.eq(self.seed.storage)
+            ).Else(
+                # One credit per rate overflow, a few kept through backpressure.
+                If(carry & ~transfer,
+                    If(credit != 15, credit.eq(credit + 1))
+                ).Elif(~carry & transfer,
+                    credit.eq(credit - 1)
+                ),
+                If(gap != 0, gap.eq(gap - 1)),
+                If(source.valid & ~source.ready, self.stalls.status.eq(self.stalls.status + 1)),
+                If(transfer,
+                    If(word != 0, prbs.eq(prbs31_next(prbs))),
+                    If(word == GROUP_WORDS - 1,
+                        word.eq(0),
+                        group.eq(group + 1),
+                        self.groups.status.eq(self.groups.status + 1),
+                        If(self.burst_length.storage != 0,
+                            If(burst == self.burst_length.storage - 1,
+                                burst.eq(0),
+                                gap.eq(self.burst_gap.storage)
+                            ).Else(
+                                burst.eq(burst + 1)
+                            )
+                        )
+                    ).Else(
+                        word.eq(word + 1)
+                    )
                 )
             )
-        ]
\ No newline at end of file
+        ]
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
+import os
+import sys
 import time
 import dearpygui.dearpygui as dpg
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from etherbone import Etherbone
+
 
 # Servo --------------------------------------------------------------------------------------------
 
@@ -12,13 +18,19 @@ class Servo:
         self.width  = getattr(bus.regs, f"servo{n}_width")
         self.period = getattr(bus.regs, f"servo{n}_period")
 
+        # Period, initial width and enable in one batch (a frame each, sent back to back).
         self.period_ticks = int(sys_clk_freq*20.0e-3)
-        self.period.write(self.period_ticks)
-        self.set(50)
-        self.on()
+        b = bus.batch()
+        b.write(self.period.addr, self.period_ticks)
+        b.write(self.width.addr, self.ticks(50))
+        b.write(self.enable.addr, 1)
+        b.execute()
+
+    def ticks(self, value):
+        return int(self.period_ticks/20*(1 + value/100))
 
     def set(self, value):
-        self.width.write(int(self.period_ticks/20*(1 + value/100)))
+        self.width.write(self.ticks(value))
 
     def on(self):
         self.enable.write(1)
@@ -31,10 +43,7 @@ class Servo:
 
 # GUI ----------------------------------------------------------------------------------------------
 
-from litex import RemoteClient
-
-bus = RemoteClient()
-bus.open()
+bus = Etherbone(csr_csv="csr.csv")
 
 dpg.create_context()
 dpg.create_viewport(title="Colorlite Gui Test", max_width=800, always_on_top=True)
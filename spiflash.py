@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+# Bulk SPI flash access over Etherbone.
+#
+# Reads go through the LiteSPI memory-mapped window (fast read) as burst reads; erase and page program
+# go through the LiteSPI master with a whole page queued in its TX FIFO before its status is polled.
+
+import sys
+import time
+import argparse
+
+from etherbone import Etherbone, EtherboneServer, CSRMap
+from bit_to_flash import W25Q32JV, flash_page_size, erase_block_size
+
+# Commands -----------------------------------------------------------------------------------------
+
+READ_ID = 0x9F
+WREN    = 0x06
+RDSR    = 0x05
+PP      = 0x02
+BE      = 0xD8 # 64 KiB block erase.
+
+WIP = 0x01
+
+RX_READY = 0b10 # LiteSPI master status.
+
+# SPIFlash -----------------------------------------------------------------------------------------
+
+class SPIFlash:
+    def __init__(self, bus, name="spiflash"):
+        self.bus  = bus
+        regs      = bus.csrs.regs
+        self._cs        = regs[f"{name}_core_master_cs"]
+        self._phyconfig = regs[f"{name}_core_master_phyconfig"]
+        self._rxtx      = regs[f"{name}_core_master_rxtx"]
+        self._status    = regs[f"{name}_core_master_status"]
+        self.mmap_base, self.size = bus.csrs.mems[name]
+
+        # SPI bit time, to wait for a queued frame to be shifted out before polling for it.
+        clk_freq = float(bus.csrs.constants.get("config_clock_frequency", 50e6))
+        divisor  = 1
+        if f"{name}_phy_clk_divisor" in regs:
+            divisor = bus.read(regs[f"{name}_phy_clk_divisor"])[0]
+        self.bit_time = 2*(divisor + 1)/clk_freq
+
+    # Master transfers: a frame is queued with write-only records (no reply to wait for), then its
+    # MISO words are popped once the master has shifted them.
+
+    def _begin(self, frame):
+        b = self.bus.batch()
+        b.write(self._cs, 1)
+        length = None
+        for i in range(0, len(frame), 4):
+            word = frame[i:i + 4]
+            if 8*len(word) != length:
+                length = 8*len(word)
+                b.write(self._phyconfig, length | (1 << 8) | (1 << 16)) # len, width=1, mask=1.
+            b.write(self._rxtx, int.from_bytes(word, "big"))
+        b.submit()
+
+    def _collect(self, frame):
+        """Pop the MISO words of a frame queued by _begin and release chip select.
+
+        Each rxtx read follows a status read in the same record and only counts if rx_ready was set. A
+        read racing with the arrival of a word (status read just before it) pops it uncounted. The core
+        executes frames in order, so the shift has started when a poll runs: a poll at least a frame
+        time after one that came up short sees the whole frame, and if words are still missing then,
+        None is returned.
+        """
+        n     = (len(frame) + 3)//4
+        shift = 8*len(frame)*self.bit_time
+        words = []
+        short = False
+        time.sleep(shift) # Typical shift time, before the first poll.
+        while True:
+            b = self.bus.batch()
+            for _ in range(n - len(words)):
+                b.read(self._status)
+                b.read(self._rxtx)
+            values = b.execute()
+            words += [rx for status, rx in zip(values[0::2], values[1::2]) if status & RX_READY]
+            if len(words) == n or short:
+                break
+            short = True
+            time.sleep(2*shift + 1e-3)
+        self.bus.write(self._cs, 0)
+        if len(words) < n:
+            return None
+        return b"".join(words[i].to_bytes(4, "big")[-len(frame[4*i:4*i + 4]):] for i in range(n))
+
+    def transfer(self, frame, retries=3):
+        """MISO bytes of frame, repeated if a word was lost (only for frames that are safe to repeat)."""
+        for _ in range(retries):
+            self._begin(frame)
+            miso = self._collect(frame)
+            if miso is not None:
+                return miso
+        raise IOError(f"SPI master lost MISO words of a {frame[0]:02x} frame {retries} times")
+
+    def _command(self, frame):
+        """Run a frame whose MISO bytes do not matter, only its completion."""
+        self._begin(frame)
+        self._collect(frame)
+
+    def _write_cmd(self, frame, poll_interval):
+        self._command(bytes([WREN]))
+        self._command(frame)
+        while self.transfer(bytes([RDSR, 0]))[1] & WIP:
+            time.sleep(poll_interval)
+
+    def read_id(self):
+        return int.from_bytes(self.transfer(bytes([READ_ID, 0, 0, 0]))[1:], "big")
+
+    def erase_block(self, addr):
+        self._write_cmd(bytes([BE]) + addr.to_bytes(3, "big"), poll_interval=10e-3)
+
+    def program_page(self, addr, data):
+        assert len(data) <= flash_page_size
+        self._write_cmd(bytes([PP]) + addr.to_bytes(3, "big") + data, poll_interval=0)
+
+    # Memory-mapped accesses.
+
+    def read(self, addr, length):
+        start = addr & ~3
+        words = self.bus.read(self.mmap_base + start, (addr + length - start + 3)//4) # Pipelined bursts.
+        data  = b"".join(w.to_bytes(4, "little") for w in words) # Flash byte 0 is the word's LSB.
+        return data[addr - start:addr - start + length]
+
+    def write(self, addr, data, progress=None):
+        """Write data at addr, only erasing/programming 64 KiB blocks whose content changes."""
+        first = addr // erase_block_size
+        last  = (addr + len(data) - 1) // erase_block_size
+        for block in range(first, last + 1):
+            start   = block*erase_block_size
+            current = self.read(start, erase_block_size)
+            new     = bytearray(current)
+            lo, hi  = max(addr, start), min(addr + len(data), start + erase_block_size)
+            new[lo - start:hi - start] = data[lo - addr:hi - addr]
+            if new != current:
+                self.erase_block(start)
+                for offset in range(0, erase_block_size, flash_page_size):
+                    page = bytes(new[offset:offset + flash_page_size])
+                    if page.count(0xff) != len(page):
+                        self.program_page(start + offset, page)
+            if progress is not None:
+                progress(block - first + 1, last - first + 1)
+
+    def verify(self, addr, data):
+        """Addresses of the pages that differ from data."""
+        readback = self.read(addr, len(data))
+        return [addr + i for i in range(0, len(data), flash_page_size)
+            if readback[i:i + flash_page_size] != data[i:i + flash_page_size]]
+
+# Simulation ---------------------------------------------------------------------------------------
+
+class SPIFlashSim:
+    """LiteSPI master/memory-mapped window around the W25Q32JV model, served by an EtherboneServer.
+
+    The master shifts one bit per `bit_time` (reported through the clock divisor), so MISO words reach
+    the RX FIFO one after the other, and reading rxtx with an empty FIFO pops nothing.
+    """
+    csrs = {
+        "spiflash_phy_clk_divisor"       : 0x4800,
+        "spiflash_core_master_cs"        : 0x4804,
+        "spiflash_core_master_phyconfig" : 0x4808,
+        "spiflash_core_master_rxtx"      : 0x480c,
+        "spiflash_core_master_status"    : 0x4810,
+    }
+    mmap_base = 0x10000000
+
+    def __init__(self, content=b"", bit_time=1e-6):
+        self.flash     = W25Q32JV(content)
+        self.divisor   = round(bit_time*50e6/2) - 1
+        self.bit_time  = 2*(self.divisor + 1)/50e6
+        self.shifted   = 0 # Time the last queued word is shifted.
+        self.cut       = 0
+        self.cs        = 0
+        self.phyconfig = 0
+        self.frame     = bytearray()
+        self.rx        = []
+
+    def csr_map(self):
+        m = CSRMap()
+        m.regs = dict(self.csrs)
+        m.mems = {"spiflash": (self.mmap_base, self.flash.size)}
+        return m
+
+    def bus_write(self, addr, value):
+        if addr == self.csrs["spiflash_core_master_cs"]:
+            if self.cs and not value and self.frame:
+                if time.perf_counter() < self.shifted:
+                    self.cut += 1 # Released mid-shift: the flash would not see a complete command.
+                else:
+                    self.flash.spi(bytes(self.frame))
+                self.frame = bytearray()
+            self.cs = value
+        elif addr == self.csrs["spiflash_core_master_phyconfig"]:
+            self.phyconfig = value
+        elif addr == self.csrs["spiflash_core_master_rxtx"]:
+            n = (self.phyconfig & 0xff)//8
+            self.frame += value.to_bytes(4, "big")[-n:]
+            miso = int.from_bytes(self.flash.miso(bytes(self.frame))[-n:], "big")
+            self.shifted = max(self.shifted, time.perf_counter()) + 8*n*self.bit_time
+            self.rx.append((self.shifted, miso))
+
+    def bus_read(self, addr):
+        if self.mmap_base <= addr < self.mmap_base + self.flash.size:
+            offset = addr - self.mmap_base
+            return int.from_bytes(self.flash.mem[offset:offset + 4], "little") # As LiteSPI's mmap serves it.
+        if addr == self.csrs["spiflash_phy_clk_divisor"]:
+            return self.divisor
+        ready = self.rx and self.rx[0][0] <= time.perf_counter()
+        if addr == self.csrs["spiflash_core_master_rxtx"]:
+            return self.rx.pop(0)[1] if ready else 0
+        if addr == self.csrs["spiflash_core_master_status"]:
+            return 0b01 | (RX_READY if ready else 0)
+        return 0
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Kandinsky SPI flash access over Etherbone")
+    parser.add_argument("--ip",      default="192.168.1.20", help="FPGA IP address")
+    parser.add_argument("--port",    default=1234, type=int, help="Etherbone UDP port")
+    parser.add_argument("--csr-csv", default="csr.csv",      help="CSR configuration file")
+    parser.add_argument("--offset",  default=0, type=lambda x: int(x, 0), help="Flash offset")
+    parser.add_argument("--write",   default=None,           help="Write image to flash")
+    parser.add_argument("--read",    default=None,           help="Read flash to file")
+    parser.add_argument("--length",  default=None, type=lambda x: int(x, 0), help="Read length (default: whole flash)")
+    parser.add_argument("--verify",  action="store_true",    help="Verify written image")
+    parser.add_argument("--sim",     action="store_true",    help="Run against a local simulated board")
+    args = parser.parse_args()
+
+    if args.sim:
+        sim    = SPIFlashSim(bytes(W25Q32JV.size)) # Non-blank content so everything gets erased.
+        server = EtherboneServer(sim.bus_read, sim.bus_write, port=0).start()
+        bus    = Etherbone(*server.addr, csr_csv=None)
+        bus.csrs = sim.csr_map()
+    else:
+        bus = Etherbone(args.ip, args.port, csr_csv=args.csr_csv)
+    flash = SPIFlash(bus)
+    print("Flash ID: {:06x}".format(flash.read_id()))
+
+    if args.write is not None:
+        with open(args.write, "rb") as f:
+            data = f.read()
+        start = time.time()
+        flash.write(args.offset, data,
+            progress=lambda n, total: print(f"\rWriting: {n}/{total} blocks", end="", flush=True))
+        print(f"\nWrote {len(data)} bytes in {time.time() - start:.1f} s")
+        if args.verify:
+            start = time.time()
+            errors = flash.verify(args.offset, data)
+            print(f"Verified {len(data)} bytes in {time.time() - start:.1f} s: {len(errors)} bad pages")
+            if errors:
+                sys.exit(1)
+
+    if args.read is not None:
+        length = args.length if args.length is not None else flash.size - args.offset
+        start  = time.time()
+        data   = flash.read(args.offset, length)
+        with open(args.read, "wb") as f:
+            f.write(data)
+        print(f"Read {len(data)} bytes in {time.time() - start:.1f} s")
+
+    bus.close()
+    if args.sim and sim.cut:
+        print(f"Simulated master: {sim.cut} frames cut by releasing chip select mid-shift")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ from liteeth.phy.ecp5rgmii import LiteEthPHYRGMII
 from liteeth.core import LiteEthUDPIPCore
 from liteeth.common import convert_ip
 from hw import Platform  # Your custom platform (hw.py)
+from toolchain import build, toolchain_args, toolchain_argdict
 
 # Clock and Reset Generator --------------------------------------------------------------------------------
 
@@ -145,6 +146,7 @@ def main():
     parser.add_argument("--host-ip", default="192.168.1.1", help="Host IP address")
     parser.add_argument("--mac", default="0x726b895bc2e2", help="FPGA MAC address")
     parser.add_argument("--port", default=5678, type=int, help="UDP Port")
+    toolchain_args(parser)
 
     args = parser.parse_args()
 
@@ -160,7 +162,7 @@ def main():
 
     # Build the design
     builder = Builder(soc, output_dir="build", csr_csv="csr.csv")
-    builder.build(build_name="barebones_udp", run=args.build)
+    build(builder, build_name="barebones_udp", run=args.build, **toolchain_argdict(args))
 
     # Load the bitstream if required
     if args.load:
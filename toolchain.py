@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+# Wrapper around the LiteX/Trellis gateware build (yosys -> nextpnr-ecp5 -> ecppack).
+#
+# LiteX generates the Verilog, LPF, Yosys script and build script; this module then decides whether
+# the toolchain actually has to run or whether identical inputs were already built before.
+
+import os
+import re
+import sys
+import time
+import shlex
+import resource
+import shutil
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Defaults -----------------------------------------------------------------------------------------
+
+BUILD_CACHE_DIR     = os.path.join("build", "cache")
+BUILD_CACHE_ENTRIES = 16
+BUILD_HISTORY       = os.path.join("build", "build_history.jsonl")
+
+# Artifacts restored from the cache (the .rpt is kept so build reports survive cache hits).
+CACHED_ARTIFACTS = [".json", ".config", ".bit", ".svf", ".rpt", "_nextpnr.log", "_seeds.rpt"]
+
+# Clock domains checked by the seed sweep, matched against nextpnr clock net names.
+CLOCK_DOMAINS = ["sys", "eth_rx", "eth_tx"]
+
+# Version commands of the tools referenced by the build script.
+TOOL_VERSION_CMDS = {
+    "yosys"        : ["yosys", "-V"],
+    "nextpnr-ecp5" : ["nextpnr-ecp5", "--version"],
+    "ecppack"      : ["ecppack", "--version"],
+}
+
+# Lines that change on every LiteX generation without changing the design.
+_VOLATILE_LINE = re.compile(rb"^(//|#).*(Date\s*:|Auto-generated by LiteX).*$", re.MULTILINE)
+
+# Build Key ----------------------------------------------------------------------------------------
+
+def tool_version(name):
+    try:
+        p = subprocess.run(TOOL_VERSION_CMDS[name], capture_output=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return "unknown"
+    return (p.stdout + p.stderr).decode(errors="replace").strip()
+
+def _hash_file(h, filename, tag):
+    with open(filename, "rb") as f:
+        data = f.read()
+    h.update(tag.encode() + b"\0")
+    h.update(_VOLATILE_LINE.sub(b"", data))
+    h.update(b"\0")
+
+def build_key(platform, gateware_dir, build_name, seeds=None):
+    """Content hash of everything the toolchain consumes for build_name."""
+    h = hashlib.sha256()
+    h.update(f"seeds\0{seeds}\0".encode())
+
+    # HDL sources (generated Verilog and added cores such as cores/pdm_core.v).
+    for filename in sorted(set(source[0] for source in platform.sources)):
+        _hash_file(h, filename, os.path.basename(filename))
+
+    # Constraints.
+    _hash_file(h, os.path.join(gateware_dir, build_name + ".lpf"), "lpf")
+
+    # Yosys script minus its (absolute path) read_verilog lines, already covered by the sources.
+    with open(os.path.join(gateware_dir, build_name + ".ys"), "r") as f:
+        ys = [l for l in f.read().splitlines() if not l.startswith("read_")]
+    h.update(("ys\0" + "\n".join(ys) + "\0").encode())
+
+    # Build script (nextpnr/ecppack options).
+    _hash_file(h, os.path.join(gateware_dir, "build_" + build_name + ".sh"), "sh")
+
+    # Toolchain versions.
+    for name in sorted(TOOL_VERSION_CMDS):
+        h.update((name + "\0" + tool_version(name) + "\0").encode())
+
+    return h.hexdigest()
+
+# Build Cache --------------------------------------------------------------------------------------
+
+class BuildCache:
+    """Content-addressed artifact store with least-recently-used eviction."""
+    def __init__(self, path=BUILD_CACHE_DIR, max_entries=BUILD_CACHE_ENTRIES):
+        self.path        = path
+        self.max_entries = max_entries
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def restore(self, key, gateware_dir, build_name):
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return False
+        for ext in CACHED_ARTIFACTS:
+            src = os.path.join(entry, "artifact" + ext)
+            if os.path.exists(src):
+                shutil.copy2(src, os.path.join(gateware_dir, build_name + ext))
+        os.utime(entry) # Mark as most recently used.
+        return True
+
+    def store(self, key, gateware_dir, build_name):
+        os.makedirs(self.path, exist_ok=True)
+        entry = self._entry(key)
+        tmp   = entry + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for ext in CACHED_ARTIFACTS:
+            src = os.path.join(gateware_dir, build_name + ext)
+            if os.path.exists(src):
+                shutil.copy2(src, os.path.join(tmp, "artifact" + ext))
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def entries(self):
+        if not os.path.isdir(self.path):
+            return []
+        entries = [os.path.join(self.path, e) for e in os.listdir(self.path) if not e.endswith(".tmp")]
+        return sorted(entries, key=os.path.getmtime, reverse=True)
+
+    def evict(self):
+        for entry in self.entries()[self.max_entries:]:
+            shutil.rmtree(entry, ignore_errors=True)
+
+# Toolchain Run ------------------------------------------------------------------------------------
+
+_FMAX_LINE = re.compile(r"Max frequency for clock\s+'(.+?)': ([\d.]+) MHz \((PASS|FAIL) at ([\d.]+) MHz\)")
+
+def build_script_commands(gateware_dir, build_name):
+    """Tool commands of the LiteX generated build script, keyed by tool name."""
+    cmds = {}
+    with open(os.path.join(gateware_dir, "build_" + build_name + ".sh"), "r") as f:
+        for line in f:
+            args = shlex.split(line, comments=True)
+            if args and args[0] in TOOL_VERSION_CMDS:
+                cmds[args[0]] = args
+    return cmds
+
+def with_option(cmd, opt, value):
+    cmd = list(cmd)
+    if opt in cmd:
+        cmd[cmd.index(opt) + 1] = value
+    else:
+        cmd += [opt, value]
+    return cmd
+
+def run_build_script(gateware_dir, build_name):
+    """Run the build script commands in order, keeping the nextpnr log for build reports."""
+    cmds = build_script_commands(gateware_dir, build_name)
+    subprocess.run(cmds["yosys"], cwd=gateware_dir, check=True)
+    subprocess.run(with_option(cmds["nextpnr-ecp5"], "--log", build_name + "_nextpnr.log"), cwd=gateware_dir, check=True)
+    subprocess.run(cmds["ecppack"], cwd=gateware_dir, check=True)
+
+# Seed Sweep ---------------------------------------------------------------------------------------
+
+def clock_domain(net):
+    for domain in sorted(CLOCK_DOMAINS, key=len, reverse=True):
+        if domain + "_clk" in net or net.endswith(domain):
+            return domain
+    return net
+
+def parse_fmax(log):
+    """Final (post-route) achieved/constrained frequency per clock domain from a nextpnr log."""
+    fmax = {}
+    for net, achieved, _, target in _FMAX_LINE.findall(log):
+        fmax[clock_domain(net)] = (float(achieved), float(target))
+    return fmax
+
+def _run_seed(nextpnr_cmd, gateware_dir, build_name, seed):
+    seed_dir = os.path.abspath(os.path.join(gateware_dir, "seeds", f"seed{seed}"))
+    os.makedirs(seed_dir, exist_ok=True)
+    cmd = with_option(nextpnr_cmd, "--seed", str(seed))
+    cmd = with_option(cmd, "--textcfg", os.path.join(seed_dir, build_name + ".config"))
+    p   = subprocess.run(cmd, cwd=gateware_dir, capture_output=True, text=True)
+    log = p.stdout + p.stderr
+    with open(os.path.join(seed_dir, "nextpnr.log"), "w") as f:
+        f.write(log)
+    return {"seed": seed, "returncode": p.returncode, "fmax": parse_fmax(log), "dir": seed_dir}
+
+def _seed_margin(result):
+    # Worst achieved/constrained ratio over the domains; >= 1.0 means every constraint is met.
+    if result["returncode"] != 0 or not result["fmax"]:
+        return 0.0
+    return min(achieved/target for achieved, target in result["fmax"].values())
+
+def write_seed_summary(filename, results, best):
+    domains = sorted(set(d for r in results for d in r["fmax"]), key=lambda d: (CLOCK_DOMAINS + [d]).index(d))
+    with open(filename, "w") as f:
+        f.write("seed  " + "".join(f"{d:>24s}" for d in domains) + "  margin  status\n")
+        for r in sorted(results, key=lambda r: r["seed"]):
+            cols = ""
+            for d in domains:
+                achieved, target = r["fmax"].get(d, (0.0, 0.0))
+                cols += f"{achieved:>10.2f} / {target:>7.2f} MHz"
+            status = "FAILED" if r["returncode"] else ("PASS" if _seed_margin(r) >= 1.0 else "FAIL")
+            mark   = " <- selected" if r is best else ""
+            f.write(f"{r['seed']:4d}  {cols}  {_seed_margin(r):6.3f}  {status}{mark}\n")
+
+def run_seed_sweep(gateware_dir, build_name, seeds, jobs=None):
+    """Synthesize once, place and route seeds 1..seeds in parallel and pack the best run."""
+    cmds = build_script_commands(gateware_dir, build_name)
+    subprocess.run(cmds["yosys"], cwd=gateware_dir, check=True)
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        results = list(pool.map(lambda seed: _run_seed(cmds["nextpnr-ecp5"], gateware_dir, build_name, seed),
+            range(1, seeds + 1)))
+
+    best = max(results, key=_seed_margin)
+    summary = os.path.join(gateware_dir, build_name + "_seeds.rpt")
+    write_seed_summary(summary, results, best)
+    print(open(summary).read(), end="")
+    if _seed_margin(best) < 1.0:
+        raise RuntimeError(f"None of the {seeds} nextpnr seeds met timing constraints, see {summary}.")
+
+    shutil.copy2(os.path.join(best["dir"], build_name + ".config"), os.path.join(gateware_dir, build_name + ".config"))
+    shutil.copy2(os.path.join(best["dir"], "nextpnr.log"), os.path.join(gateware_dir, build_name + "_nextpnr.log"))
+    subprocess.run(cmds["ecppack"], cwd=gateware_dir, check=True)
+    print(f"Selected nextpnr seed {best['seed']} (margin {_seed_margin(best):.3f}).")
+
+def run_toolchain(gateware_dir, build_name, seeds=None, jobs=None, history=None):
+    start = time.monotonic()
+    if seeds:
+        run_seed_sweep(gateware_dir, build_name, seeds, jobs)
+    else:
+        run_build_script(gateware_dir, build_name)
+    wall_time = time.monotonic() - start
+
+    # Peak RSS of the largest toolchain process (kB on Linux, bytes on macOS).
+    peak_mem = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    peak_mem = peak_mem/2**20 if sys.platform == "darwin" else peak_mem/2**10
+
+    if history is not None:
+        from build_report import record
+        record(gateware_dir, build_name, history, wall_time=wall_time, peak_mem_mb=peak_mem)
+
+# Build --------------------------------------------------------------------------------------------
+
+def build(builder, build_name, run=True, cache_dir=BUILD_CACHE_DIR, cache_entries=BUILD_CACHE_ENTRIES,
+    seeds=None, jobs=None, history=BUILD_HISTORY):
+    """Drop-in for builder.build(): generate with LiteX, then run the toolchain unless cached.
+
+    With seeds, nextpnr is swept over that many seeds and the best timing result is kept. Every
+    toolchain run is appended to the history file (see build_report.py).
+    """
+    # Let LiteX generate Verilog/LPF/scripts without running the toolchain.
+    vns = builder.build(build_name=build_name, run=False)
+    if not run:
+        return vns
+
+    gateware_dir = builder.gateware_dir
+    platform     = builder.soc.platform
+
+    if cache_dir is None:
+        run_toolchain(gateware_dir, build_name, seeds, jobs, history)
+        return vns
+
+    cache = BuildCache(cache_dir, cache_entries)
+    key   = build_key(platform, gateware_dir, build_name, seeds)
+    if cache.restore(key, gateware_dir, build_name):
+        print(f"Build cache hit ({key[:12]}), reusing {build_name} artifacts.")
+        return vns
+
+    print(f"Build cache miss ({key[:12]}), running toolchain.")
+    run_toolchain(gateware_dir, build_name, seeds, jobs, history)
+    cache.store(key, gateware_dir, build_name)
+    return vns
+
+# Arguments ----------------------------------------------------------------------------------------
+
+def toolchain_args(parser):
+    parser.add_argument("--build-cache",         default=BUILD_CACHE_DIR,     help="Bitstream cache directory")
+    parser.add_argument("--build-cache-entries", default=BUILD_CACHE_ENTRIES, type=int, help="Bitstreams kept in cache")
+    parser.add_argument("--no-build-cache",      action="store_true",         help="Always run the toolchain")
+    parser.add_argument("--build-history",       default=BUILD_HISTORY,       help="Build report history file")
+    parser.add_argument("--seeds",               default=None, type=int,      help="Sweep N nextpnr seeds in parallel, keep the best")
+    parser.add_argument("--seed-jobs",           default=None, type=int,      help="Parallel nextpnr runs (default: all cores)")
+
+def toolchain_argdict(args):
+    return {
+        "cache_dir"     : None if args.no_build_cache else args.build_cache,
+        "cache_entries" : args.build_cache_entries,
+        "seeds"         : args.seeds,
+        "jobs"          : args.seed_jobs,
+        "history"       : args.build_history,
+    }